@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+Offline end-to-end benchmark for the MCP server.
+
+Drives `python main.py --http` over MCP with a fixed mix of tool calls from
+several concurrent client sessions, using the load generator behind
+`clients.py bench`, and reports calls, errors, throughput, a latency
+histogram and p50/p95/p99 latency per tool. With --spawn it first starts
+fake_arcgis.py and the MCP server (pointed at it through
+ESRI_MCP_LAYER_BASE_URL, with fresh metadata/sync databases), so runs need
+no network and are reproducible.
+
+Usage:
+    python benchmark.py --spawn --duration 30 --concurrency 8
+    python benchmark.py --url http://localhost:8000/mcp --iterations 200 --json results.json
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+import clients
+
+# (tool, arguments) pairs run in order, round-robin across workers.
+SCENARIOS = [
+    ("query_point_layer", {"layer_name": "usgs-gauges", "where": "state = 'MI'", "return_count_only": True}),
+    ("query_point_layer", {"layer_name": "weather-stations", "where": "STATE = 'TX'", "return_geometry": True}),
+    ("query_layer", {"layer_name": "storm-reports", "where": "STATE = 'TX' AND EVENT_TYPE = 'HAIL'"}),
+    ("query_layer", {"layer_name": "rivers", "where": "STATE = 'VA'", "return_geometry": True}),
+    ("query_layer", {"layer_name": "dams", "where": "1=1", "strategy": "paged"}),
+    ("query_layer", {"layer_name": "sample-points", "where": "STATE = 'MI'", "strategy": "objectids"}),
+    ("query_geojson", {"layer_name": "watersheds", "where": "STATE = 'MI'", "resolution": 1000}),
+    ("query_geojson", {"layer_name": "counties", "where": "STATE = 'OH'"}),
+    ("query_statistics", {"layer_name": "dams", "group_by": "STATE", "statistics": [{"type": "avg", "field": "NID_HEIGHT", "alias": "avg_height"}]}),
+    ("query_many", {"queries": [
+        {"id": "gauges", "layer_name": "usgs-gauges", "where": "state = 'MI'", "return_count_only": True},
+        {"id": "dams", "layer_name": "dams", "where": "STATE = 'MI'", "return_count_only": True},
+        {"id": "stations", "layer_name": "water-quality", "where": "STATE = 'MI'", "return_count_only": True},
+    ]}),
+    ("get_layer_fields", {"layer_name": "rivers"}),
+]
+
+
+def _bust(arguments: dict, counter: int) -> dict:
+    """Makes the call's where clause unique, so it cannot be answered from the response cache."""
+    arguments = json.loads(json.dumps(arguments))
+    specs = arguments.get("queries", [arguments])
+    for spec in specs:
+        if "where" in spec:
+            spec["where"] = f"({spec['where']}) AND OBJECTID <> -{counter}"
+    return arguments
+
+
+async def run(url: str, concurrency: int, duration, iterations, bust_cache: bool, warmup: int, rate=None) -> dict:
+    if warmup:
+        # Loads layer metadata and opens upstream connections before measuring.
+        await clients.run_bench(url, SCENARIOS * warmup, concurrency=1)
+    calls = itertools.cycle(SCENARIOS) if duration is not None else iter(SCENARIOS * iterations)
+    if bust_cache:
+        calls = ((tool, _bust(arguments, n)) for n, (tool, arguments) in enumerate(calls, 1))
+    return await clients.run_bench(url, calls, concurrency, rate, duration)
+
+
+def _wait_for(url: str, process: subprocess.Popen, timeout: float = 60) -> None:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{' '.join(process.args)} exited with {process.returncode}")
+        try:
+            httpx.get(url, timeout=1)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    raise RuntimeError(f"Timed out waiting for {url}")
+
+
+def spawn(args) -> list:
+    """Starts fake_arcgis.py and the MCP server against it; returns the processes."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    state = tempfile.mkdtemp(prefix="esri-mcp-bench-")
+    fake = subprocess.Popen(
+        [sys.executable, os.path.join(here, "fake_arcgis.py"), "--port", str(args.fake_port),
+         "--latency", str(args.latency), "--jitter", str(args.jitter), "--error-rate", str(args.error_rate)],
+        cwd=here,
+    )
+    processes = [fake]
+    try:
+        _wait_for(f"http://127.0.0.1:{args.fake_port}/admin/stats", fake)
+        environment = {
+            **os.environ,
+            "ESRI_MCP_LAYER_BASE_URL": f"http://127.0.0.1:{args.fake_port}",
+            "ESRI_MCP_HTTP_PORT": str(args.port),
+            "ESRI_MCP_METADATA_DB": os.path.join(state, "metadata.sqlite"),
+            "ESRI_MCP_SYNC_DB": os.path.join(state, "sync.sqlite"),
+            # Every fake layer shares one host; do not let the per-host rate limit cap the benchmark.
+            "ESRI_MCP_HOST_RATE": os.environ.get("ESRI_MCP_HOST_RATE", "100000"),
+            "ESRI_MCP_HOST_BURST": os.environ.get("ESRI_MCP_HOST_BURST", "100000"),
+            "ESRI_MCP_HOST_MAX_IN_FLIGHT": os.environ.get("ESRI_MCP_HOST_MAX_IN_FLIGHT", "64"),
+        }
+        server = subprocess.Popen([sys.executable, os.path.join(here, "main.py"), "--http"], cwd=here, env=environment)
+        processes.append(server)
+        _wait_for(f"http://127.0.0.1:{args.port}/metrics", server)
+    except Exception:
+        stop(processes)
+        raise
+    return processes
+
+
+def stop(processes: list) -> None:
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--url", help="MCP endpoint (default: the spawned server, or http://localhost:8000/mcp)")
+    parser.add_argument("--spawn", action="store_true", help="Start fake_arcgis.py and main.py --http for the run")
+    parser.add_argument("--port", type=int, default=8765, help="MCP server port with --spawn")
+    parser.add_argument("--fake-port", type=int, default=8090, help="Fake ArcGIS server port with --spawn")
+    parser.add_argument("--latency", type=float, default=0.02, help="Fake upstream latency with --spawn")
+    parser.add_argument("--jitter", type=float, default=0.01, help="Fake upstream jitter with --spawn")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fake upstream 503 rate with --spawn")
+    parser.add_argument("--concurrency", type=int, default=4, help="Concurrent MCP client sessions")
+    parser.add_argument("--rate", type=float, help="Start this many calls per second instead of running closed-loop")
+    parser.add_argument("--duration", type=float, help="Run for this many seconds instead of a fixed number of iterations")
+    parser.add_argument("--iterations", type=int, default=20, help="Passes over the scenario list")
+    parser.add_argument("--warmup", type=int, default=1, help="Unmeasured passes before the run")
+    parser.add_argument("--bust-cache", action="store_true", help="Make every query unique so the response cache is bypassed")
+    parser.add_argument("--json", dest="json_path", help="Also write the report to this file")
+    args = parser.parse_args()
+
+    processes = spawn(args) if args.spawn else []
+    url = args.url or (f"http://127.0.0.1:{args.port}/mcp" if args.spawn else "http://localhost:8000/mcp")
+    try:
+        report = asyncio.run(run(url, args.concurrency, args.duration, args.iterations, args.bust_cache, args.warmup, args.rate))
+    finally:
+        stop(processes)
+    clients.print_bench_report(report)
+    if args.json_path:
+        with open(args.json_path, "w") as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
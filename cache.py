@@ -0,0 +1,108 @@
+"""
+In-process LRU + TTL cache for upstream query responses.
+
+Entries expire after a per-entry TTL and the least recently used entries are
+evicted once the cached responses exceed `max_bytes` (measured by the
+upstream response size the caller reports, or the compact JSON size when it
+reports none).
+"""
+
+import json
+import re
+import time
+from collections import OrderedDict
+from typing import Optional
+
+
+def canonical_key(*parts) -> str:
+    """Builds a stable cache key from JSON-serializable parts."""
+    return json.dumps(parts, sort_keys=True, separators=(",", ":"), default=str)
+
+
+# Single-quoted SQL literals ('' is an escaped quote inside one), or a run of whitespace.
+_WHERE_TOKEN = re.compile(r"'(?:[^']|'')*'|\s+")
+
+
+def normalize_where(where: str) -> str:
+    """Collapses whitespace runs to one space, leaving quoted string literals untouched."""
+    normalized = _WHERE_TOKEN.sub(lambda match: match.group() if match.group().startswith("'") else " ", where.strip())
+    return normalized or "1=1"
+
+
+def normalize_out_fields(out_fields: str) -> str:
+    fields = sorted({field.strip() for field in out_fields.split(",") if field.strip()})
+    return "*" if "*" in fields else ",".join(fields)
+
+
+class TTLCache:
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries = OrderedDict()
+
+    def get(self, key: str):
+        """
+        Returns a shallow copy of the cached value, or None.
+
+        Top-level keys of the copy can be replaced freely; nested lists and
+        dicts (such as "features") are shared with the cache and must not be
+        mutated in place.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, size, value = entry
+        if expires_at <= time.monotonic():
+            self._remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return dict(value) if isinstance(value, dict) else value
+
+    def set(self, key: str, value, ttl: float, size: Optional[int] = None) -> None:
+        """Stores `value` for `ttl` seconds; `size` is its upstream byte count, measured as compact JSON when omitted."""
+        if ttl <= 0:
+            return
+        if size is None:
+            size = len(json.dumps(value, separators=(",", ":")))
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.monotonic() + ttl, size, value)
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def invalidate(self, predicate=None) -> int:
+        """Drops every entry, or those whose key matches `predicate`; returns the count."""
+        keys = [key for key in self._entries if predicate is None or predicate(key)]
+        for key in keys:
+            self._remove(key)
+        return len(keys)
+
+    def _remove(self, key: str) -> None:
+        _, size, _ = self._entries.pop(key)
+        self.bytes -= size
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else None,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
@@ -0,0 +1,162 @@
+"""
+Record/replay of upstream traffic.
+
+With ESRI_MCP_CASSETTE_MODE=record every upstream response is written to
+ESRI_MCP_CASSETTE_DIR (default ~/.cache/esri-mcp/cassettes), one gzipped
+JSON file per request fingerprint, together with how long upstream took to
+answer. With ESRI_MCP_CASSETTE_MODE=replay requests are answered from those
+files without touching the network, after the recorded latency multiplied by
+ESRI_MCP_CASSETTE_TIME_SCALE (default 1; 0 answers immediately). A request
+with no recording fails with CassetteMissError and is listed in `stats()`.
+ESRI_MCP_CASSETTE_MODE=auto replays what is recorded and records the rest.
+
+A fingerprint covers the method, URL, query parameters and form body, with
+parameters sorted so their order does not matter; request headers are not
+part of it. Conditional requests are answered from the stored response: a
+304 when its ETag or Last-Modified matches, the full response otherwise.
+Only definitive answers are stored, so 304s, 429s and 5xx responses never
+overwrite a recording.
+"""
+
+import asyncio
+import base64
+import gzip
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import Optional
+from urllib.parse import parse_qsl
+
+import httpx
+
+import metrics
+import tracing
+
+MODE = os.environ.get("ESRI_MCP_CASSETTE_MODE", "off")
+CASSETTE_DIR = os.environ.get("ESRI_MCP_CASSETTE_DIR", os.path.expanduser("~/.cache/esri-mcp/cassettes"))
+TIME_SCALE = float(os.environ.get("ESRI_MCP_CASSETTE_TIME_SCALE", "1"))
+RECORD = MODE in ("record", "auto")
+REPLAY = MODE in ("replay", "auto")
+# Distinct missed requests kept for stats().
+MAX_MISSES_LISTED = 100
+
+# Recomputed from the body on replay.
+_DROPPED_HEADERS = {"content-encoding", "content-length", "transfer-encoding", "connection", "keep-alive"}
+
+logger = logging.getLogger(__name__)
+
+_stats = {"hits": 0, "misses": 0, "recorded": 0, "not_modified": 0}
+_misses = {}
+
+
+class CassetteMissError(httpx.TransportError):
+    """Raised in replay mode for a request that has no recorded response."""
+
+
+def fingerprint(method: str, url: str, kwargs: dict) -> str:
+    """Returns a stable key for the request, independent of parameter order and headers."""
+    request = httpx.Request(method, url, params=kwargs.get("params"), data=kwargs.get("data"), json=kwargs.get("json"), content=kwargs.get("content"))
+    query = sorted(parse_qsl(request.url.query.decode(), keep_blank_values=True))
+    body = request.content
+    if request.headers.get("Content-Type", "").startswith("application/x-www-form-urlencoded"):
+        body_key = sorted(parse_qsl(body.decode(), keep_blank_values=True))
+    else:
+        body_key = hashlib.sha256(body).hexdigest() if body else ""
+    key = [method.upper(), str(request.url.copy_with(query=None)), query, body_key]
+    return hashlib.sha256(json.dumps(key, separators=(",", ":")).encode()).hexdigest()[:32]
+
+
+def _path(url: str, key: str) -> str:
+    host = httpx.URL(url).netloc.decode().replace(":", "_")
+    return os.path.join(CASSETTE_DIR, host, f"{key}.json.gz")
+
+
+def _read(path: str) -> Optional[dict]:
+    try:
+        with gzip.open(path, "rt") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+
+def _write(path: str, entry: dict) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with gzip.open(temp_path, "wt") as file:
+        json.dump(entry, file, separators=(",", ":"))
+    # Concurrent readers see the old recording or the new one, never a partial file.
+    os.replace(temp_path, path)
+
+
+def _not_modified(entry: dict, headers: dict) -> bool:
+    stored = {name.lower(): value for name, value in entry["headers"]}
+    request = {name.lower(): value for name, value in (headers or {}).items()}
+    if "if-none-match" in request:
+        return request["if-none-match"] == stored.get("etag")
+    return "if-modified-since" in request and request["if-modified-since"] == stored.get("last-modified")
+
+
+async def replay(method: str, url: str, kwargs: dict) -> Optional[httpx.Response]:
+    """Returns the recorded response for the request after its recorded latency, or None if there is none."""
+    key = fingerprint(method, url, kwargs)
+    with tracing.span("cassette.replay", **{"cassette.fingerprint": key}) as replay_span:
+        entry = await asyncio.to_thread(_read, _path(url, key))
+        if entry is None:
+            _stats["misses"] += 1
+            if key in _misses:
+                _misses[key]["count"] += 1
+            elif len(_misses) < MAX_MISSES_LISTED:
+                logger.warning("Cassette miss: %s %s (%s)", method.upper(), url, key)
+                _misses[key] = {"method": method.upper(), "url": url, "fingerprint": key, "count": 1}
+            if replay_span is not None:
+                replay_span.set(**{"cassette.hit": False})
+            return None
+        _stats["hits"] += 1
+        delay = entry["elapsed"] * TIME_SCALE
+        if delay > 0:
+            await asyncio.sleep(delay)
+        status, content = entry["status"], base64.b64decode(entry["body"])
+        if _not_modified(entry, kwargs.get("headers")):
+            _stats["not_modified"] += 1
+            status, content = 304, b""
+        if replay_span is not None:
+            replay_span.set(**{"cassette.hit": True, "http.response.status_code": status})
+    metrics.observe_upstream(httpx.URL(url).netloc.decode(), url, delay, len(content), error=status >= 400)
+    return httpx.Response(
+        status,
+        headers=[(name, value) for name, value in entry["headers"] if name.lower() not in _DROPPED_HEADERS],
+        content=content,
+        request=httpx.Request(method, url, params=kwargs.get("params")),
+        extensions={"http_version": entry["http_version"].encode()},
+    )
+
+
+async def record(method: str, url: str, kwargs: dict, response: httpx.Response) -> None:
+    """Stores the response for later replay, unless it is a 304 or a transient failure."""
+    if response.status_code == 304 or response.status_code == 429 or response.status_code >= 500:
+        return
+    key = fingerprint(method, url, kwargs)
+    entry = {
+        "method": method.upper(),
+        "url": url,
+        "recorded_at": time.time(),
+        "elapsed": response.elapsed.total_seconds(),
+        "status": response.status_code,
+        "http_version": response.http_version,
+        "headers": list(response.headers.multi_items()),
+        "body": base64.b64encode(response.content).decode(),
+    }
+    await asyncio.to_thread(_write, _path(url, key), entry)
+    _stats["recorded"] += 1
+
+
+def stats() -> dict:
+    return {
+        "mode": MODE,
+        "directory": CASSETTE_DIR if MODE != "off" else None,
+        "time_scale": TIME_SCALE,
+        **_stats,
+        "missed_requests": list(_misses.values()),
+    }
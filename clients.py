@@ -5,20 +5,51 @@ MCP Client for Esri Living Atlas Tools
 This script provides a command-line interface to interact with the Esri Living Atlas MCP server.
 It can list available tools and call them with provided parameters.
 
+It can also replay a workload file of tool calls as a load test (see `bench` below).
+
 Usage:
     python clients.py list-tools
     python clients.py call-tool <tool_name> <param1> <value1> <param2> <value2> ...
+    python clients.py bench <workload_file> [option value ...]
 
 Example:
     python clients.py call-tool query_layer layer_name usgs-gauges where "state = 'MI'" return_count_only true
+    python clients.py bench scripts/workload.json concurrency 8 duration 60
+    python clients.py bench scripts/workload.json rate 20 duration 60 json results.json
+
+Bench options:
+    concurrency N   Persistent MCP sessions (default 4). Without `rate`, each session
+                    sends its next call as soon as the previous one returns.
+    rate N          Start N calls per second on a fixed schedule, whatever the response
+                    times, spread over the sessions. Latency then includes queueing.
+    duration S      Run for S seconds, cycling through the workload.
+    requests N      Stop after N calls, cycling through the workload. Without `duration`
+                    or `requests`, the workload runs once.
+    warmup N        Unmeasured calls before the run (default 0).
+    json PATH       Also write the report to PATH.
+
+The workload file is a JSON list (or JSON lines) of
+{"tool": <name>, "arguments": {...}, "weight": <times per pass, default 1>}.
 """
 
 import asyncio
+import contextlib
+import itertools
 import sys
 import json
+import math
+import time
 from fastmcp import Client
 import httpx
 
+# Upper bounds of the latency histogram buckets, in milliseconds.
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+# Command-line option -> (bench() argument, type)
+BENCH_OPTIONS = {
+    "concurrency": ("concurrency", int), "rate": ("rate", float), "duration": ("duration", float),
+    "requests": ("requests", int), "warmup": ("warmup", int), "json": ("json_path", str),
+}
+
 
 async def list_tools(server_url):
     """List all available tools from the MCP server."""
@@ -43,6 +74,156 @@ async def call_tool(server_url, tool_name, **kwargs):
         print(f"Error calling tool: {e}")
 
 
+def load_workload(path):
+    """Read a workload file into a list of (tool, arguments) pairs, one pass in order."""
+    with open(path) as file:
+        text = file.read()
+    try:
+        entries = json.loads(text)
+    except json.JSONDecodeError:
+        entries = [json.loads(line) for line in text.splitlines() if line.strip()]
+    calls = []
+    for entry in entries:
+        calls.extend([(entry["tool"], entry.get("arguments", {}))] * int(entry.get("weight", 1)))
+    return calls
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of an unsorted list."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    # Rounded first so float noise (0.07 * 100 == 7.000000000000001) does not push the rank up by one.
+    rank = math.ceil(round(fraction * len(ordered), 9))
+    return ordered[max(0, min(len(ordered) - 1, rank - 1))]
+
+
+def is_error(result):
+    """Whether a tool result is a failure, including the {"error": ...} results the server returns."""
+    if result.is_error:
+        return True
+    data = result.structured_content
+    if isinstance(data, dict):
+        value = data.get("result", data)
+        return isinstance(value, dict) and "error" in value or isinstance(value, str) and value.startswith(("Error", "Query error"))
+    return False
+
+
+def _latency_summary(latencies):
+    return {name: round(percentile(latencies, fraction) * 1000, 1) if latencies else None for name, fraction in (("p50_ms", 0.5), ("p95_ms", 0.95), ("p99_ms", 0.99))}
+
+
+async def run_bench(server_url, calls, concurrency=4, rate=None, duration=None):
+    """
+    Replay (tool, arguments) pairs from `calls` over `concurrency` persistent sessions and return a report.
+
+    Without `rate` this is a closed loop: each session sends its next call as soon as the previous one returns.
+    With `rate`, calls start on a fixed schedule of `rate` per second, round-robin over the sessions, and each
+    latency is measured from the call's scheduled start, so a server that falls behind shows it. Stops when
+    `calls` is exhausted or after `duration` seconds.
+    """
+    calls = iter(calls)
+    samples = {}
+
+    async def timed(client, tool, arguments, scheduled):
+        try:
+            failed = is_error(await client.call_tool(tool, arguments, raise_on_error=False))
+        except Exception:
+            failed = True
+        entry = samples.setdefault(tool, {"latencies": [], "errors": 0})
+        entry["latencies"].append(time.perf_counter() - scheduled)
+        entry["errors"] += failed
+
+    async def worker(client, deadline):
+        # Sessions share the call iterator, so the mix is the same whatever the concurrency.
+        for tool, arguments in calls:
+            if deadline is not None and time.perf_counter() >= deadline:
+                return
+            await timed(client, tool, arguments, time.perf_counter())
+
+    async with contextlib.AsyncExitStack() as stack:
+        clients = [await stack.enter_async_context(Client(server_url)) for _ in range(concurrency)]
+        started = time.perf_counter()
+        deadline = started + duration if duration else None
+        if rate:
+            pending = set()
+            for n, (tool, arguments) in enumerate(calls):
+                scheduled = started + n / rate
+                if deadline is not None and scheduled >= deadline:
+                    break
+                await asyncio.sleep(max(0, scheduled - time.perf_counter()))
+                task = asyncio.create_task(timed(clients[n % concurrency], tool, arguments, scheduled))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+            if pending:
+                await asyncio.wait(pending)
+        else:
+            await asyncio.gather(*(worker(client, deadline) for client in clients))
+        elapsed = time.perf_counter() - started
+
+    latencies = [latency for entry in samples.values() for latency in entry["latencies"]]
+    errors = sum(entry["errors"] for entry in samples.values())
+    histogram = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+    for latency in latencies:
+        histogram[next((i for i, bound in enumerate(LATENCY_BUCKETS_MS) if latency * 1000 <= bound), len(LATENCY_BUCKETS_MS))] += 1
+    return {
+        "elapsed_seconds": round(elapsed, 2),
+        "concurrency": concurrency,
+        "rate": rate,
+        "calls": len(latencies),
+        "errors": errors,
+        "error_rate": round(errors / len(latencies), 4) if latencies else 0,
+        "throughput": round(len(latencies) / elapsed, 2) if elapsed else 0,
+        **_latency_summary(latencies),
+        "histogram": {f"<={bound}ms": count for bound, count in zip(LATENCY_BUCKETS_MS, histogram)} | {"+Inf": histogram[-1]},
+        "tools": {
+            tool: {
+                "calls": len(entry["latencies"]),
+                "errors": entry["errors"],
+                "throughput": round(len(entry["latencies"]) / elapsed, 2) if elapsed else 0,
+                **_latency_summary(entry["latencies"]),
+            }
+            for tool, entry in sorted(samples.items())
+        },
+    }
+
+
+def print_bench_report(report):
+    """Print a bench report as a summary line, a latency histogram and a per-tool table."""
+    mode = f"{report['rate']} calls/s target" if report["rate"] else "closed loop"
+    print(f"{report['calls']} calls in {report['elapsed_seconds']}s over {report['concurrency']} sessions ({mode}): "
+          f"{report['throughput']} calls/s, {report['errors']} errors ({report['error_rate']:.1%})")
+    print(f"Latency: p50 {report['p50_ms']} ms, p95 {report['p95_ms']} ms, p99 {report['p99_ms']} ms")
+    buckets = list(report["histogram"].items())
+    filled = [i for i, (_, count) in enumerate(buckets) if count]
+    peak = max((count for _, count in buckets), default=0) or 1
+    # Only the range that has samples, so the histogram stays readable.
+    for bucket, count in buckets[filled[0]:filled[-1] + 1] if filled else []:
+        print(f"  {bucket:>9} {'#' * round(40 * count / peak):<40} {count}")
+    print(f"{'tool':<20}{'calls':>8}{'errors':>8}{'calls/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for tool, row in report["tools"].items():
+        print(f"{tool:<20}{row['calls']:>8}{row['errors']:>8}{row['throughput']:>10}{row['p50_ms']:>10}{row['p95_ms']:>10}{row['p99_ms']:>10}")
+
+
+async def bench(server_url, workload_file, concurrency=4, rate=None, duration=None, requests=None, warmup=0, json_path=None):
+    """Replay a workload file against the server and print latency, error rate and throughput."""
+    workload = load_workload(workload_file)
+    if not workload:
+        print(f"No calls in {workload_file}")
+        return
+    if warmup:
+        await run_bench(server_url, itertools.islice(itertools.cycle(workload), warmup), concurrency)
+    if duration is not None or requests is not None:
+        calls = itertools.islice(itertools.cycle(workload), requests)
+    else:
+        calls = workload
+    report = await run_bench(server_url, calls, concurrency, rate, duration)
+    print_bench_report(report)
+    if json_path:
+        with open(json_path, "w") as file:
+            json.dump(report, file, indent=2)
+
+
 def parse_args():
     """Parse command-line arguments."""
     if len(sys.argv) < 2:
@@ -70,6 +251,18 @@ def parse_args():
                 params[key] = value
             i += 2
         return command, {"tool_name": tool_name, "params": params}
+    elif command == "bench":
+        if len(sys.argv) < 3:
+            print("Usage: python clients.py bench <workload_file> [option value ...]")
+            sys.exit(1)
+        options = {}
+        for key, value in zip(sys.argv[3::2], sys.argv[4::2]):
+            if key not in BENCH_OPTIONS:
+                print(f"Unknown bench option: {key}")
+                sys.exit(1)
+            name, convert = BENCH_OPTIONS[key]
+            options[name] = convert(value)
+        return command, {"workload_file": sys.argv[2], "options": options}
     else:
         print(f"Unknown command: {command}")
         print(__doc__)
@@ -85,6 +278,8 @@ async def main():
         await list_tools(server_url)
     elif command == "call-tool":
         await call_tool(server_url, args["tool_name"], **args["params"])
+    elif command == "bench":
+        await bench(server_url, args["workload_file"], **args["options"])
 
 
 if __name__ == "__main__":
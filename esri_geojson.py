@@ -0,0 +1,195 @@
+"""
+Esri JSON to GeoJSON geometry conversion.
+
+`features_to_geojson` converts a whole batch of features at once. The
+vertices of every polygon ring in the batch are packed into one NumPy
+coordinate buffer with per-ring offsets, so signed areas and bounding boxes
+for all rings take a few array operations instead of a Python loop per
+vertex. Coordinates that must change (rounding to `precision`, dropping M
+values) are likewise rewritten in one pass over a buffer of every vertex;
+all other coordinate lists are reused from the input as they are.
+
+Points become Point, multipoints MultiPoint, polylines LineString or (with
+more than one path) MultiLineString, and polygons Polygon or MultiPolygon.
+Esri polygons are a flat list of rings, outer rings clockwise and holes
+counter-clockwise; each hole is assigned to the smallest outer ring that
+contains it, a "hole" contained by no outer ring becomes a polygon of its
+own, and rings are reversed where needed so output follows the RFC 7946
+right-hand rule (exteriors counter-clockwise, holes clockwise). Envelopes
+become rectangular Polygons.
+"""
+
+import itertools
+from typing import Optional
+
+import numpy as np
+
+import geometry
+
+
+def _parts(esri_geometry: Optional[dict], has_z: bool) -> tuple:
+    """Returns (kind, list of vertex lists) for one Esri geometry, or (None, []) if it is empty."""
+    if not esri_geometry:
+        return None, []
+    if "x" in esri_geometry:
+        x, y = esri_geometry.get("x"), esri_geometry.get("y")
+        if x is None or y is None or x == "NaN" or y == "NaN":
+            return None, []
+        vertex = [x, y, esri_geometry["z"]] if has_z and esri_geometry.get("z") is not None else [x, y]
+        return "Point", [[vertex]]
+    if "rings" in esri_geometry:
+        kind, parts = "Polygon", esri_geometry["rings"]
+    elif "paths" in esri_geometry:
+        kind, parts = "LineString", esri_geometry["paths"]
+    elif "points" in esri_geometry:
+        kind, parts = "MultiPoint", [esri_geometry["points"]]
+    elif "xmin" in esri_geometry:
+        xmin, ymin, xmax, ymax = (esri_geometry.get(key) for key in ("xmin", "ymin", "xmax", "ymax"))
+        if None in (xmin, ymin, xmax, ymax) or "NaN" in (xmin, ymin, xmax, ymax):
+            return None, []
+        # Clockwise, like an Esri outer ring.
+        return "Polygon", [[[xmin, ymin], [xmin, ymax], [xmax, ymax], [xmax, ymin], [xmin, ymin]]]
+    else:
+        return None, []
+    parts = [part for part in parts if part]
+    return (kind, parts) if parts else (None, [])
+
+
+def _coordinate_buffer(vertices: list, dims: int) -> np.ndarray:
+    """Packs vertex lists into a (vertices, dims) float array; vertices of mixed dimensions keep only x and y."""
+    width = len(vertices[0])
+    # A matching total alone is not enough: 2D and 4D vertices can add up to the same count as 3D ones.
+    if all(len(vertex) == width for vertex in vertices):
+        flat = np.fromiter(itertools.chain.from_iterable(vertices), dtype=float, count=width * len(vertices))
+        return flat.reshape(-1, width)[:, :dims]
+    return np.array([vertex[:2] for vertex in vertices], dtype=float)
+
+
+def _nest_rings(rings: range, areas: np.ndarray, bounds: np.ndarray, xy: np.ndarray, starts: np.ndarray, ends: np.ndarray) -> list:
+    """
+    Groups one polygon's rings (indices into the ring arrays) into [exterior, hole, ...] lists.
+
+    Exteriors are the clockwise rings. Each hole goes to the smallest exterior
+    containing its first vertex; a hole that no exterior contains is kept as
+    an exterior of its own.
+    """
+    rings = np.asarray(rings)
+    exteriors = rings[areas[rings] <= 0]
+    holes = rings[areas[rings] > 0]
+    if not len(holes):
+        return [[ring] for ring in exteriors.tolist()]
+    if len(exteriors) == 1:
+        return [[int(exteriors[0]), *holes.tolist()]]
+
+    owner = np.full(len(holes), -1)
+    hole_x, hole_y = xy[starts[holes], 0], xy[starts[holes], 1]
+    # Exteriors have negative areas, so this visits the smallest first and a hole's first owner is its tightest.
+    for exterior in exteriors[np.argsort(-areas[exteriors], kind="stable")].tolist():
+        xmin, ymin, xmax, ymax = bounds[exterior]
+        candidates = np.flatnonzero((owner < 0) & (hole_x >= xmin) & (hole_x <= xmax) & (hole_y >= ymin) & (hole_y <= ymax))
+        if len(candidates):
+            inside = geometry.points_in_polygon(hole_x[candidates], hole_y[candidates], {"rings": [xy[starts[exterior]:ends[exterior]]]})
+            owner[candidates[inside]] = exterior
+    groups = {exterior: [exterior] for exterior in exteriors.tolist()}
+    for hole, exterior in zip(holes.tolist(), owner.tolist()):
+        if exterior < 0:
+            groups[hole] = [hole]
+        else:
+            groups[exterior].append(hole)
+    # Input order of the exteriors (and of orphaned holes, where they appeared).
+    return [groups[ring] for ring in sorted(groups)]
+
+
+def _ring_arrays(rings: list) -> tuple:
+    """Signed areas, bounding boxes, x/y buffer and offsets of all rings, computed over one buffer."""
+    lengths = np.fromiter(map(len, rings), dtype=np.int64, count=len(rings))
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+    xy = _coordinate_buffer(list(itertools.chain.from_iterable(rings)), 2)
+    x, y = xy[:, 0], xy[:, 1]
+    # Shoelace terms, each vertex paired with the next one in its own ring.
+    following = np.arange(1, len(xy) + 1)
+    following[ends - 1] = starts
+    areas = np.add.reduceat(x * y[following] - x[following] * y, starts) / 2
+    bounds = np.column_stack([
+        np.minimum.reduceat(x, starts), np.minimum.reduceat(y, starts),
+        np.maximum.reduceat(x, starts), np.maximum.reduceat(y, starts),
+    ])
+    return areas, bounds, xy, starts, ends
+
+
+def features_to_geojson(features: list, has_z: bool = False, precision: Optional[int] = None) -> list:
+    """
+    Converts Esri JSON features to GeoJSON features in one batch, skipping those without geometry.
+
+    Coordinates are only copied when they change (rounding, dropping M values);
+    otherwise the output shares the input's coordinate lists.
+
+    :param features: Esri JSON features, as in a query response's "features".
+    :param has_z: Whether the response has Z values (its "hasZ"); they are kept as a third coordinate. M values are dropped.
+    :param precision: Number of decimals to round coordinates to. Default keeps full precision.
+    """
+    kinds, part_counts, parts = [], [], []
+    for feature in features:
+        kind, feature_parts = _parts(feature.get("geometry"), has_z)
+        kinds.append(kind)
+        part_counts.append(len(feature_parts))
+        parts.extend(feature_parts)
+    if not parts:
+        return []
+
+    rings = [part for kind, count, part in zip(kinds, part_counts, _split(parts, part_counts)) if kind == "Polygon" for part in part]
+    if rings:
+        areas, bounds, xy, ring_starts, ring_ends = _ring_arrays(rings)
+
+    dims = 3 if has_z else 2
+    if precision is not None or any(len(vertex) != dims for part in parts for vertex in part):
+        # One pass over every vertex: trim to x, y (and z), round, and split back into parts.
+        buffer = _coordinate_buffer(list(itertools.chain.from_iterable(parts)), dims)
+        if precision is not None:
+            buffer = np.round(buffer, precision)
+        flat = buffer.tolist()
+        ends = itertools.accumulate(map(len, parts))
+        parts = [flat[end - len(part):end] for part, end in zip(parts, ends)]
+
+    result = []
+    first_part = first_ring = 0
+    for feature, kind, count in zip(features, kinds, part_counts):
+        if kind is None:
+            continue
+        feature_parts = parts[first_part:first_part + count]
+        if kind == "Point":
+            geojson_geometry = {"type": "Point", "coordinates": feature_parts[0][0]}
+        elif kind == "MultiPoint":
+            geojson_geometry = {"type": "MultiPoint", "coordinates": feature_parts[0]}
+        elif kind == "LineString":
+            geojson_geometry = {"type": "LineString", "coordinates": feature_parts[0]} if count == 1 else {"type": "MultiLineString", "coordinates": feature_parts}
+        else:
+            if count == 1:
+                groups = [[first_ring]]
+            else:
+                groups = _nest_rings(range(first_ring, first_ring + count), areas, bounds, xy, ring_starts, ring_ends)
+            # Right-hand rule: exteriors counter-clockwise (positive area), holes clockwise.
+            shapes = [[
+                feature_parts[ring - first_ring][::-1] if (areas[ring] < 0) == (position == 0) else feature_parts[ring - first_ring]
+                for position, ring in enumerate(group)
+            ] for group in groups]
+            geojson_geometry = {"type": "Polygon", "coordinates": shapes[0]} if len(shapes) == 1 else {"type": "MultiPolygon", "coordinates": shapes}
+            first_ring += count
+        result.append({"type": "Feature", "geometry": geojson_geometry, "properties": feature.get("attributes", {})})
+        first_part += count
+    return result
+
+
+def _split(parts: list, counts: list):
+    """Yields each feature's slice of the flat part list."""
+    first = 0
+    for count in counts:
+        yield parts[first:first + count]
+        first += count
+
+
+def geometry_to_geojson(esri_geometry: dict, has_z: bool = False, precision: Optional[int] = None) -> Optional[dict]:
+    """Converts a single Esri JSON geometry to a GeoJSON geometry, or None if it is empty."""
+    features = features_to_geojson([{"geometry": esri_geometry}], has_z, precision)
+    return features[0]["geometry"] if features else None
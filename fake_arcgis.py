@@ -0,0 +1,805 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the ArcGIS FeatureServer layers in main.LAYER_MAPPING.
+
+Serves layer metadata and /query for every layer name at
+http://host:port/<layer>/FeatureServer/0, from synthetic data (points,
+many-vertex polygons and polylines, generated deterministically from --seed)
+and from recorded GeoJSON: query_output.json and geojson.json seed
+usgs-gauges by default. Supported query features: where clauses of
+comparisons, IN, LIKE and timestamp literals joined by AND/OR, objectIds,
+envelope and polygon spatial filters, outFields, orderByFields,
+resultOffset/resultRecordCount paging (usgs-gauges reports no pagination
+support, like the real MapServer layer), returnCountOnly, returnIdsOnly,
+outStatistics with groupByFieldsForStatistics, and geometryPrecision.
+Layers with pagination also list PBF in supportedQueryFormats and answer
+f=pbf with an esriPBuffer FeatureCollection, quantized with the request's
+quantizationParameters (or a fine upper-left grid) and delta-encoded like
+the real server's; --no-pbf makes every layer JSON-only. Metadata responses
+carry an ETag and answer If-None-Match with 304.
+
+Latency and failures can be injected with --latency / --jitter /
+--error-rate (503) / --throttle-rate (429 with Retry-After), or changed at
+runtime by POSTing the same keys as JSON to /admin/faults, optionally with
+"layer" to target one layer.
+
+Usage:
+    python fake_arcgis.py --port 8090 --latency 0.02 --jitter 0.01
+    ESRI_MCP_LAYER_BASE_URL=http://127.0.0.1:8090 python main.py --http
+"""
+
+import argparse
+import asyncio
+import fnmatch
+import json
+import math
+import random
+import re
+import statistics
+import struct
+from datetime import datetime, timezone
+from typing import Optional
+from urllib.parse import parse_qsl
+
+import numpy as np
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response
+
+import geometry
+import pbf
+
+POINT_LAYERS = [
+    "usgs-gauges", "water-quality", "sample-points",
+    "weather-stations", "raws-stations", "seismic-stations", "cors-stations", "storm-reports",
+]
+POLYGON_LAYERS = ["states", "counties", "watersheds", "impaired-waters"]
+POLYLINE_LAYERS = ["rivers"]
+DAM_LAYERS = ["dams"]
+NO_PAGINATION_LAYERS = ["usgs-gauges", "sample-points"]
+RECORDED_SEEDS = {"usgs-gauges": ["query_output.json", "geojson.json"]}
+
+STATES = [
+    ("AL", "Alabama"), ("AZ", "Arizona"), ("CA", "California"), ("CO", "Colorado"), ("FL", "Florida"),
+    ("GA", "Georgia"), ("IL", "Illinois"), ("MI", "Michigan"), ("MN", "Minnesota"), ("NY", "New York"),
+    ("OH", "Ohio"), ("OR", "Oregon"), ("PA", "Pennsylvania"), ("TX", "Texas"), ("VA", "Virginia"), ("WA", "Washington"),
+]
+STATE_FIPS = {
+    "AL": "01", "AZ": "04", "CA": "06", "CO": "08", "FL": "12", "GA": "13", "IL": "17", "MI": "26",
+    "MN": "27", "NY": "36", "OH": "39", "OR": "41", "PA": "42", "TX": "48", "VA": "51", "WA": "53",
+}
+CATEGORIES = ["A", "B", "C", "D"]
+EVENT_TYPES = ["HAIL", "WIND", "TORNADO"]
+# Continental US, where the synthetic features are placed.
+EXTENT = {"xmin": -125.0, "ymin": 25.0, "xmax": -67.0, "ymax": 49.0, "spatialReference": {"wkid": 4326, "latestWkid": 4326}}
+MAX_RECORD_COUNT = 2000
+EDIT_DATE_FIELD = "EditDate"
+# Synthetic edits fall in the 30 days before 2026-01-01, so datasets are identical across runs.
+LAST_EDIT_DATE = 1767225600000
+
+_TOKEN = re.compile(r"\s*(?:(?P<string>'(?:[^']|'')*')|(?P<number>-?\d+(?:\.\d+)?)|(?P<op><>|!=|<=|>=|=|<|>|\(|\)|,)|(?P<word>[A-Za-z_][A-Za-z0-9_]*))")
+_KEYWORDS = ("AND", "OR", "IN", "NOT", "LIKE", "IS", "NULL", "TIMESTAMP", "DATE")
+
+
+class QueryError(ValueError):
+    pass
+
+
+def _field(name: str, field_type: str) -> dict:
+    return {"name": name, "type": field_type, "alias": name}
+
+
+class Layer:
+    def __init__(self, name: str, geometry_type: str, fields: list, features: list, supports_pagination: bool = True):
+        self.name = name
+        self.geometry_type = geometry_type
+        self.fields = fields
+        self.features = features
+        self.supports_pagination = supports_pagination
+        # Like the real MapServer layers, those without pagination only answer f=json.
+        self.supports_pbf = supports_pagination
+        self.field_names = {field["name"].lower(): field["name"] for field in fields}
+        self.boxes = np.array([_bbox(feature.get("geometry")) for feature in features], dtype=float).reshape(-1, 4)
+        edit_dates = [feature["attributes"].get(EDIT_DATE_FIELD) or 0 for feature in features]
+        self.last_edit = max(edit_dates, default=0)
+        self.faults = {}
+
+    def info(self) -> dict:
+        return {
+            "currentVersion": 11.1,
+            "name": self.name,
+            "type": "Feature Layer",
+            "geometryType": self.geometry_type,
+            "objectIdField": "OBJECTID",
+            "displayField": "NAME",
+            "fields": self.fields,
+            "maxRecordCount": MAX_RECORD_COUNT,
+            "capabilities": "Query",
+            "supportedQueryFormats": "JSON, PBF" if self.supports_pbf else "JSON",
+            "advancedQueryCapabilities": {
+                "supportsPagination": self.supports_pagination,
+                "supportsStatistics": True,
+                "supportsOrderBy": True,
+                "supportsHavingClause": False,
+            },
+            "extent": EXTENT,
+            "editingInfo": {"lastEditDate": self.last_edit},
+            "editFieldsInfo": {"editDateField": EDIT_DATE_FIELD},
+        }
+
+    def column(self, name: str) -> str:
+        if name.lower() not in self.field_names:
+            raise QueryError(f"Invalid field: {name}")
+        return self.field_names[name.lower()]
+
+
+def _bbox(esri_geometry) -> tuple:
+    if not esri_geometry:
+        return (math.nan,) * 4
+    if "x" in esri_geometry:
+        return esri_geometry["x"], esri_geometry["y"], esri_geometry["x"], esri_geometry["y"]
+    points = np.array([point[:2] for part in esri_geometry.get("rings") or esri_geometry.get("paths") for point in part], dtype=float)
+    return points[:, 0].min(), points[:, 1].min(), points[:, 0].max(), points[:, 1].max()
+
+
+def _edit_date(rng: random.Random) -> int:
+    return LAST_EDIT_DATE - int(rng.uniform(0, 30 * 86400) * 1000)
+
+
+def _common_attributes(rng: random.Random, object_id: int, layer_name: str) -> dict:
+    abbreviation, name = rng.choice(STATES)
+    return {
+        "OBJECTID": object_id,
+        "NAME": f"{layer_name} {object_id}",
+        "STATE": abbreviation,
+        "STATE_NAME": name,
+        "CATEGORY": rng.choice(CATEGORIES),
+        "VALUE": round(rng.uniform(0, 1000), 3),
+        EDIT_DATE_FIELD: _edit_date(rng),
+    }
+
+
+COMMON_FIELDS = [
+    _field("OBJECTID", "esriFieldTypeOID"), _field("NAME", "esriFieldTypeString"), _field("STATE", "esriFieldTypeString"),
+    _field("STATE_NAME", "esriFieldTypeString"), _field("CATEGORY", "esriFieldTypeString"),
+    _field("VALUE", "esriFieldTypeDouble"), _field(EDIT_DATE_FIELD, "esriFieldTypeDate"),
+]
+
+
+def _ring(rng: random.Random, center_x: float, center_y: float, radius: float, vertices: int) -> list:
+    # Clockwise, like Esri outer rings, with a jagged outline so simplification has work to do.
+    ring = []
+    for index in range(vertices):
+        angle = -2 * math.pi * index / vertices
+        distance = radius * rng.uniform(0.85, 1.0)
+        ring.append([round(center_x + distance * math.cos(angle), 6), round(center_y + distance * math.sin(angle), 6)])
+    ring.append(list(ring[0]))
+    return ring
+
+
+def synthetic_layer(name: str, rng: random.Random, points: int, shapes: int, vertices: int) -> Layer:
+    fields = list(COMMON_FIELDS)
+    features = []
+    if name in POINT_LAYERS or name in DAM_LAYERS:
+        if name == "storm-reports":
+            fields.append(_field("EVENT_TYPE", "esriFieldTypeString"))
+        if name in DAM_LAYERS:
+            fields.append(_field("NID_HEIGHT", "esriFieldTypeDouble"))
+        for object_id in range(1, points + 1):
+            attributes = _common_attributes(rng, object_id, name)
+            if name == "storm-reports":
+                attributes["EVENT_TYPE"] = rng.choice(EVENT_TYPES)
+            if name in DAM_LAYERS:
+                attributes["NID_HEIGHT"] = round(rng.uniform(5, 300), 1)
+            point = {"x": round(rng.uniform(EXTENT["xmin"], EXTENT["xmax"]), 6), "y": round(rng.uniform(EXTENT["ymin"], EXTENT["ymax"]), 6)}
+            features.append({"attributes": attributes, "geometry": point})
+        return Layer(name, "esriGeometryPoint", fields, features, name not in NO_PAGINATION_LAYERS)
+
+    # The fields gazetteer.refresh reads, so the boundary gazetteer can be built offline.
+    if name == "states":
+        fields += [_field("STATE_ABBR", "esriFieldTypeString"), _field("STATE_FIPS", "esriFieldTypeString")]
+    elif name == "counties":
+        fields += [_field("STATEFP", "esriFieldTypeString"), _field("COUNTYFP", "esriFieldTypeString")]
+    count = len(STATES) if name == "states" else shapes
+    for object_id in range(1, count + 1):
+        attributes = _common_attributes(rng, object_id, name)
+        if name == "states":
+            attributes["STATE"], attributes["STATE_NAME"] = STATES[object_id - 1]
+            attributes["STATE_ABBR"], attributes["STATE_FIPS"] = attributes["STATE"], STATE_FIPS[attributes["STATE"]]
+        elif name == "counties":
+            attributes["STATEFP"], attributes["COUNTYFP"] = STATE_FIPS[attributes["STATE"]], f"{object_id:03d}"
+        center_x = rng.uniform(EXTENT["xmin"] + 2, EXTENT["xmax"] - 2)
+        center_y = rng.uniform(EXTENT["ymin"] + 2, EXTENT["ymax"] - 2)
+        radius = 3.0 if name == "states" else rng.uniform(0.1, 1.0)
+        if name in POLYLINE_LAYERS:
+            path = []
+            for index in range(vertices):
+                step = index / max(1, vertices - 1)
+                path.append([round(center_x - radius + 2 * radius * step, 6), round(center_y + 0.2 * radius * math.sin(12 * step) + rng.uniform(-0.01, 0.01), 6)])
+            features.append({"attributes": attributes, "geometry": {"paths": [path]}})
+        else:
+            features.append({"attributes": attributes, "geometry": {"rings": [_ring(rng, center_x, center_y, radius, vertices)]}})
+    geometry_type = "esriGeometryPolyline" if name in POLYLINE_LAYERS else "esriGeometryPolygon"
+    return Layer(name, geometry_type, fields, features, name not in NO_PAGINATION_LAYERS)
+
+
+def _read_geojson(path: str) -> dict:
+    """Reads a GeoJSON file, or a saved `clients.py call-tool` output whose result is a GeoJSON string."""
+    with open(path) as file:
+        text = file.read()
+    data = json.loads(text[text.index("{"):])
+    if isinstance(data.get("result"), str):
+        data = json.loads(data["result"])
+    return data
+
+
+def _esri_geometry(geojson_geometry: dict):
+    if not geojson_geometry:
+        return None
+    kind = geojson_geometry["type"]
+    coordinates = geojson_geometry["coordinates"]
+    if kind == "Point":
+        return {"x": coordinates[0], "y": coordinates[1]}
+    if kind == "LineString":
+        return {"paths": [coordinates]}
+    if kind == "MultiLineString":
+        return {"paths": coordinates}
+    if kind == "Polygon":
+        return {"rings": coordinates}
+    if kind == "MultiPolygon":
+        return {"rings": [ring for polygon in coordinates for ring in polygon]}
+    raise ValueError(f"Unsupported GeoJSON geometry: {kind}")
+
+
+def _field_type(values: list) -> str:
+    present = [value for value in values if value is not None]
+    if present and all(isinstance(value, bool) or isinstance(value, int) for value in present):
+        return "esriFieldTypeInteger"
+    if present and all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in present):
+        return "esriFieldTypeDouble"
+    return "esriFieldTypeString"
+
+
+def recorded_layer(name: str, paths: list) -> Layer:
+    """Builds a layer from recorded GeoJSON features, deduplicated by object ID."""
+    by_id = {}
+    for path in paths:
+        for feature in _read_geojson(path).get("features", []):
+            properties = dict(feature.get("properties") or {})
+            object_id = properties.pop("objectid", properties.pop("OBJECTID", None)) or len(by_id) + 1
+            properties["OBJECTID"] = object_id
+            by_id[object_id] = {"attributes": properties, "geometry": _esri_geometry(feature.get("geometry"))}
+    features = [by_id[object_id] for object_id in sorted(by_id)]
+    names = []
+    for feature in features:
+        names.extend(key for key in feature["attributes"] if key not in names)
+    fields = [_field("OBJECTID", "esriFieldTypeOID")] + [
+        _field(field_name, _field_type([feature["attributes"].get(field_name) for feature in features]))
+        for field_name in names if field_name != "OBJECTID"
+    ]
+    geometry_types = {"x": "esriGeometryPoint", "paths": "esriGeometryPolyline", "rings": "esriGeometryPolygon"}
+    first = next((feature["geometry"] for feature in features if feature["geometry"]), {"x": 0})
+    geometry_type = next(value for key, value in geometry_types.items() if key in first)
+    return Layer(name, geometry_type, fields, features, name not in NO_PAGINATION_LAYERS)
+
+
+# --- where clauses ---------------------------------------------------------------------------------------------------
+
+def _tokenize(where: str) -> list:
+    tokens = []
+    position = 0
+    where = where.strip()
+    while position < len(where):
+        match = _TOKEN.match(where, position)
+        if not match or match.end() == position:
+            raise QueryError(f"Unable to parse where clause: {where}")
+        kind = match.lastgroup
+        text = match.group(kind)
+        if kind == "string":
+            tokens.append(("value", text[1:-1].replace("''", "'")))
+        elif kind == "number":
+            tokens.append(("value", float(text)))
+        elif kind == "word" and text.upper() in _KEYWORDS:
+            tokens.append(("keyword", text.upper()))
+        else:
+            tokens.append((kind, text))
+        position = match.end()
+    return tokens
+
+
+def _timestamp_value(text: str) -> int:
+    parsed = datetime.strptime(text, "%Y-%m-%d %H:%M:%S" if " " in text else "%Y-%m-%d").replace(tzinfo=timezone.utc)
+    return int(parsed.timestamp() * 1000)
+
+
+def _like(pattern: str) -> re.Pattern:
+    return re.compile(fnmatch.translate(pattern.replace("*", "[*]").replace("?", "[?]").replace("%", "*").replace("_", "?")), re.IGNORECASE)
+
+
+def _compare(left, operator: str, right) -> bool:
+    if left is None:
+        return False
+    if isinstance(right, float) and isinstance(left, str):
+        try:
+            left = float(left)
+        except ValueError:
+            return False
+    if operator == "=":
+        return left == right
+    if operator in ("<>", "!="):
+        return left != right
+    try:
+        if operator == "<":
+            return left < right
+        if operator == ">":
+            return left > right
+        if operator == "<=":
+            return left <= right
+        return left >= right
+    except TypeError:
+        return False
+
+
+def compile_where(layer: Layer, where: str):
+    """Compiles a where clause into a predicate over attribute dicts; OR binds looser than AND."""
+    tokens = _tokenize(where or "1=1")
+    position = 0
+
+    def peek():
+        return tokens[position] if position < len(tokens) else (None, None)
+
+    def take():
+        nonlocal position
+        token = peek()
+        position += 1
+        return token
+
+    def value():
+        kind, text = take()
+        if kind == "keyword" and text in ("TIMESTAMP", "DATE"):
+            kind, text = take()
+            return _timestamp_value(text)
+        if kind != "value":
+            raise QueryError(f"Expected a value in where clause: {where}")
+        return text
+
+    def comparison():
+        kind, text = peek()
+        if (kind, text) == ("op", "("):
+            take()
+            predicate = disjunction()
+            if take() != ("op", ")"):
+                raise QueryError(f"Unbalanced parentheses in where clause: {where}")
+            return predicate
+        if kind == "keyword" and text == "NOT":
+            take()
+            inner = comparison()
+            return lambda attributes: not inner(attributes)
+        if kind == "value":
+            left = value()
+            operator = take()[1]
+            right = value()
+            return lambda attributes: _compare(left, operator, right)
+        if kind != "word":
+            raise QueryError(f"Unable to parse where clause: {where}")
+        take()
+        column = layer.column(text)
+        kind, operator = take()
+        negate = False
+        if (kind, operator) == ("keyword", "NOT"):
+            negate = True
+            kind, operator = take()
+        if kind == "op" and operator in ("=", "<>", "!=", "<", ">", "<=", ">="):
+            right = value()
+            return lambda attributes: _compare(attributes.get(column), operator, right)
+        if (kind, operator) == ("keyword", "LIKE"):
+            pattern = _like(str(value()))
+            return lambda attributes: (attributes.get(column) is not None and bool(pattern.match(str(attributes[column])))) != negate
+        if (kind, operator) == ("keyword", "IN"):
+            if take() != ("op", "("):
+                raise QueryError(f"Expected ( after IN: {where}")
+            options = [value()]
+            while take() == ("op", ","):
+                options.append(value())
+            return lambda attributes: any(_compare(attributes.get(column), "=", option) for option in options) != negate
+        if (kind, operator) == ("keyword", "IS"):
+            is_not = peek() == ("keyword", "NOT")
+            if is_not:
+                take()
+            if take() != ("keyword", "NULL"):
+                raise QueryError(f"Expected NULL: {where}")
+            return lambda attributes: (attributes.get(column) is None) != is_not
+        raise QueryError(f"Unsupported operator {operator} in where clause: {where}")
+
+    def conjunction():
+        predicates = [comparison()]
+        while peek() == ("keyword", "AND"):
+            take()
+            predicates.append(comparison())
+        return predicates[0] if len(predicates) == 1 else (lambda attributes: all(predicate(attributes) for predicate in predicates))
+
+    def disjunction():
+        predicates = [conjunction()]
+        while peek() == ("keyword", "OR"):
+            take()
+            predicates.append(conjunction())
+        return predicates[0] if len(predicates) == 1 else (lambda attributes: any(predicate(attributes) for predicate in predicates))
+
+    predicate = disjunction()
+    if position != len(tokens):
+        raise QueryError(f"Unable to parse where clause: {where}")
+    return predicate
+
+
+# --- queries ---------------------------------------------------------------------------------------------------------
+
+def _spatial_filter(layer: Layer, params: dict):
+    """Indices of features passing the geometry filter, or None without one."""
+    raw = params.get("geometry")
+    if not raw:
+        return None
+    if raw.lstrip().startswith("{"):
+        shape = json.loads(raw)
+    else:
+        xmin, ymin, xmax, ymax = (float(value) for value in raw.split(","))
+        shape = {"xmin": xmin, "ymin": ymin, "xmax": xmax, "ymax": ymax}
+    envelope = geometry.polygon_envelope(shape) if "rings" in shape else shape
+    boxes = layer.boxes
+    hits = np.flatnonzero(
+        (boxes[:, 0] <= envelope["xmax"]) & (boxes[:, 2] >= envelope["xmin"])
+        & (boxes[:, 1] <= envelope["ymax"]) & (boxes[:, 3] >= envelope["ymin"])
+    )
+    if "rings" in shape and layer.geometry_type == "esriGeometryPoint" and len(hits):
+        # Exact for points; other geometries are matched by bounding box.
+        hits = hits[geometry.points_in_polygon(boxes[hits, 0], boxes[hits, 1], shape)]
+    return hits
+
+
+def _round_geometry(esri_geometry: dict, decimals: int) -> dict:
+    if "x" in esri_geometry:
+        return {"x": round(esri_geometry["x"], decimals), "y": round(esri_geometry["y"], decimals)}
+    key = "rings" if "rings" in esri_geometry else "paths"
+    return {key: [[[round(coordinate, decimals) for coordinate in point] for point in part] for part in esri_geometry[key]]}
+
+
+def _statistics(layer: Layer, features: list, params: dict) -> dict:
+    definitions = json.loads(params["outStatistics"])
+    group_fields = [layer.column(name.strip()) for name in params.get("groupByFieldsForStatistics", "").split(",") if name.strip()]
+    groups = {}
+    for feature in features:
+        key = tuple(feature["attributes"].get(name) for name in group_fields)
+        groups.setdefault(key, []).append(feature["attributes"])
+    if not group_fields and not groups:
+        groups[()] = []
+    rows = []
+    for key, members in groups.items():
+        attributes = dict(zip(group_fields, key))
+        for definition in definitions:
+            column = layer.column(definition["onStatisticField"])
+            values = [member[column] for member in members if member.get(column) is not None]
+            kind = definition["statisticType"].lower()
+            if kind == "count":
+                result = len(values)
+            elif not values:
+                result = None
+            elif kind == "sum":
+                result = sum(values)
+            elif kind == "min":
+                result = min(values)
+            elif kind == "max":
+                result = max(values)
+            elif kind == "avg":
+                result = statistics.fmean(values)
+            elif kind == "stddev":
+                result = statistics.stdev(values) if len(values) > 1 else 0.0
+            else:
+                raise QueryError(f"Unsupported statistic type: {kind}")
+            attributes[definition.get("outStatisticFieldName") or f"{kind}_{column}"] = result
+        rows.append({"attributes": attributes})
+    fields = [_field(name, "esriFieldTypeString") for name in group_fields]
+    fields += [_field(definition.get("outStatisticFieldName") or definition["statisticType"], "esriFieldTypeDouble") for definition in definitions]
+    return {"displayFieldName": "", "fields": fields, "features": _order(layer, rows, params, statistics_result=True)}
+
+
+def _order(layer: Layer, features: list, params: dict, statistics_result: bool = False) -> list:
+    order_by = params.get("orderByFields")
+    if not order_by:
+        return features
+    for clause in reversed([part.strip() for part in order_by.split(",") if part.strip()]):
+        name, _, direction = clause.partition(" ")
+        if not statistics_result:
+            name = layer.column(name)
+        features = sorted(
+            features,
+            key=lambda feature: (feature["attributes"].get(name) is None, feature["attributes"].get(name) or 0),
+            reverse=direction.strip().upper() == "DESC",
+        )
+    return features
+
+
+def run_query(layer: Layer, params: dict) -> dict:
+    """Answers a /query request in the f=json response shape."""
+    predicate = compile_where(layer, params.get("where", "1=1"))
+    indices = _spatial_filter(layer, params)
+    candidates = layer.features if indices is None else [layer.features[index] for index in indices.tolist()]
+    if params.get("objectIds"):
+        wanted = {int(value) for value in params["objectIds"].split(",") if value.strip()}
+        candidates = [feature for feature in candidates if feature["attributes"]["OBJECTID"] in wanted]
+    matches = [feature for feature in candidates if predicate(feature["attributes"])]
+
+    if params.get("outStatistics"):
+        return _statistics(layer, matches, params)
+    if params.get("returnCountOnly", "false").lower() == "true":
+        return {"count": len(matches)}
+    if params.get("returnIdsOnly", "false").lower() == "true":
+        return {"objectIdFieldName": "OBJECTID", "objectIds": [feature["attributes"]["OBJECTID"] for feature in matches]}
+
+    matches = _order(layer, matches, params)
+    offset = int(params.get("resultOffset") or 0)
+    if offset and not layer.supports_pagination:
+        raise QueryError("Pagination is not supported.")
+    page_size = min(int(params.get("resultRecordCount") or MAX_RECORD_COUNT), MAX_RECORD_COUNT)
+    page = matches[offset:offset + page_size]
+
+    out_fields = params.get("outFields", "*")
+    names = None if "*" in out_fields else [layer.column(name.strip()) for name in out_fields.split(",") if name.strip()]
+    return_geometry = params.get("returnGeometry", "true").lower() == "true"
+    precision = params.get("geometryPrecision")
+    features = []
+    for feature in page:
+        attributes = feature["attributes"] if names is None else {name: feature["attributes"].get(name) for name in names}
+        result = {"attributes": attributes}
+        if return_geometry and feature.get("geometry"):
+            result["geometry"] = _round_geometry(feature["geometry"], int(precision)) if precision else feature["geometry"]
+        features.append(result)
+    response = {
+        "objectIdFieldName": "OBJECTID",
+        "geometryType": layer.geometry_type,
+        "spatialReference": EXTENT["spatialReference"],
+        "fields": layer.fields if names is None else [field for field in layer.fields if field["name"] in names],
+        "features": features,
+    }
+    if offset + page_size < len(matches):
+        response["exceededTransferLimit"] = True
+    return response
+
+
+# --- pbf -------------------------------------------------------------------------------------------------------------
+
+# Grid used when a pbf request has no quantizationParameters: about 0.1 mm in degrees.
+DEFAULT_QUANTIZATION_SCALE = 1e-9
+
+
+def _pbf_varint(value: int) -> bytes:
+    out = bytearray()
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _pbf_zigzag(value: int) -> int:
+    return value * 2 if value >= 0 else -value * 2 - 1
+
+
+def _pbf_uint(number: int, value: int) -> bytes:
+    return _pbf_varint(number << 3) + _pbf_varint(value)
+
+
+def _pbf_double(number: int, value: float) -> bytes:
+    return _pbf_varint(number << 3 | 1) + struct.pack("<d", value)
+
+
+def _pbf_message(number: int, data: bytes) -> bytes:
+    return _pbf_varint(number << 3 | 2) + _pbf_varint(len(data)) + data
+
+
+def _pbf_value(value, field_type: str) -> bytes:
+    """A Value message; NULL is an empty one."""
+    if value is None:
+        return b""
+    if isinstance(value, bool):
+        return _pbf_uint(9, int(value))
+    if isinstance(value, str):
+        return _pbf_message(1, value.encode())
+    if isinstance(value, float) or field_type in ("esriFieldTypeDouble", "esriFieldTypeSingle"):
+        return _pbf_double(3, float(value))
+    if field_type in ("esriFieldTypeSmallInteger", "esriFieldTypeInteger"):
+        return _pbf_uint(4, _pbf_zigzag(value))
+    if field_type == "esriFieldTypeOID" and value >= 0:
+        return _pbf_uint(5, value)
+    if field_type == "esriFieldTypeDate":
+        return _pbf_uint(6, value & 0xFFFFFFFFFFFFFFFF)
+    return _pbf_uint(8, _pbf_zigzag(value))
+
+
+def _pbf_transform(quantization: dict) -> tuple:
+    """(origin, scale, translate x, translate y) from quantizationParameters, or the default grid."""
+    extent = quantization.get("extent") or EXTENT
+    scale = float(quantization.get("tolerance") or DEFAULT_QUANTIZATION_SCALE)
+    if quantization.get("originPosition") == "lowerLeft":
+        return 1, scale, extent["xmin"], extent["ymin"]
+    return pbf.UPPER_LEFT, scale, extent["xmin"], extent["ymax"]
+
+
+def _pbf_geometry(esri_geometry: dict, transform: tuple) -> bytes:
+    """A Geometry message: part lengths and zigzagged coordinate deltas, which run on across parts."""
+    origin, scale, translate_x, translate_y = transform
+    if "x" in esri_geometry:
+        parts = [[[esri_geometry["x"], esri_geometry["y"]]]]
+    else:
+        parts = esri_geometry.get("rings") or esri_geometry.get("paths") or ([esri_geometry["points"]] if "points" in esri_geometry else [])
+    coordinates = bytearray()
+    previous_x = previous_y = 0
+    for part in parts:
+        for vertex in part:
+            x = round((vertex[0] - translate_x) / scale)
+            y = round((translate_y - vertex[1]) / scale) if origin == pbf.UPPER_LEFT else round((vertex[1] - translate_y) / scale)
+            coordinates += _pbf_varint(_pbf_zigzag(x - previous_x)) + _pbf_varint(_pbf_zigzag(y - previous_y))
+            previous_x, previous_y = x, y
+    message = b""
+    if "x" not in esri_geometry and "points" not in esri_geometry and parts:
+        message += _pbf_message(2, b"".join(_pbf_varint(len(part)) for part in parts))
+    if coordinates:
+        message += _pbf_message(3, bytes(coordinates))
+    return message
+
+
+def encode_pbf(result: dict, quantization: Optional[dict] = None) -> bytes:
+    """Encodes an f=json query result (features, count or IDs) as a FeatureCollectionPBuffer."""
+    if "count" in result:
+        query_result = _pbf_message(2, _pbf_uint(1, result["count"]))
+    elif "objectIds" in result:
+        ids = b"".join(_pbf_varint(object_id) for object_id in result["objectIds"])
+        query_result = _pbf_message(3, _pbf_message(1, result["objectIdFieldName"].encode()) + _pbf_message(3, ids))
+    else:
+        transform = _pbf_transform(quantization or {})
+        origin, scale, translate_x, translate_y = transform
+        geometry_types = {name: number for number, name in pbf.GEOMETRY_TYPES.items()}
+        message = _pbf_message(1, result.get("objectIdFieldName", "OBJECTID").encode())
+        message += _pbf_uint(7, geometry_types.get(result.get("geometryType"), 127))
+        reference = result.get("spatialReference") or {}
+        message += _pbf_message(8, b"".join(_pbf_uint(number, reference[key]) for number, key in ((1, "wkid"), (2, "latestWkid")) if key in reference))
+        if result.get("exceededTransferLimit"):
+            message += _pbf_uint(9, 1)
+        message += _pbf_message(12, _pbf_uint(1, origin) + _pbf_message(2, _pbf_double(1, scale) + _pbf_double(2, scale))
+                                + _pbf_message(3, _pbf_double(1, translate_x) + _pbf_double(2, translate_y)))
+        fields = result.get("fields", [])
+        for field in fields:
+            field_type = pbf.FIELD_TYPES.index(field["type"]) if field["type"] in pbf.FIELD_TYPES else 4
+            message += _pbf_message(13, _pbf_message(1, field["name"].encode()) + _pbf_uint(2, field_type) + _pbf_message(3, field.get("alias", field["name"]).encode()))
+        for feature in result.get("features", []):
+            attributes = feature["attributes"]
+            encoded = b"".join(_pbf_message(1, _pbf_value(attributes.get(field["name"]), field["type"])) for field in fields)
+            if feature.get("geometry") is not None:
+                encoded += _pbf_message(2, _pbf_geometry(feature["geometry"], transform))
+            message += _pbf_message(15, encoded)
+        query_result = _pbf_message(1, message)
+    return _pbf_message(2, query_result)
+
+
+# --- server ----------------------------------------------------------------------------------------------------------
+
+def create_app(layers: dict, faults: dict) -> FastAPI:
+    api = FastAPI(title="Fake ArcGIS FeatureServer")
+    counters = {"requests": 0, "injected_errors": 0, "injected_throttles": 0}
+
+    def layer_faults(name: str) -> dict:
+        return {**faults, **layers[name].faults}
+
+    async def inject(name: str):
+        settings = layer_faults(name)
+        delay = settings.get("latency", 0) + random.uniform(0, settings.get("jitter", 0))
+        if delay > 0:
+            await asyncio.sleep(delay)
+        roll = random.random()
+        if roll < settings.get("error_rate", 0):
+            counters["injected_errors"] += 1
+            return JSONResponse({"error": {"code": 503, "message": "Injected failure"}}, status_code=503)
+        if roll < settings.get("error_rate", 0) + settings.get("throttle_rate", 0):
+            counters["injected_throttles"] += 1
+            return JSONResponse({"error": {"code": 429, "message": "Too many requests"}}, status_code=429, headers={"Retry-After": "1"})
+        return None
+
+    async def params_of(request: Request) -> dict:
+        params = dict(request.query_params)
+        if request.method == "POST":
+            params.update(parse_qsl((await request.body()).decode(), keep_blank_values=True))
+        return params
+
+    @api.api_route("/{layer_name}/FeatureServer/0", methods=["GET", "POST"])
+    async def layer_info(layer_name: str, request: Request):
+        counters["requests"] += 1
+        if layer_name not in layers:
+            return JSONResponse({"error": {"code": 400, "message": f"Invalid layer: {layer_name}"}})
+        failure = await inject(layer_name)
+        if failure is not None:
+            return failure
+        layer = layers[layer_name]
+        etag = f'"{layer_name}-{layer.last_edit}"'
+        if request.headers.get("If-None-Match") == etag:
+            return Response(status_code=304, headers={"ETag": etag})
+        return JSONResponse(layer.info(), headers={"ETag": etag})
+
+    @api.api_route("/{layer_name}/FeatureServer/0/query", methods=["GET", "POST"])
+    async def query(layer_name: str, request: Request):
+        counters["requests"] += 1
+        if layer_name not in layers:
+            return JSONResponse({"error": {"code": 400, "message": f"Invalid layer: {layer_name}"}})
+        failure = await inject(layer_name)
+        if failure is not None:
+            return failure
+        params = await params_of(request)
+        layer = layers[layer_name]
+        output_format = params.get("f", "json")
+        if output_format not in ("json", "pjson") and not (output_format == "pbf" and layer.supports_pbf and not params.get("outStatistics")):
+            return JSONResponse({"error": {"code": 400, "message": f"Unsupported format: {params['f']}"}})
+        try:
+            result = run_query(layer, params)
+            if output_format == "pbf":
+                quantization = json.loads(params["quantizationParameters"]) if params.get("quantizationParameters") else None
+                return Response(encode_pbf(result, quantization), media_type="application/x-protobuf")
+            return JSONResponse(result)
+        except (QueryError, ValueError, KeyError) as e:
+            return JSONResponse({"error": {"code": 400, "message": "Unable to complete operation.", "details": [str(e)]}})
+
+    @api.post("/admin/faults")
+    async def set_faults(request: Request):
+        settings = await request.json()
+        target = settings.pop("layer", None)
+        if target is not None:
+            layers[target].faults.update(settings)
+        else:
+            faults.update(settings)
+        return {"faults": faults, "layers": {name: layer.faults for name, layer in layers.items() if layer.faults}}
+
+    @api.get("/admin/stats")
+    async def stats():
+        return {**counters, "layers": {name: len(layer.features) for name, layer in layers.items()}}
+
+    return api
+
+
+def build_layers(seed: int, points: int, shapes: int, vertices: int, recorded: dict) -> dict:
+    rng = random.Random(seed)
+    layers = {}
+    for name in POINT_LAYERS + DAM_LAYERS + POLYGON_LAYERS + POLYLINE_LAYERS:
+        layers[name] = recorded_layer(name, recorded[name]) if recorded.get(name) else synthetic_layer(name, rng, points, shapes, vertices)
+    return layers
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--points", type=int, default=5000, help="Features per synthetic point layer")
+    parser.add_argument("--shapes", type=int, default=500, help="Features per synthetic polygon/polyline layer")
+    parser.add_argument("--vertices", type=int, default=400, help="Vertices per synthetic polygon ring or polyline")
+    parser.add_argument("--dataset", action="append", default=[], metavar="LAYER=PATH", help="Serve LAYER from a recorded GeoJSON file (repeatable)")
+    parser.add_argument("--no-recorded", action="store_true", help="Use synthetic data for usgs-gauges too")
+    parser.add_argument("--latency", type=float, default=0.0, help="Added seconds per request")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Extra random seconds per request, up to this much")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with 503")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Fraction of requests answered with 429")
+    parser.add_argument("--no-pbf", action="store_true", help="Do not offer f=pbf on any layer")
+    args = parser.parse_args()
+
+    recorded = {} if args.no_recorded else dict(RECORDED_SEEDS)
+    datasets = {}
+    for dataset in args.dataset:
+        name, _, path = dataset.partition("=")
+        datasets.setdefault(name, []).append(path)
+    recorded.update(datasets)
+    layers = build_layers(args.seed, args.points, args.shapes, args.vertices, recorded)
+    if args.no_pbf:
+        for layer in layers.values():
+            layer.supports_pbf = False
+    faults = {"latency": args.latency, "jitter": args.jitter, "error_rate": args.error_rate, "throttle_rate": args.throttle_rate}
+
+    import uvicorn
+    uvicorn.run(create_app(layers, faults), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+"""
+Multi-request fetch strategies for ArcGIS layer queries.
+
+A single /query request returns at most the layer's maxRecordCount features
+and flags the rest with `exceededTransferLimit`. The strategies here fetch
+the full result set by splitting it into requests that run concurrently,
+bounded by ESRI_MCP_MAX_CONCURRENT_PAGES, and merge them into one response:
+
+- "paged": resultOffset/resultRecordCount pages, for layers that support pagination.
+- "objectids": returnIdsOnly first, then batches of objectIds, for layers
+  (typically MapServer endpoints) that do not.
+- "auto": "paged" when the layer supports pagination, otherwise "objectids".
+
+Object ID batches come back in ID order, so queries with orderByFields always
+use "paged"; on layers without pagination they fail with an error instead of
+returning features in the wrong order.
+
+Layers that list PBF in supportedQueryFormats are queried with f=pbf and the
+protocol buffer response is decoded by pbf.decode into the same dict f=json
+returns. Set ESRI_MCP_PBF=0 to always use f=json.
+"""
+
+import asyncio
+import math
+import os
+from typing import Optional
+
+import metadata
+import pbf
+import tracing
+import upstream
+
+MAX_CONCURRENT_PAGES = int(os.environ.get("ESRI_MCP_MAX_CONCURRENT_PAGES", "4"))
+PBF_ENABLED = os.environ.get("ESRI_MCP_PBF", "1") != "0"
+DEFAULT_MAX_RECORD_COUNT = 1000
+
+# Parameters that select features; dropped once the matching IDs are known.
+_FILTER_PARAMS = ("where", "geometry", "geometryType", "spatialRel", "inSR", "resultOffset", "resultRecordCount", "orderByFields")
+# Parameters whose responses are only requested as f=json.
+_JSON_ONLY_PARAMS = ("outStatistics",)
+
+def object_id_field(info: dict) -> str:
+    if info.get("objectIdField"):
+        return info["objectIdField"]
+    for field in info.get("fields", []):
+        if field.get("type") == "esriFieldTypeOID":
+            return field["name"]
+    return "OBJECTID"
+
+
+def supports_pagination(info: dict) -> bool:
+    return bool(info.get("advancedQueryCapabilities", {}).get("supportsPagination"))
+
+
+def supports_pbf(info: dict) -> bool:
+    formats = info.get("supportedQueryFormats") or ""
+    return "pbf" in (value.strip().lower() for value in formats.split(","))
+
+
+def layer_query_url(layer_url: str, info: dict, params: dict) -> str:
+    """Returns the layer's /query URL with f=pbf when the layer supports it, otherwise f=json."""
+    if PBF_ENABLED and supports_pbf(info) and not any(key in params for key in _JSON_ONLY_PARAMS):
+        return f"{layer_url}/query?f=pbf"
+    return f"{layer_url}/query?f=json"
+
+
+async def post_query(query_url: str, params: dict) -> tuple:
+    """POSTs a query and returns (json, response size in bytes); f=pbf responses are decoded to the f=json shape."""
+    if query_url.endswith("f=pbf"):
+        response = await upstream.post(query_url, data=params, headers={"Accept": "application/x-protobuf, application/json"})
+        response.raise_for_status()
+        # Errors are reported as JSON even when pbf was requested.
+        if "json" not in response.headers.get("Content-Type", ""):
+            with tracing.span("decode", format="pbf", bytes=len(response.content)) as decode_span:
+                data = pbf.decode(response.content)
+                if decode_span is not None:
+                    decode_span.set(features=len(data.get("features", [])))
+            return data, len(response.content)
+    else:
+        response = await upstream.post(query_url, data=params, headers={"Accept": "application/json"})
+        response.raise_for_status()
+    with tracing.span("decode", format="json", bytes=len(response.content)) as decode_span:
+        data = response.json()
+        if decode_span is not None:
+            decode_span.set(features=len(data.get("features", [])))
+    return data, len(response.content)
+
+
+def _merge(pages: list, total_bytes: int, max_features: Optional[int] = None) -> dict:
+    merged = {key: value for key, value in pages[0].items() if key not in ("features", "exceededTransferLimit")}
+    merged["features"] = [feature for page in pages for feature in page.get("features", [])][:max_features]
+    merged["pages"] = len(pages)
+    merged["bytes"] = total_bytes
+    return merged
+
+
+async def fetch_paged(layer_url: str, params: dict, max_features: Optional[int] = None, max_concurrency: int = MAX_CONCURRENT_PAGES) -> dict:
+    """
+    Fetches every feature matching `params` using resultOffset/resultRecordCount paging.
+
+    The matching count is requested first so all pages can be issued at once;
+    pages are ordered by the object ID field so offsets are stable. At most
+    `max_features` features are returned when it is given.
+    """
+    info = await metadata.get_layer_info(layer_url)
+    if "error" in info:
+        return info
+    if not supports_pagination(info):
+        return {"error": f"Layer does not support pagination: {layer_url}"}
+
+    page_size = info.get("maxRecordCount") or DEFAULT_MAX_RECORD_COUNT
+    url = layer_query_url(layer_url, info, params)
+    count_data, total_bytes = await post_query(url, {**params, "returnCountOnly": "true"})
+    if "error" in count_data:
+        return count_data
+    total = count_data.get("count", 0)
+    if max_features is not None:
+        total = min(total, max_features)
+    page_count = max(1, math.ceil(total / page_size))
+
+    page_params = {
+        **params,
+        "returnCountOnly": "false",
+        "orderByFields": params.get("orderByFields") or object_id_field(info),
+        "resultRecordCount": str(page_size),
+    }
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def fetch_page(index: int) -> tuple:
+        async with semaphore:
+            return await post_query(url, {**page_params, "resultOffset": str(index * page_size)})
+
+    results = list(await asyncio.gather(*(fetch_page(index) for index in range(page_count))))
+    # Live layers can grow between the count and the last page; keep going until drained.
+    while max_features is None and results[-1][0].get("exceededTransferLimit") and "error" not in results[-1][0]:
+        results.append(await fetch_page(len(results)))
+
+    pages = []
+    for data, size in results:
+        if "error" in data:
+            return data
+        pages.append(data)
+        total_bytes += size
+    return _merge(pages, total_bytes, max_features)
+
+
+async def fetch_by_object_ids(layer_url: str, params: dict, max_features: Optional[int] = None, max_concurrency: int = MAX_CONCURRENT_PAGES) -> dict:
+    """
+    Fetches every feature matching `params` by object ID batches.
+
+    The matching IDs are requested first with returnIdsOnly, sorted, and split
+    into batches of maxRecordCount. Batches are fetched concurrently and merged
+    in ID order, so the result order is stable across calls.
+    """
+    info = await metadata.get_layer_info(layer_url)
+    if "error" in info:
+        return info
+
+    url = layer_query_url(layer_url, info, params)
+    batch_size = info.get("maxRecordCount") or DEFAULT_MAX_RECORD_COUNT
+    ids_data, total_bytes = await post_query(url, {**params, "returnIdsOnly": "true", "returnCountOnly": "false"})
+    if "error" in ids_data:
+        return ids_data
+    object_ids = sorted(ids_data.get("objectIds") or [])[:max_features]
+    if not object_ids:
+        return {"objectIdFieldName": ids_data.get("objectIdFieldName", object_id_field(info)), "features": [], "pages": 0, "bytes": total_bytes}
+
+    # The IDs already satisfy the where clause and spatial filter, so the
+    # batch requests only need to select by ID.
+    batch_params = {key: value for key, value in params.items() if key not in _FILTER_PARAMS}
+    batch_params["returnCountOnly"] = "false"
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def fetch_batch(start: int) -> tuple:
+        batch = object_ids[start:start + batch_size]
+        async with semaphore:
+            return await post_query(url, {**batch_params, "objectIds": ",".join(str(oid) for oid in batch)})
+
+    results = await asyncio.gather(*(fetch_batch(start) for start in range(0, len(object_ids), batch_size)))
+
+    pages = []
+    for data, size in results:
+        if "error" in data:
+            return data
+        pages.append(data)
+        total_bytes += size
+    return _merge(pages, total_bytes)
+
+
+async def fetch_all(layer_url: str, params: dict, strategy: str, max_features: Optional[int] = None) -> dict:
+    """Fetches with the named strategy ("paged", "objectids" or "auto"); ordered queries are always paged."""
+    ordered = bool(params.get("orderByFields"))
+    if strategy == "auto" or (strategy == "objectids" and ordered):
+        info = await metadata.get_layer_info(layer_url)
+        if "error" in info:
+            return info
+        if supports_pagination(info):
+            strategy = "paged"
+        elif ordered:
+            return {"error": f"orderByFields needs a layer that supports pagination: {layer_url}"}
+        else:
+            strategy = "objectids"
+    with tracing.span("fetch", strategy=strategy) as fetch_span:
+        if strategy == "paged":
+            data = await fetch_paged(layer_url, params, max_features)
+        else:
+            data = await fetch_by_object_ids(layer_url, params, max_features)
+        if fetch_span is not None:
+            fetch_span.set(pages=data.get("pages"), bytes=data.get("bytes"), features=len(data.get("features", [])))
+    return data
@@ -0,0 +1,251 @@
+"""
+Offline state and county boundary gazetteer.
+
+Answers boundary lookups (geometry, bounding box, FIPS codes, names) from a
+local binary file instead of querying the states/counties layers upstream.
+
+File layout (all integers big-endian):
+
+    b"EMGZ" | version: u16 | index length: u32 | zlib(JSON index) | geometry blobs
+
+The JSON index holds every record's names, FIPS codes, bbox and the offset
+and length of its zlib-compressed Esri JSON geometry blob, which is only
+decompressed when that geometry is requested. The index itself is read on
+first use.
+
+When the file is missing, the first lookup through `ensure_built` starts
+building it from the upstream layers in the background (disable with
+ESRI_MCP_GAZETTEER_AUTOBUILD=0); lookups fall back to upstream, with a
+logged warning, until it is ready. A failed build is retried by the next
+lookup once ESRI_MCP_GAZETTEER_RETRY seconds (default 300) have passed.
+Rebuild the file at any time with:
+
+    python gazetteer.py refresh [path]
+"""
+
+import asyncio
+import json
+import logging
+import os
+import struct
+import sys
+import time
+import zlib
+from typing import Optional
+
+MAGIC = b"EMGZ"
+VERSION = 1
+_HEADER = struct.Struct(">4sHI")
+
+GAZETTEER_PATH = os.environ.get(
+    "ESRI_MCP_GAZETTEER", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "gazetteer.bin")
+)
+
+AUTOBUILD = os.environ.get("ESRI_MCP_GAZETTEER_AUTOBUILD", "1") != "0"
+BUILD_RETRY_INTERVAL = float(os.environ.get("ESRI_MCP_GAZETTEER_RETRY", "300"))
+
+logger = logging.getLogger(__name__)
+
+_index = None
+_blob_offset = 0
+_geometries = {}
+_build_task = None
+_build_failed_at = None
+_fallback_warned = False
+
+
+def _load_index() -> Optional[dict]:
+    global _index, _blob_offset
+    if _index is None:
+        if not os.path.exists(GAZETTEER_PATH):
+            return None
+        with open(GAZETTEER_PATH, "rb") as f:
+            magic, version, index_length = _HEADER.unpack(f.read(_HEADER.size))
+            if magic != MAGIC or version != VERSION:
+                logger.warning("Ignoring gazetteer %s: unsupported format", GAZETTEER_PATH)
+                return None
+            index = json.loads(zlib.decompress(f.read(index_length)))
+        index["states_by_key"] = {}
+        for record in index["states"]:
+            for key in (record["name"], record["abbr"], record["fips"]):
+                index["states_by_key"][key.upper()] = record
+        index["counties_by_key"] = {
+            (record["state_fips"], record["name"].upper()): record for record in index["counties"]
+        }
+        _blob_offset = _HEADER.size + index_length
+        _index = index
+    return _index
+
+
+def available() -> bool:
+    return _load_index() is not None
+
+
+def spatial_reference(layer: str) -> Optional[dict]:
+    """The spatial reference the "states" or "counties" geometries were stored in, if known."""
+    index = _load_index()
+    return (index.get("spatialReferences") or {}).get(layer) if index else None
+
+
+async def _build(states_url: str, counties_url: str) -> None:
+    global _build_task, _build_failed_at
+    try:
+        result = await refresh(GAZETTEER_PATH, states_url, counties_url)
+        logger.info("Built gazetteer %s: %s states, %s counties", result["path"], result["states"], result["counties"])
+    except Exception as e:
+        logger.warning("Building gazetteer %s failed (retrying in %ss): %s", GAZETTEER_PATH, BUILD_RETRY_INTERVAL, e)
+        # Lets a later lookup start another build.
+        _build_failed_at = time.monotonic()
+        _build_task = None
+
+
+def ensure_built(states_url: str, counties_url: str) -> None:
+    """
+    Starts building a missing gazetteer in the background (unless
+    ESRI_MCP_GAZETTEER_AUTOBUILD=0, and at most every BUILD_RETRY_INTERVAL
+    seconds after a failure) and warns once that lookups go upstream meanwhile.
+    """
+    global _build_task, _fallback_warned
+    if available():
+        return
+    if not _fallback_warned:
+        _fallback_warned = True
+        logger.warning(
+            "Gazetteer %s not found; boundary lookups go upstream%s", GAZETTEER_PATH,
+            " while it is built in the background" if AUTOBUILD else ". Build it with: python gazetteer.py refresh",
+        )
+    retry_due = _build_failed_at is None or time.monotonic() - _build_failed_at >= BUILD_RETRY_INTERVAL
+    if AUTOBUILD and _build_task is None and retry_due:
+        _build_task = asyncio.get_running_loop().create_task(_build(states_url, counties_url))
+
+
+def _geometry(record: dict) -> dict:
+    key = record["offset"]
+    geometry = _geometries.get(key)
+    if geometry is None:
+        with open(GAZETTEER_PATH, "rb") as f:
+            f.seek(_blob_offset + record["offset"])
+            geometry = json.loads(zlib.decompress(f.read(record["length"])))
+        _geometries[key] = geometry
+    return geometry
+
+
+def _public(record: dict, include_geometry: bool) -> dict:
+    result = {key: value for key, value in record.items() if key not in ("offset", "length")}
+    if include_geometry:
+        result["geometry"] = _geometry(record)
+    return result
+
+
+def find_state(state: str, include_geometry: bool = True) -> Optional[dict]:
+    """Looks up a state by name, abbreviation or FIPS code; None if unknown or no gazetteer is installed."""
+    index = _load_index()
+    if index is None:
+        return None
+    record = index["states_by_key"].get(state.strip().upper())
+    return _public(record, include_geometry) if record else None
+
+
+def find_county(county: str, state: str, include_geometry: bool = True) -> Optional[dict]:
+    """Looks up a county by name (with or without the "County" suffix) within a state."""
+    index = _load_index()
+    if index is None:
+        return None
+    state_record = index["states_by_key"].get(state.strip().upper())
+    if state_record is None:
+        return None
+    name = county.strip().upper()
+    record = index["counties_by_key"].get((state_record["fips"], name))
+    if record is None and name.endswith(" COUNTY"):
+        record = index["counties_by_key"].get((state_record["fips"], name[: -len(" COUNTY")]))
+    return _public(record, include_geometry) if record else None
+
+
+def envelope(geometry: dict) -> Optional[dict]:
+    """Computes the {xmin, ymin, xmax, ymax} envelope of an Esri polygon or polyline."""
+    points = [point for part in geometry.get("rings") or geometry.get("paths") or [] for point in part]
+    if not points:
+        return None
+    xs = [point[0] for point in points]
+    ys = [point[1] for point in points]
+    return {"xmin": min(xs), "ymin": min(ys), "xmax": max(xs), "ymax": max(ys)}
+
+
+def write(path: str, states: list, counties: list, spatial_references: dict) -> None:
+    """Writes a gazetteer file. Records carry a "geometry" key that is moved into a blob."""
+    blobs = []
+    offset = 0
+    index = {"version": VERSION, "built_at": time.time(), "spatialReferences": spatial_references, "states": [], "counties": []}
+    for kind, records in (("states", states), ("counties", counties)):
+        for record in records:
+            blob = zlib.compress(json.dumps(record["geometry"], separators=(",", ":")).encode(), 9)
+            entry = {key: value for key, value in record.items() if key != "geometry"}
+            entry["bbox"] = envelope(record["geometry"])
+            entry["offset"] = offset
+            entry["length"] = len(blob)
+            index[kind].append(entry)
+            blobs.append(blob)
+            offset += len(blob)
+    index_blob = zlib.compress(json.dumps(index, separators=(",", ":")).encode(), 9)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(_HEADER.pack(MAGIC, VERSION, len(index_blob)))
+        f.write(index_blob)
+        for blob in blobs:
+            f.write(blob)
+    os.replace(tmp_path, path)
+
+
+def reset() -> None:
+    """Forgets the loaded index so the next lookup re-reads the file."""
+    global _index
+    _index = None
+    _geometries.clear()
+
+
+async def refresh(path: str, states_url: str, counties_url: str) -> dict:
+    """Rebuilds the gazetteer file from the upstream states and counties layers."""
+    import fetch
+
+    params = {"where": "1=1", "outFields": "*", "returnGeometry": "true", "returnCountOnly": "false"}
+    states_data, counties_data = await asyncio.gather(
+        fetch.fetch_all(states_url, params, "auto"),
+        fetch.fetch_all(counties_url, params, "auto"),
+    )
+    for data in (states_data, counties_data):
+        if "error" in data:
+            raise RuntimeError(f"Gazetteer refresh failed: {data['error']}")
+
+    states = []
+    for feature in states_data["features"]:
+        attributes = feature["attributes"]
+        states.append({
+            "name": attributes["STATE_NAME"],
+            "abbr": attributes["STATE_ABBR"],
+            "fips": attributes["STATE_FIPS"],
+            "geometry": feature["geometry"],
+        })
+    counties = []
+    for feature in counties_data["features"]:
+        attributes = feature["attributes"]
+        counties.append({
+            "name": attributes["NAME"],
+            "state_fips": attributes["STATEFP"],
+            "fips": attributes.get("FIPS") or f"{attributes['STATEFP']}{attributes.get('COUNTYFP', '')}",
+            "geometry": feature["geometry"],
+        })
+    spatial_references = {"states": states_data.get("spatialReference"), "counties": counties_data.get("spatialReference")}
+    write(path, states, counties, spatial_references)
+    reset()
+    return {"path": path, "states": len(states), "counties": len(counties), "bytes": os.path.getsize(path)}
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != "refresh":
+        print(__doc__)
+        sys.exit(1)
+    from main import LAYER_MAPPING
+
+    target = sys.argv[2] if len(sys.argv) > 2 else GAZETTEER_PATH
+    print(asyncio.run(refresh(target, LAYER_MAPPING["states"], LAYER_MAPPING["counties"])))
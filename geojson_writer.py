@@ -0,0 +1,30 @@
+"""
+GeoJSON FeatureCollection serializer.
+
+MCP tool results are returned as one string, so the collection is dumped in
+a single call. Output is compact by default; `indent` is still available for
+human-readable files. `orjson` is used for compact output when installed
+(set ESRI_MCP_JSON_BACKEND=json to force the standard library). Features
+come from esri_geojson, which also does any coordinate rounding.
+"""
+
+import json
+import os
+from typing import Optional
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+JSON_BACKEND = os.environ.get("ESRI_MCP_JSON_BACKEND", "orjson" if orjson else "json")
+
+
+def dumps_feature_collection(features: list, indent: Optional[int] = None) -> str:
+    """Serializes GeoJSON features as a FeatureCollection string."""
+    collection = {"type": "FeatureCollection", "features": features}
+    if indent:
+        return json.dumps(collection, indent=indent)
+    if JSON_BACKEND == "orjson" and orjson is not None:
+        return orjson.dumps(collection).decode()
+    return json.dumps(collection, separators=(",", ":"))
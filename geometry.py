@@ -0,0 +1,278 @@
+"""
+Geometry helpers for Esri JSON polygons.
+
+`points_in_polygon` is a vectorized even-odd point-in-polygon test over all
+rings of a polygon, so holes and multipart polygons are handled without
+classifying rings first.
+
+`resolution_to_units` converts a target ground resolution (meters per
+pixel) into coordinate units, for requesting generalized geometries.
+
+`optimize_polygon` shrinks a polygon spatial filter before it is sent
+upstream: each ring is simplified with Douglas-Peucker, retried at a smaller
+tolerance if the result self-intersects, offset outward by the tolerance so
+the optimized polygon still contains the original, rounded to a precision
+well below the tolerance, and stripped of duplicate vertices. Rings whose
+offset fails a containment check are sent unsimplified instead.
+
+Esri rings keep the polygon interior on the right of the direction of
+travel (outer rings clockwise, holes counter-clockwise), so "outward" is
+always the left side of every ring.
+"""
+
+import json
+import math
+from typing import Optional
+
+import numpy as np
+
+# Beyond this miter length (in multiples of the offset distance) sharp convex
+# corners get a square cap instead of a long spike.
+MITER_LIMIT = 4.0
+# Self-intersection checks are quadratic; larger rings are trusted as-is.
+MAX_VALIDATED_VERTICES = 5000
+# points_in_polygon tests blocks of points x edges to bound its temporary arrays.
+PIP_POINT_BLOCK = 256
+PIP_EDGE_BLOCK = 4096
+# Ground distance of one degree of latitude, for resolutions in geographic coordinate systems.
+METERS_PER_DEGREE = 111320.0
+GEOGRAPHIC_WKIDS = (4326, 4269, 4267, 4258, 4283, 4617)
+
+
+def ring_area(ring) -> float:
+    """Signed shoelace area; negative for clockwise rings (Esri outer rings)."""
+    points = np.asarray(ring, dtype=float)[:, :2]
+    x, y = points[:, 0], points[:, 1]
+    return 0.5 * float(np.dot(x[:-1], y[1:]) - np.dot(x[1:], y[:-1]))
+
+
+def _douglas_peucker(points: np.ndarray, tolerance: float) -> np.ndarray:
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end <= start + 1:
+            continue
+        segment = points[end] - points[start]
+        inner = points[start + 1:end] - points[start]
+        squared_length = segment[0] ** 2 + segment[1] ** 2
+        # Distance to the segment, not its infinite line: vertices past either end
+        # are measured to that endpoint, or they could be dropped while far outside.
+        if squared_length == 0:
+            projection = np.zeros(len(inner))
+        else:
+            projection = np.clip((inner[:, 0] * segment[0] + inner[:, 1] * segment[1]) / squared_length, 0, 1)
+        distances = np.hypot(inner[:, 0] - projection * segment[0], inner[:, 1] - projection * segment[1])
+        index = int(np.argmax(distances))
+        if distances[index] > tolerance:
+            split = start + 1 + index
+            keep[split] = True
+            stack.append((start, split))
+            stack.append((split, end))
+    return points[keep]
+
+
+def _self_intersects(points: np.ndarray) -> bool:
+    """True if any two non-adjacent edges of the closed ring cross."""
+    a = points[:-1]
+    b = points[1:]
+    count = len(a)
+    if count < 4 or count > MAX_VALIDATED_VERTICES:
+        return False
+    d = b - a
+    for i in range(count - 2):
+        # Edges i+2 .. count-1, skipping the edge that closes back onto edge i.
+        last = count - 1 if i == 0 else count
+        if last <= i + 2:
+            continue
+        p, r = a[i], d[i]
+        q, s = a[i + 2:last], d[i + 2:last]
+        denominator = r[0] * s[:, 1] - r[1] * s[:, 0]
+        qp = q - p
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t = (qp[:, 0] * s[:, 1] - qp[:, 1] * s[:, 0]) / denominator
+            u = (qp[:, 0] * r[1] - qp[:, 1] * r[0]) / denominator
+        if np.any((denominator != 0) & (t >= 0) & (t <= 1) & (u >= 0) & (u <= 1)):
+            return True
+    return False
+
+
+def simplify_ring(ring, tolerance: float) -> Optional[np.ndarray]:
+    """
+    Simplifies a closed ring, halving the tolerance until the result does not
+    self-intersect. Returns None if the ring collapses below a triangle.
+    """
+    points = np.asarray(ring, dtype=float)[:, :2]
+    points = points[np.concatenate(([True], np.any(points[1:] != points[:-1], axis=1)))]
+    if len(points) < 4:
+        return None
+    while tolerance > 0:
+        simplified = _douglas_peucker(points, tolerance)
+        if len(simplified) >= 4 and not _self_intersects(simplified):
+            return simplified
+        if len(simplified) >= len(points) - 1:
+            break
+        tolerance /= 2
+    return points
+
+
+def offset_ring(points: np.ndarray, distance: float) -> np.ndarray:
+    """Offsets a closed ring `distance` to the left of its direction of travel (mitered)."""
+    ring = points[:-1]
+    incoming = ring - np.roll(ring, 1, axis=0)
+    outgoing = np.roll(ring, -1, axis=0) - ring
+    incoming /= np.hypot(incoming[:, 0], incoming[:, 1])[:, None]
+    outgoing /= np.hypot(outgoing[:, 0], outgoing[:, 1])[:, None]
+    normal_in = np.column_stack((-incoming[:, 1], incoming[:, 0]))
+    normal_out = np.column_stack((-outgoing[:, 1], outgoing[:, 0]))
+    bisector = normal_in + normal_out
+    # 1 / cos(half the turn angle) scales the bisector to reach both offset edges.
+    cos_half = np.hypot(bisector[:, 0], bisector[:, 1]) / 2
+    turn = incoming[:, 0] * outgoing[:, 1] - incoming[:, 1] * outgoing[:, 0]
+
+    result = []
+    for i in range(len(ring)):
+        # Right turns are convex on the offset side; cap them when the miter would spike.
+        if turn[i] < 0 and (cos_half[i] == 0 or 1 / cos_half[i] > MITER_LIMIT):
+            result.append(ring[i] + distance * (normal_in[i] + incoming[i]))
+            result.append(ring[i] + distance * (normal_out[i] - outgoing[i]))
+        elif cos_half[i] == 0:
+            result.append(ring[i] + distance * normal_in[i])
+        else:
+            result.append(ring[i] + distance * bisector[i] / (2 * cos_half[i] ** 2))
+    result.append(result[0])
+    return np.asarray(result)
+
+
+def _round_ring(points: np.ndarray, decimals: int) -> list:
+    rounded = np.round(points, decimals)
+    changed = np.any(rounded[1:] != rounded[:-1], axis=1)
+    deduplicated = rounded[np.concatenate(([True], changed))]
+    if decimals <= 0:
+        deduplicated = deduplicated.astype(np.int64)
+    return deduplicated.tolist()
+
+
+def decimals_for_tolerance(tolerance: float) -> int:
+    """Coordinate precision an order of magnitude finer than the tolerance."""
+    return max(0, math.ceil(-math.log10(tolerance / 10)))
+
+
+def resolution_to_units(resolution: float, wkid: Optional[int]) -> float:
+    """Converts a ground resolution in meters to the units of `wkid`: degrees for geographic systems, otherwise meters."""
+    if wkid in GEOGRAPHIC_WKIDS:
+        return resolution / METERS_PER_DEGREE
+    return resolution
+
+
+def _contains_ring(outer: np.ndarray, inner: np.ndarray) -> bool:
+    """True if every vertex of `inner` is strictly inside the simple ring `outer` (even-odd)."""
+    return bool(np.all(points_in_polygon(inner[:, 0], inner[:, 1], {"rings": [outer]})))
+
+
+def _offset_is_valid(original: np.ndarray, offset: np.ndarray, is_hole: bool) -> bool:
+    """
+    Checks that an offset ring still bounds the original one: it must not fold
+    onto itself (mitered joins can on short or reflex edges), an outer ring
+    must contain every original vertex, and a hole must lie inside the original hole.
+    """
+    if _self_intersects(offset) or (ring_area(offset) > 0) != is_hole:
+        return False
+    if is_hole:
+        return _contains_ring(original, offset[:-1])
+    return _contains_ring(offset, original[:-1])
+
+
+def optimize_polygon(geometry: dict, tolerance: float) -> dict:
+    """
+    Returns a smaller polygon that contains `geometry`, for use as a spatial filter.
+
+    Every original vertex lies within `tolerance` of the simplified ring, so
+    offsetting by the tolerance (plus the rounding error) restores containment.
+    Each result is checked; an outer ring whose offset folds or misses an
+    original vertex is sent unsimplified, and such a hole is dropped, which
+    only widens the filter.
+    """
+    if not tolerance > 0:
+        raise ValueError(f"Invalid tolerance: {tolerance}. It must be a positive number.")
+    decimals = decimals_for_tolerance(tolerance)
+    distance = tolerance + 10 ** -decimals
+    rings = []
+    for ring in geometry.get("rings", []):
+        simplified = simplify_ring(ring, tolerance)
+        if simplified is None:
+            continue
+        original = np.asarray(ring, dtype=float)[:, :2]
+        # From the original: simplifying a thin ring can reverse its orientation.
+        is_hole = ring_area(original) > 0
+        offset = np.asarray(_round_ring(offset_ring(simplified, distance), decimals), dtype=float)
+        if len(offset) >= 4 and _offset_is_valid(original, offset, is_hole):
+            rings.append(_round_ring(offset, decimals))
+        elif not is_hole:
+            rings.append(ring)
+    optimized = {key: value for key, value in geometry.items() if key != "rings"}
+    optimized["rings"] = rings
+    return optimized
+
+
+def vertex_count(geometry: dict) -> int:
+    return sum(len(ring) for ring in geometry.get("rings", []))
+
+
+def compact_json(geometry: dict) -> str:
+    return json.dumps(geometry, separators=(",", ":"))
+
+
+def polygon_envelope(geometry: dict) -> dict:
+    """{xmin, ymin, xmax, ymax} of all rings, keeping the spatialReference if present."""
+    points = np.concatenate([np.asarray(ring, dtype=float)[:, :2] for ring in geometry["rings"]])
+    xmin, ymin = points.min(axis=0)
+    xmax, ymax = points.max(axis=0)
+    envelope = {"xmin": float(xmin), "ymin": float(ymin), "xmax": float(xmax), "ymax": float(ymax)}
+    if "spatialReference" in geometry:
+        envelope["spatialReference"] = geometry["spatialReference"]
+    return envelope
+
+
+def points_in_polygon(xs, ys, geometry: dict) -> np.ndarray:
+    """
+    Boolean mask of the points (xs[i], ys[i]) that fall inside the polygon.
+
+    Uses the even-odd crossing rule over the edges of every ring at once, so
+    a point inside a hole crosses the hole's edges too and tests outside.
+    """
+    xs = np.asarray(xs, dtype=float)
+    ys = np.asarray(ys, dtype=float)
+    rings = [np.asarray(ring, dtype=float)[:, :2] for ring in geometry.get("rings", []) if len(ring) > 1]
+    inside = np.zeros(len(xs), dtype=bool)
+    if not rings or not len(xs):
+        return inside
+    starts = np.concatenate([ring[:-1] for ring in rings])
+    ends = np.concatenate([ring[1:] for ring in rings])
+
+    # Only points inside the envelope can be inside the polygon.
+    all_points = np.concatenate(rings)
+    (xmin, ymin), (xmax, ymax) = all_points.min(axis=0), all_points.max(axis=0)
+    candidates = np.flatnonzero((xs >= xmin) & (xs <= xmax) & (ys >= ymin) & (ys <= ymax))
+    # Sorting by y keeps each block in a narrow band, so most edges can be skipped per block.
+    candidates = candidates[np.argsort(ys[candidates], kind="stable")]
+    edge_ymin = np.minimum(starts[:, 1], ends[:, 1])
+    edge_ymax = np.maximum(starts[:, 1], ends[:, 1])
+    edge_xmax = np.maximum(starts[:, 0], ends[:, 0])
+    crossings = np.zeros(len(candidates), dtype=np.int64)
+    for point_block in range(0, len(candidates), PIP_POINT_BLOCK):
+        block_points = candidates[point_block:point_block + PIP_POINT_BLOCK]
+        px = xs[block_points][:, None]
+        py = ys[block_points][:, None]
+        edges = np.flatnonzero((edge_ymax >= py.min()) & (edge_ymin <= py.max()) & (edge_xmax >= px.min()))
+        for edge_block in range(0, len(edges), PIP_EDGE_BLOCK):
+            block_edges = edges[edge_block:edge_block + PIP_EDGE_BLOCK]
+            x1, y1 = starts[block_edges].T
+            x2, y2 = ends[block_edges].T
+            straddles = (y1 > py) != (y2 > py)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                x_cross = x1 + (py - y1) * (x2 - x1) / (y2 - y1)
+            crossings[point_block:point_block + PIP_POINT_BLOCK] += np.count_nonzero(straddles & (px < x_cross), axis=1)
+    inside[candidates] = crossings % 2 == 1
+    return inside
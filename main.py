@@ -1,12 +1,78 @@
 from fastmcp import FastMCP
-import requests
+from fastmcp.server.middleware import Middleware
+import cache
+import esri_geojson
+import fetch
+import gazetteer
+import geometry
+import geojson_writer
+import metadata
+import metrics
+import ratelimit
+import replica
+import sync
+import tracing
+import upstream
+import asyncio
 import json
+import os
+import time
 import urllib.parse
 from typing import Optional
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.responses import PlainTextResponse
 
 app = FastMCP(name="Esri Living Atlas")
 
+
+class _SessionMiddleware(Middleware):
+    """Tags each tool call's upstream requests with its MCP session, so host rate limits are shared fairly between sessions."""
+
+    async def on_call_tool(self, context, call_next):
+        try:
+            session_id = context.fastmcp_context.session_id if context.fastmcp_context else None
+        except RuntimeError:
+            session_id = None
+        token = ratelimit.session.set(session_id)
+        try:
+            return await call_next(context)
+        finally:
+            ratelimit.session.reset(token)
+
+
+class _MetricsMiddleware(Middleware):
+    """Records each tool call's outcome, latency and result size for /metrics."""
+
+    async def on_call_tool(self, context, call_next):
+        started = time.perf_counter()
+        try:
+            result = await call_next(context)
+        except Exception:
+            metrics.observe_tool(context.message.name, started, False, 0)
+            raise
+        structured = getattr(result, "structured_content", None)
+        failed = getattr(result, "is_error", False) or (isinstance(structured, dict) and "error" in structured)
+        sent = sum(len(getattr(block, "text", "") or "") for block in getattr(result, "content", None) or [])
+        metrics.observe_tool(context.message.name, started, not failed, sent)
+        return result
+
+
+class _TracingMiddleware(Middleware):
+    """Opens the root span of a sampled tool call; the phases below it are recorded as child spans."""
+
+    async def on_call_tool(self, context, call_next):
+        arguments = context.message.arguments or {}
+        with tracing.root_span(f"tool {context.message.name}", **{"mcp.tool": context.message.name, "esri.layer": arguments.get("layer_name")}) as root:
+            result = await call_next(context)
+            if root is not None:
+                root.set(**{"mcp.result.bytes": sum(len(getattr(block, "text", "") or "") for block in getattr(result, "content", None) or [])})
+            return result
+
+
+app.add_middleware(_MetricsMiddleware())
+app.add_middleware(_TracingMiddleware())
+app.add_middleware(_SessionMiddleware())
+
 # Add CORS middleware for web app access
 app.http_app().add_middleware(
     CORSMiddleware,
@@ -33,6 +99,99 @@ LAYER_MAPPING = {
     "storm-reports": "https://services9.arcgis.com/RHVPKKiFTONKtxq3/arcgis/rest/services/NOAA_storm_reports_v1/FeatureServer/4"
 }
 
+# Point every layer at a local stand-in server instead (see fake_arcgis.py), e.g. for offline benchmarks.
+LAYER_BASE_URL = os.environ.get("ESRI_MCP_LAYER_BASE_URL")
+if LAYER_BASE_URL:
+    LAYER_MAPPING = {name: f"{LAYER_BASE_URL.rstrip('/')}/{name}/FeatureServer/0" for name in LAYER_MAPPING}
+
+FETCH_STRATEGIES = ["single", "paged", "objectids", "auto"]
+
+SPATIAL_MODES = ["server", "envelope"]
+
+GEOMETRY_FORMATS = ["esri", "geojson"]
+
+# query_many: most queries per call, and how many run at once against one upstream host.
+MAX_BATCH_QUERIES = int(os.environ.get("ESRI_MCP_BATCH_MAX_QUERIES", "50"))
+BATCH_HOST_CONCURRENCY = int(os.environ.get("ESRI_MCP_BATCH_HOST_CONCURRENCY", "6"))
+STATISTIC_TYPES = ["count", "sum", "min", "max", "avg", "stddev"]
+
+QUERY_SPEC_KEYS = [
+    "id", "layer_name", "where", "out_fields", "return_count_only", "spatial_filter", "return_geometry",
+    "strategy", "simplify_tolerance", "spatial_mode", "resolution",
+]
+
+# Response cache TTLs in seconds; live layers expire quickly, boundaries rarely change.
+DEFAULT_CACHE_TTL = 600
+CACHE_TTLS = {
+    "states": 86400,
+    "counties": 86400,
+    "watersheds": 86400,
+    "rivers": 86400,
+    "dams": 86400,
+    "impaired-waters": 86400,
+    "sample-points": 86400,
+    "cors-stations": 3600,
+    "seismic-stations": 3600,
+    "water-quality": 3600,
+    "raws-stations": 300,
+    "usgs-gauges": 300,
+    "weather-stations": 60,
+    "storm-reports": 60,
+}
+
+# Upstream resilience overrides per layer (see upstream.DEFAULT_POLICY). The NOAA
+# gauge service has a long latency tail, so slow queries to it are hedged.
+UPSTREAM_POLICIES = {
+    "usgs-gauges": {"hedge": True, "retries": 3},
+    "weather-stations": {"hedge": True},
+    "storm-reports": {"hedge": True},
+}
+upstream.POLICIES.update({LAYER_MAPPING[name]: policy for name, policy in UPSTREAM_POLICIES.items()})
+
+response_cache = cache.TTLCache(max_bytes=int(os.environ.get("ESRI_MCP_CACHE_MAX_BYTES", str(64 * 1024 * 1024))))
+
+
+def _invalidate_cached_layer(delta: dict) -> None:
+    """Sync subscriber: drops a layer's cached responses once upstream reports edits."""
+    if delta["full"] or delta["since"] != delta["watermark"]:
+        prefix = cache.canonical_key(delta["layer"])[:-1] + ","
+        response_cache.invalidate(lambda key: key.startswith(prefix))
+
+
+def _metrics_collector() -> list:
+    """Scrape-time gauges for pool, rate limiter and cache state that other modules already track."""
+    stats = upstream.pool_stats()
+    hosts = stats["hosts"]
+    limits = stats["rate_limits"]
+    cache_stats = response_cache.stats()
+    return [
+        ("esri_mcp_upstream_in_flight", "gauge", "Upstream requests in flight.", [({"host": host}, host_stats["in_flight"]) for host, host_stats in hosts.items()]),
+        ("esri_mcp_upstream_requests_total", "counter", "Upstream request attempts.", [({"host": host}, host_stats["requests"]) for host, host_stats in hosts.items()]),
+        ("esri_mcp_upstream_retries_total", "counter", "Upstream request retries.", [({"host": host}, host_stats["retries"]) for host, host_stats in hosts.items()]),
+        ("esri_mcp_upstream_coalesced_total", "counter", "Requests served by an identical in-flight request.", [({"host": host}, host_stats["coalesced"]) for host, host_stats in hosts.items()]),
+        ("esri_mcp_upstream_circuit_open", "gauge", "1 while the host's circuit breaker is open.", [({"host": host}, int(host_stats["breaker_state"] == "open")) for host, host_stats in hosts.items()]),
+        ("esri_mcp_upstream_open_connections", "gauge", "Open pooled connections.", [({"host": host}, host_stats["open_connections"]) for host, host_stats in hosts.items()]),
+        ("esri_mcp_rate_limit_waiting", "gauge", "Requests queued by the host rate limiter.", [({"host": host}, host_limits["waiting"]) for host, host_limits in limits.items()]),
+        ("esri_mcp_rate_limit_throttled_total", "counter", "Throttling responses (429, 503 with Retry-After).", [({"host": host}, host_limits["throttled"]) for host, host_limits in limits.items()]),
+        ("esri_mcp_response_cache_hits_total", "counter", "Response cache hits.", [({}, cache_stats["hits"])]),
+        ("esri_mcp_response_cache_misses_total", "counter", "Response cache misses.", [({}, cache_stats["misses"])]),
+        ("esri_mcp_response_cache_hit_ratio", "gauge", "Response cache hit ratio.", [({}, cache_stats["hit_ratio"])]),
+        ("esri_mcp_response_cache_bytes", "gauge", "Bytes held by the response cache.", [({}, cache_stats["bytes"])]),
+    ]
+
+
+metrics.register_layers(LAYER_MAPPING)
+metrics.register_collector(_metrics_collector)
+
+
+@app.custom_route("/metrics", methods=["GET"])
+async def metrics_endpoint(request) -> PlainTextResponse:
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+for _layer_name in sorted(set(sync.SYNC_LAYERS) | set(replica.REPLICA_LAYERS)):
+    sync.subscribe(_layer_name, _invalidate_cached_layer, features=False)
+
 POINT_LAYERS = [
     "usgs-gauges", "water-quality", "sample-points",
     "weather-stations", "raws-stations", "seismic-stations", "cors-stations", "storm-reports"
@@ -46,8 +205,220 @@ app.http_app().add_middleware(
     allow_headers=["*"],  # Covers Content-Type, Accept, X-Session-ID, Authorization
 )
 
+def _build_query_params(where: str, out_fields: str, return_count_only: bool, spatial_filter: Optional[str], return_geometry: bool, simplify_tolerance: Optional[float] = None) -> tuple:
+    """
+    Builds the /query form parameters shared by query_layer and query_point_layer.
+
+    Returns (params, filter_stats); filter_stats reports the polygon filter size
+    before and after simplification, or is None when no simplification was requested.
+    """
+    params = {
+        "where": where,
+        "outFields": out_fields,
+        "returnCountOnly": str(return_count_only).lower()
+    }
+    filter_stats = None
+    if return_geometry:
+        params["returnGeometry"] = "true"
+    if spatial_filter:
+        # Parse the JSON string for geometry
+        geometry_obj = json.loads(spatial_filter)
+        if "rings" in geometry_obj:
+            # Polygon
+            if simplify_tolerance:
+                optimized = geometry.optimize_polygon(geometry_obj, simplify_tolerance)
+                params["geometry"] = geometry.compact_json(optimized)
+                filter_stats = {
+                    "original_bytes": len(geometry.compact_json(geometry_obj)),
+                    "optimized_bytes": len(params["geometry"]),
+                    "original_vertices": geometry.vertex_count(geometry_obj),
+                    "optimized_vertices": geometry.vertex_count(optimized),
+                }
+            else:
+                params["geometry"] = geometry.compact_json(geometry_obj)
+            params["geometryType"] = "esriGeometryPolygon"
+        else:
+            # Envelope
+            params["geometry"] = f"{geometry_obj['xmin']},{geometry_obj['ymin']},{geometry_obj['xmax']},{geometry_obj['ymax']}"
+            params["geometryType"] = "esriGeometryEnvelope"
+        params["spatialRel"] = "esriSpatialRelIntersects"
+    return params, filter_stats
+
+
+async def _resolution_params(layer_name: str, resolution: float, out_wkid: Optional[int] = None) -> dict:
+    """
+    Generalization parameters for returning geometries at `resolution` meters per pixel.
+
+    Vertices closer than one pixel are dropped with maxAllowableOffset and
+    coordinates are rounded with geometryPrecision. Queries that go upstream as
+    f=pbf in the layer's own spatial reference also get quantizationParameters,
+    so the coordinate grid itself is no finer than a pixel.
+    """
+    info = await metadata.get_layer_info(LAYER_MAPPING[layer_name])
+    if "error" in info:
+        info = {}
+    layer_reference = info.get("extent", {}).get("spatialReference", {})
+    layer_wkid = layer_reference.get("latestWkid") or layer_reference.get("wkid")
+    tolerance = geometry.resolution_to_units(resolution, out_wkid or layer_wkid)
+    params = {
+        "maxAllowableOffset": repr(tolerance),
+        "geometryPrecision": str(geometry.decimals_for_tolerance(tolerance)),
+    }
+    if fetch.PBF_ENABLED and fetch.supports_pbf(info) and layer_wkid and out_wkid in (None, layer_wkid):
+        extent = info["extent"]
+        params["quantizationParameters"] = json.dumps({
+            "mode": "view",
+            "originPosition": "upperLeft",
+            "tolerance": tolerance,
+            "extent": {key: extent[key] for key in ("xmin", "ymin", "xmax", "ymax", "spatialReference")},
+        }, separators=(",", ":"))
+    return params
+
+
+def _cache_key(layer_name: str, params: dict, strategy: str, max_features: Optional[int]) -> str:
+    canonical = dict(params)
+    canonical["where"] = cache.normalize_where(params.get("where", "1=1"))
+    canonical["outFields"] = cache.normalize_out_fields(params.get("outFields", "*"))
+    if canonical.get("returnCountOnly") == "true":
+        # Counts do not depend on how features would have been fetched.
+        strategy, max_features = "single", None
+    return cache.canonical_key(layer_name, strategy, max_features, canonical)
+
+
+async def _run_query(layer_name: str, params: dict, strategy: str = "single", max_features: Optional[int] = None) -> dict:
+    """Runs a /query request against a layer using the given fetch strategy, serving repeats from the response cache."""
+    if strategy not in FETCH_STRATEGIES:
+        return {"error": f"Invalid strategy: {strategy}. Available strategies: {FETCH_STRATEGIES}"}
+
+    metadata.ensure_refresher(LAYER_MAPPING.values())
+    sync.ensure_sync_task(LAYER_MAPPING)
+    key = _cache_key(layer_name, params, strategy, max_features)
+    with tracing.span("query", **{"esri.layer": layer_name, "strategy": strategy}) as query_span:
+        cached = response_cache.get(key)
+        if cached is not None:
+            if query_span is not None:
+                query_span.set(**{"cache.hit": True})
+            return cached
+
+        layer_url = LAYER_MAPPING[layer_name]
+        if strategy != "single" and params.get("returnCountOnly") != "true":
+            data = await fetch.fetch_all(layer_url, params, strategy, max_features)
+            size = data.get("bytes")
+        else:
+            info = await metadata.get_layer_info(layer_url)
+            # Layers without readable metadata are still queried, as f=json.
+            query_url = fetch.layer_query_url(layer_url, {} if "error" in info else info, params)
+            data, size = await fetch.post_query(query_url, params)
+
+        if query_span is not None:
+            query_span.set(**{"cache.hit": False, "bytes": size, "features": len(data.get("features", []))})
+        if "error" not in data:
+            response_cache.set(key, data, CACHE_TTLS.get(layer_name, DEFAULT_CACHE_TTL), size)
+        return data
+
+
+async def _cap_single(layer_name: str, result: dict) -> dict:
+    """Truncates a locally computed result to maxRecordCount, like a single upstream request would."""
+    features = result.get("features")
+    if features is None:
+        return result
+    info = await metadata.get_layer_info(LAYER_MAPPING[layer_name])
+    max_record_count = info.get("maxRecordCount") or fetch.DEFAULT_MAX_RECORD_COUNT
+    if len(features) <= max_record_count:
+        return result
+    return {**result, "features": features[:max_record_count], "exceededTransferLimit": True}
+
+
+async def _query_points_in_polygon(layer_name: str, where: str, out_fields: str, return_count_only: bool, polygon: dict, return_geometry: bool, strategy: str) -> dict:
+    """
+    Two-phase polygon query for point layers: fetch the points inside the
+    polygon's envelope, then keep those inside the polygon with a local test.
+    """
+    info = await metadata.get_layer_info(LAYER_MAPPING[layer_name])
+    if "error" in info:
+        return info
+    envelope = geometry.polygon_envelope(polygon)
+    spatial_reference = polygon.get("spatialReference", {})
+    wkid = spatial_reference.get("latestWkid") or spatial_reference.get("wkid")
+    params = {
+        "where": where,
+        # Counting only needs the point locations.
+        "outFields": fetch.object_id_field(info) if return_count_only else out_fields,
+        "returnCountOnly": "false",
+        "returnGeometry": "true",
+        "geometry": f"{envelope['xmin']},{envelope['ymin']},{envelope['xmax']},{envelope['ymax']}",
+        "geometryType": "esriGeometryEnvelope",
+        "spatialRel": "esriSpatialRelIntersects",
+    }
+    if wkid:
+        # Have the points returned in the polygon's coordinate system.
+        params["inSR"] = str(wkid)
+        params["outSR"] = str(wkid)
+
+    # Every candidate is needed to refine correctly, whatever the requested strategy.
+    candidates = await _run_query(layer_name, params, "auto" if strategy == "single" else strategy)
+    if "error" in candidates:
+        return candidates
+
+    features = [feature for feature in candidates.get("features", []) if feature.get("geometry")]
+    xs = [feature["geometry"]["x"] for feature in features]
+    ys = [feature["geometry"]["y"] for feature in features]
+    inside = geometry.points_in_polygon(xs, ys, polygon)
+    features = [feature for feature, keep in zip(features, inside) if keep]
+    if return_count_only:
+        return {"count": len(features)}
+
+    result = {key: value for key, value in candidates.items() if key not in ("features", "pages", "bytes")}
+    if strategy != "single":
+        result["pages"] = candidates.get("pages")
+        result["bytes"] = candidates.get("bytes")
+    if not return_geometry:
+        features = [{key: value for key, value in feature.items() if key != "geometry"} for feature in features]
+        result.pop("geometryType", None)
+        result.pop("spatialReference", None)
+    result["features"] = features
+    return await _cap_single(layer_name, result) if strategy == "single" else result
+
+
+async def _query(layer_name: str, where: str, out_fields: str, return_count_only: bool, spatial_filter: Optional[str], return_geometry: bool, strategy: str, simplify_tolerance: Optional[float], spatial_mode: str, resolution: Optional[float] = None) -> dict:
+    """Shared implementation of query_layer and query_point_layer."""
+    if resolution is not None and resolution <= 0:
+        return {"error": f"Invalid resolution: {resolution}. It must be a positive number of meters per pixel."}
+    if simplify_tolerance is not None and not simplify_tolerance > 0:
+        return {"error": f"Invalid simplify_tolerance: {simplify_tolerance}. It must be a positive number in the filter's coordinate units."}
+    if spatial_mode not in SPATIAL_MODES:
+        return {"error": f"Invalid spatial_mode: {spatial_mode}. Available modes: {SPATIAL_MODES}"}
+    if strategy not in FETCH_STRATEGIES:
+        return {"error": f"Invalid strategy: {strategy}. Available strategies: {FETCH_STRATEGIES}"}
+
+    sync.ensure_sync_task(LAYER_MAPPING)
+    local = replica.get(layer_name)
+    if local is not None:
+        try:
+            result = local.query(where, out_fields, return_count_only, json.loads(spatial_filter) if spatial_filter else None, return_geometry)
+        except replica.UnsupportedQuery:
+            result = None
+        if result is not None:
+            tracing.set_attributes(**{"replica.hit": True})
+            return await _cap_single(layer_name, result) if strategy == "single" else result
+    if spatial_mode == "envelope" and spatial_filter:
+        polygon = json.loads(spatial_filter)
+        if "rings" in polygon:
+            if layer_name not in POINT_LAYERS:
+                return {"error": f"spatial_mode 'envelope' is only supported for point layers: {POINT_LAYERS}"}
+            return await _query_points_in_polygon(layer_name, where, out_fields, return_count_only, polygon, return_geometry, strategy)
+
+    params, filter_stats = _build_query_params(where, out_fields, return_count_only, spatial_filter, return_geometry, simplify_tolerance)
+    if resolution and return_geometry and not return_count_only:
+        params.update(await _resolution_params(layer_name, resolution))
+    result = await _run_query(layer_name, params, strategy)
+    if filter_stats:
+        result = {**result, "spatialFilterStats": filter_stats}
+    return result
+
+
 @app.tool()
-def query_point_layer(layer_name: str, where: str = "1=1", out_fields: str = "*", return_count_only: bool = False, spatial_filter: Optional[str] = None, return_geometry: bool = False) -> dict:
+async def query_point_layer(layer_name: str, where: str = "1=1", out_fields: str = "*", return_count_only: bool = False, spatial_filter: Optional[str] = None, return_geometry: bool = False, strategy: str = "single", simplify_tolerance: Optional[float] = None, spatial_mode: str = "server") -> dict:
     """
     Queries a point feature layer from the Esri Living Atlas.
 
@@ -57,13 +428,18 @@ def query_point_layer(layer_name: str, where: str = "1=1", out_fields: str = "*"
     :param return_count_only: Set to true to return only the feature count, not the data.
     :param spatial_filter: A spatial filter in Esri JSON format (optional).
     :param return_geometry: Set to true to include geometry in the response.
+    :param strategy: How to fetch results. "single" sends one request and returns at most the layer's maxRecordCount features. "paged" fetches every matching feature in concurrent resultOffset pages and merges them, adding "pages" and "bytes" to the response. "objectids" does the same with concurrent objectIds batches, for layers without pagination support (e.g. usgs-gauges, sample-points). "auto" picks "paged" or "objectids" from the layer's capabilities.
+    :param simplify_tolerance: Optional tolerance, in the filter's coordinate units, for shrinking a polygon spatial_filter before sending it. The polygon is simplified, grown outward by the tolerance so it still contains the original, and rounded; features just outside the original boundary may be included. The response then reports the filter size before and after in "spatialFilterStats".
+    :param spatial_mode: How a polygon spatial_filter is applied. "server" sends the polygon upstream. "envelope" (point layers only) sends just the polygon's bounding box and tests the returned points against the polygon locally, which is much faster for detailed polygons such as state boundaries.
 
     Examples:
     - Count USGS gages in Michigan: layer_name="usgs-gauges", where="state = 'MI'", return_count_only=true
     - Count census points in Michigan: layer_name="sample-points", where="STATE_FIPS = '26'", return_count_only=true
+    - Get all census points in Michigan: layer_name="sample-points", where="STATE_FIPS = '26'", strategy="auto"
     - Count weather stations in the US: layer_name="weather-stations", where="COUNTRY = 'United States'", return_count_only=true
     - Count RAWS stations in Michigan: layer_name="raws-stations", where="State = 'Michigan'", return_count_only=true
     - Count storm reports in Texas: layer_name="storm-reports", where="STATE = 'TX'", return_count_only=true
+    - Count USGS gages inside a state polygon: layer_name="usgs-gauges", spatial_filter=<output of get_state_geometry>, spatial_mode="envelope", return_count_only=true
 
     :return: The JSON response from the server, or {"error": "message"} if failed.
     """
@@ -74,40 +450,11 @@ def query_point_layer(layer_name: str, where: str = "1=1", out_fields: str = "*"
     if layer_name not in LAYER_MAPPING:
         return {"error": f"Invalid layer name: {layer_name}. Available layers: {list(LAYER_MAPPING.keys())}"}
 
-    layer_url = LAYER_MAPPING[layer_name]
-
-    # Always include f=json as a query parameter
-    query_url = f"{layer_url}/query?f=json"
-
-    headers = {"Accept": "application/json"}
-
-    params = {
-        "where": where,
-        "outFields": out_fields,
-        "returnCountOnly": str(return_count_only).lower()
-    }
-    if return_geometry:
-        params["returnGeometry"] = "true"
-    if spatial_filter:
-        # Parse the JSON string for geometry
-        geometry_obj = json.loads(spatial_filter)
-        if "rings" in geometry_obj:
-            # Polygon
-            params["geometry"] = urllib.parse.quote(spatial_filter)
-            params["geometryType"] = "esriGeometryPolygon"
-        else:
-            # Envelope
-            params["geometry"] = f"{geometry_obj['xmin']},{geometry_obj['ymin']},{geometry_obj['xmax']},{geometry_obj['ymax']}"
-            params["geometryType"] = "esriGeometryEnvelope"
-        params["spatialRel"] = "esriSpatialRelIntersects"
-    response = requests.post(query_url, data=params, headers=headers, timeout=30)
-
-    response.raise_for_status()
-    return response.json()
+    return await _query(layer_name, where, out_fields, return_count_only, spatial_filter, return_geometry, strategy, simplify_tolerance, spatial_mode)
 
 
 @app.tool()
-def query_layer(layer_name: str, where: str = "1=1", out_fields: str = "*", return_count_only: bool = False, spatial_filter: Optional[str] = None, return_geometry: bool = False) -> dict:
+async def query_layer(layer_name: str, where: str = "1=1", out_fields: str = "*", return_count_only: bool = False, spatial_filter: Optional[str] = None, return_geometry: bool = False, strategy: str = "single", simplify_tolerance: Optional[float] = None, spatial_mode: str = "server", resolution: Optional[float] = None) -> dict:
     """
     Queries a feature layer from the Esri Living Atlas.
 
@@ -117,11 +464,17 @@ def query_layer(layer_name: str, where: str = "1=1", out_fields: str = "*", retu
     :param return_count_only: Set to true to return only the feature count, not the data.
     :param spatial_filter: A spatial filter in Esri JSON format (optional).
     :param return_geometry: Set to true to include geometry in the response.
+    :param strategy: How to fetch results. "single" sends one request and returns at most the layer's maxRecordCount features. "paged" fetches every matching feature in concurrent resultOffset pages and merges them, adding "pages" and "bytes" to the response. "objectids" does the same with concurrent objectIds batches, for layers without pagination support (e.g. usgs-gauges, sample-points). "auto" picks "paged" or "objectids" from the layer's capabilities.
+    :param simplify_tolerance: Optional tolerance, in the filter's coordinate units, for shrinking a polygon spatial_filter before sending it. The polygon is simplified, grown outward by the tolerance so it still contains the original, and rounded; features just outside the original boundary may be included. The response then reports the filter size before and after in "spatialFilterStats".
+    :param spatial_mode: How a polygon spatial_filter is applied. "server" sends the polygon upstream. "envelope" (point layers only) sends just the polygon's bounding box and tests the returned points against the polygon locally, which is much faster for detailed polygons such as state boundaries.
+    :param resolution: Optional target map resolution in meters per pixel for returned geometries (e.g. 1000 for a statewide map, 100 for a county). The server generalizes polygons and polylines to that detail, which makes layers like watersheds, rivers and counties many times smaller. A 1:S map scale at 96 dpi is about S / 3780 meters per pixel.
 
     Examples:
     - Count USGS gages in Michigan: layer_name="usgs-gauges", where="state = 'MI'", return_count_only=true
     - Get state boundaries: layer_name="states", where="STATE_NAME = 'Michigan'", return_geometry=true
+    - Watersheds for a statewide overview map: layer_name="watersheds", where="STATES LIKE '%MI%'", return_geometry=true, resolution=1000
     - Query rivers in Virginia: layer_name="rivers", where="State = 'VA'"
+    - Query all rivers in Virginia past maxRecordCount: layer_name="rivers", where="State = 'VA'", strategy="paged"
     - Query storm reports in Texas: layer_name="storm-reports", where="STATE = 'TX'"
 
     :return: The JSON response from the server, or {"error": "message"} if failed.
@@ -129,82 +482,241 @@ def query_layer(layer_name: str, where: str = "1=1", out_fields: str = "*", retu
     if layer_name not in LAYER_MAPPING:
         return {"error": f"Invalid layer name: {layer_name}. Available layers: {list(LAYER_MAPPING.keys())}"}
 
-    layer_url = LAYER_MAPPING[layer_name]
-    
-    # Always include f=json as a query parameter
-    query_url = f"{layer_url}/query?f=json"
+    return await _query(layer_name, where, out_fields, return_count_only, spatial_filter, return_geometry, strategy, simplify_tolerance, spatial_mode, resolution)
+
+@app.tool()
+async def query_many(queries: list, host_concurrency: Optional[int] = None) -> dict:
+    """
+    Runs several layer queries concurrently in one call.
+
+    :param queries: A list of query specs, each a dict with the same keys as query_layer's arguments (layer_name, where, out_fields, return_count_only, spatial_filter, return_geometry, strategy, simplify_tolerance, spatial_mode, resolution) plus an optional "id" used to key its result (defaults to its position in the list, as a string). At most 50 queries per call.
+    :param host_concurrency: Optional limit on how many of the queries run at once against the same upstream host (default 6). Queries to different hosts always run in parallel.
+
+    Example:
+    - Water infrastructure in Virginia: queries=[{"id": "gauges", "layer_name": "usgs-gauges", "where": "state = 'VA'", "return_count_only": true}, {"id": "dams", "layer_name": "dams", "where": "STATE = 'VA'", "return_count_only": true}, {"id": "rivers", "layer_name": "rivers", "where": "State = 'VA'"}]
+
+    :return: {"results": {id: result}, "succeeded": n, "failed": n}. Each result is what query_layer would have returned for that spec, or {"error": "message"}; one failing query does not affect the others.
+    """
+    if not isinstance(queries, list) or not queries:
+        return {"error": "queries must be a non-empty list of query specs"}
+    if len(queries) > MAX_BATCH_QUERIES:
+        return {"error": f"Too many queries: {len(queries)}. At most {MAX_BATCH_QUERIES} per call."}
+    if host_concurrency is not None and host_concurrency < 1:
+        return {"error": f"Invalid host_concurrency: {host_concurrency}. It must be at least 1."}
+
+    semaphores = {}
+    limit = BATCH_HOST_CONCURRENCY if host_concurrency is None else host_concurrency
+
+    async def run(spec) -> dict:
+        if not isinstance(spec, dict):
+            return {"error": "Query spec must be an object"}
+        unknown = sorted(set(spec) - set(QUERY_SPEC_KEYS))
+        if unknown:
+            return {"error": f"Unknown query spec keys: {unknown}. Allowed keys: {QUERY_SPEC_KEYS}"}
+        arguments = {key: value for key, value in spec.items() if key != "id"}
+        layer_name = arguments.get("layer_name")
+        if layer_name not in LAYER_MAPPING:
+            return {"error": f"Invalid layer name: {layer_name}. Available layers: {list(LAYER_MAPPING.keys())}"}
+        host = urllib.parse.urlsplit(LAYER_MAPPING[layer_name]).netloc
+        semaphore = semaphores.setdefault(host, asyncio.Semaphore(limit))
+        async with semaphore:
+            try:
+                return await query_layer(**arguments)
+            except Exception as e:
+                return {"error": f"{type(e).__name__}: {e}"}
+
+    ids = [str(spec.get("id", index)) if isinstance(spec, dict) else str(index) for index, spec in enumerate(queries)]
+    duplicates = sorted({query_id for query_id in ids if ids.count(query_id) > 1})
+    if duplicates:
+        return {"error": f"Duplicate query ids: {duplicates}"}
+    results = await asyncio.gather(*(run(spec) for spec in queries))
+    failed = sum(1 for result in results if "error" in result)
+    return {"results": dict(zip(ids, results)), "succeeded": len(results) - failed, "failed": failed}
 
-    headers = {"Accept": "application/json"}
+
+@app.tool()
+async def query_statistics(layer_name: str, statistics: Optional[list] = None, group_by: Optional[str] = None, where: str = "1=1", having: Optional[str] = None, order_by: Optional[str] = None) -> dict:
+    """
+    Computes aggregate statistics on the server, optionally grouped by one or more fields, without downloading features.
+
+    :param layer_name: The name of the layer to aggregate. Available layers: states, counties, usgs-gauges, rivers, dams, watersheds, impaired-waters, water-quality, sample-points, weather-stations, raws-stations, seismic-stations, cors-stations, storm-reports.
+    :param statistics: A list of statistics, each {"type": "count" | "sum" | "min" | "max" | "avg" | "stddev", "field": "<field name>", "alias": "<output name, optional>"}. Defaults to a count of features named "count".
+    :param group_by: Comma-separated fields to group by (e.g., "state"). Omit for one row over all matching features.
+    :param where: The WHERE clause selecting the features to aggregate. Default is "1=1".
+    :param having: Optional condition on the aggregated values (e.g., "COUNT(OBJECTID) > 100"), for layers that support it.
+    :param order_by: Optional ordering of the result rows (e.g., "count DESC").
+
+    Examples:
+    - Gauges per state: layer_name="usgs-gauges", group_by="state"
+    - Storm reports per state and type: layer_name="storm-reports", group_by="STATE,EVENT_TYPE"
+    - Average dam height in Virginia: layer_name="dams", statistics=[{"type": "avg", "field": "NID_HEIGHT", "alias": "avg_height"}], where="STATE = 'VA'"
+
+    :return: The JSON response from the server; each feature's attributes hold the group_by fields and the statistic aliases. Or {"error": "message"} if failed.
+    """
+    if layer_name not in LAYER_MAPPING:
+        return {"error": f"Invalid layer name: {layer_name}. Available layers: {list(LAYER_MAPPING.keys())}"}
+    info = await metadata.get_layer_info(LAYER_MAPPING[layer_name])
+    if "error" in info:
+        return info
+    capabilities = info.get("advancedQueryCapabilities", {})
+    if capabilities.get("supportsStatistics") is False:
+        return {"error": f"Layer does not support statistics: {layer_name}"}
+    if having and capabilities.get("supportsHavingClause") is False:
+        return {"error": f"Layer does not support a having clause: {layer_name}"}
+
+    out_statistics = []
+    for statistic in statistics or [{"type": "count", "field": fetch.object_id_field(info), "alias": "count"}]:
+        statistic_type = str(statistic.get("type", "")).lower()
+        if statistic_type not in STATISTIC_TYPES:
+            return {"error": f"Invalid statistic type: {statistic.get('type')}. Available types: {STATISTIC_TYPES}"}
+        if not statistic.get("field"):
+            return {"error": f"Statistic is missing a field: {statistic}"}
+        out_statistics.append({
+            "statisticType": statistic_type,
+            "onStatisticField": statistic["field"],
+            "outStatisticFieldName": statistic.get("alias") or f"{statistic_type}_{statistic['field']}",
+        })
 
     params = {
         "where": where,
-        "outFields": out_fields,
-        "returnCountOnly": str(return_count_only).lower()
+        "outStatistics": json.dumps(out_statistics, separators=(",", ":")),
+        "returnGeometry": "false",
+        "returnCountOnly": "false",
     }
-    if return_geometry:
-        params["returnGeometry"] = "true"
-    if spatial_filter:
-        # Parse the JSON string for geometry
-        geometry_obj = json.loads(spatial_filter)
-        if "rings" in geometry_obj:
-            # Polygon
-            params["geometry"] = urllib.parse.quote(spatial_filter)
-            params["geometryType"] = "esriGeometryPolygon"
-        else:
-            # Envelope
-            params["geometry"] = f"{geometry_obj['xmin']},{geometry_obj['ymin']},{geometry_obj['xmax']},{geometry_obj['ymax']}"
-            params["geometryType"] = "esriGeometryEnvelope"
-        params["spatialRel"] = "esriSpatialRelIntersects"
-    response = requests.post(query_url, data=params, headers=headers, timeout=30)
+    if group_by:
+        params["groupByFieldsForStatistics"] = ",".join(field.strip() for field in group_by.split(",") if field.strip())
+    if having:
+        params["having"] = having
+    if order_by:
+        params["orderByFields"] = order_by
+    return await _run_query(layer_name, params)
 
-    response.raise_for_status()
-    return response.json()
 
 @app.tool()
-def get_layer_fields(layer_name: str) -> dict:
+async def get_layer_fields(layer_name: str) -> dict:
     """
     Gets the fields of a feature layer from the Esri Living Atlas.
 
     :param layer_name: The name of the layer to get fields from. Available layers: states, counties, usgs-gauges, sample-points, weather-stations, raws-stations, seismic-stations, cors-stations, storm-reports.
-    :return: The JSON response from the server.
+    :return: The layer's fields, served from the local metadata store when available.
     """
     if layer_name not in LAYER_MAPPING:
         return {"error": f"Invalid layer name: {layer_name}. Available layers: {list(LAYER_MAPPING.keys())}"}
 
-    layer_url = LAYER_MAPPING[layer_name]
-    params = {
-        "f": "json"
-    }
-    response = requests.get(layer_url, params=params, timeout=30)
-    print(f"Raw response for {layer_name}: {response.text}")
-    response.raise_for_status()
-    return {"fields": response.json().get("fields", [])}
+    metadata.ensure_refresher(LAYER_MAPPING.values())
+    info = await metadata.get_layer_info(LAYER_MAPPING[layer_name])
+    if "error" in info:
+        return info
+    return {"fields": info.get("fields", [])}
+
+def _sql_string(value: str) -> str:
+    """Quotes a value as a SQL string literal, doubling any single quotes in it."""
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def _is_wgs84(spatial_reference: Optional[dict]) -> bool:
+    return bool(spatial_reference) and (spatial_reference.get("latestWkid") or spatial_reference.get("wkid")) == 4326
+
+
+def _boundary_result(geometry: Optional[dict], output_format: str) -> Optional[dict]:
+    """Returns a boundary geometry or envelope as is, or converted to GeoJSON (envelopes become Polygons)."""
+    if output_format == "geojson" and geometry is not None:
+        return esri_geojson.geometry_to_geojson(geometry)
+    return geometry
+
 
 @app.tool()
-def get_state_geometry(state_name: str) -> dict:
+async def get_state_geometry(state_name: str, envelope_only: bool = False, output_format: str = "esri") -> dict:
     """
     Gets the geometry of a state from the 'states' layer.
 
-    :param state_name: The name of the state (e.g., "Michigan").
-    :return: The geometry of the state in Esri JSON format.
+    :param state_name: The name of the state (e.g., "Michigan"). Abbreviations ("MI") and FIPS codes ("26") also work when the local gazetteer is installed.
+    :param envelope_only: Set to true to return only the state's bounding box as {xmin, ymin, xmax, ymax}, ready to use as a spatial_filter.
+    :param output_format: "esri" (default) for Esri JSON in the layer's spatial reference, or "geojson" for a GeoJSON geometry in WGS84 (an envelope becomes a Polygon).
+    :return: The geometry of the state in the requested format.
     """
+    if output_format not in GEOMETRY_FORMATS:
+        return {"error": f"Invalid output_format: {output_format}. Available formats: {GEOMETRY_FORMATS}"}
+    gazetteer.ensure_built(LAYER_MAPPING["states"], LAYER_MAPPING["counties"])
+    # GeoJSON is always WGS84; a gazetteer stored in another spatial reference is bypassed for it.
+    if output_format == "esri" or _is_wgs84(gazetteer.spatial_reference("states")):
+        record = gazetteer.find_state(state_name, include_geometry=not envelope_only)
+        if record is not None:
+            return _boundary_result(record["bbox"] if envelope_only else record["geometry"], output_format)
+
     states_layer_url = LAYER_MAPPING["states"]
-    where_clause = f"STATE_NAME = \'{state_name}\'"
+    where_clause = f"STATE_NAME = {_sql_string(state_name)}"
     params = {
         "where": where_clause,
         "outFields": "",
         "returnGeometry": "true",
         "f": "json"
     }
-    response = requests.get(f"{states_layer_url}/query", params=params, timeout=30)
+    if output_format == "geojson":
+        params["outSR"] = "4326"
+    response = await upstream.get(f"{states_layer_url}/query", params=params)
     response.raise_for_status()
     features = response.json().get("features", [])
     if features:
-        return features[0]["geometry"]
+        geometry = features[0]["geometry"]
+        return _boundary_result(gazetteer.envelope(geometry) if envelope_only else geometry, output_format)
     return {"error": f"State \'{state_name}\' not found or has no geometry."}
 
 @app.tool()
-def query_geojson(layer_name: str, where: str = "1=1", out_fields: str = "*", limit: int = 1000) -> str:
+async def get_county_geometry(county_name: str, state: str, envelope_only: bool = False, output_format: str = "esri") -> dict:
+    """
+    Gets the geometry of a county from the 'counties' layer.
+
+    :param county_name: The name of the county (e.g., "Kent" or "Kent County").
+    :param state: The state the county is in, as a name ("Michigan"), abbreviation ("MI") or FIPS code ("26").
+    :param envelope_only: Set to true to return only the county's bounding box as {xmin, ymin, xmax, ymax}, ready to use as a spatial_filter.
+    :param output_format: "esri" (default) for Esri JSON in the layer's spatial reference, or "geojson" for a GeoJSON geometry in WGS84 (an envelope becomes a Polygon).
+    :return: The geometry of the county in the requested format.
+    """
+    if output_format not in GEOMETRY_FORMATS:
+        return {"error": f"Invalid output_format: {output_format}. Available formats: {GEOMETRY_FORMATS}"}
+    gazetteer.ensure_built(LAYER_MAPPING["states"], LAYER_MAPPING["counties"])
+    if output_format == "esri" or _is_wgs84(gazetteer.spatial_reference("counties")):
+        record = gazetteer.find_county(county_name, state, include_geometry=not envelope_only)
+        if record is not None:
+            return _boundary_result(record["bbox"] if envelope_only else record["geometry"], output_format)
+
+    state_record = gazetteer.find_state(state, include_geometry=False)
+    if state_record is not None:
+        state_fips = state_record["fips"]
+    elif state.isdigit():
+        state_fips = state
+    else:
+        state_key = "STATE_ABBR" if len(state) == 2 else "STATE_NAME"
+        params = {"where": f"{state_key} = {_sql_string(state)}", "outFields": "STATE_FIPS", "returnGeometry": "false", "f": "json"}
+        response = await upstream.get(f"{LAYER_MAPPING['states']}/query", params=params)
+        response.raise_for_status()
+        features = response.json().get("features", [])
+        if not features:
+            return {"error": f"State '{state}' not found."}
+        state_fips = features[0]["attributes"]["STATE_FIPS"]
+
+    name = county_name.strip()
+    if name.lower().endswith(" county"):
+        name = name[: -len(" county")]
+    params = {
+        "where": f"NAME = {_sql_string(name)} AND STATEFP = {_sql_string(state_fips)}",
+        "outFields": "",
+        "returnGeometry": "true",
+        "f": "json"
+    }
+    if output_format == "geojson":
+        params["outSR"] = "4326"
+    response = await upstream.get(f"{LAYER_MAPPING['counties']}/query", params=params)
+    response.raise_for_status()
+    features = response.json().get("features", [])
+    if features:
+        geometry = features[0]["geometry"]
+        return _boundary_result(gazetteer.envelope(geometry) if envelope_only else geometry, output_format)
+    return {"error": f"County '{county_name}' in '{state}' not found or has no geometry."}
+
+@app.tool()
+async def query_geojson(layer_name: str, where: str = "1=1", out_fields: str = "*", limit: int = 1000, strategy: str = "single", precision: Optional[int] = None, indent: Optional[int] = None, resolution: Optional[float] = None) -> str:
     """
     Queries a feature layer and returns the results as a GeoJSON string.
 
@@ -212,13 +724,16 @@ def query_geojson(layer_name: str, where: str = "1=1", out_fields: str = "*", li
     :param where: The WHERE clause for the query (e.g., "STATE = 'MI'", "COUNTRY = 'United States'").
     :param out_fields: Comma-separated list of fields to return (e.g., "NAME,STATE"). Use "*" for all.
     :param limit: Maximum number of features to return (default 1000).
+    :param strategy: How to fetch results: "single", "paged", "objectids" or "auto" (see query_layer). Multi-request strategies can return more than the layer's maxRecordCount, up to `limit`.
+    :param precision: Number of decimals to round coordinates to (e.g. 6 is about 10 cm). Default keeps full precision.
+    :param indent: Indentation for pretty-printed output. Default is compact JSON.
+    :param resolution: Optional target map resolution in meters per pixel (see query_layer). Geometries are generalized upstream to that detail.
     :return: A GeoJSON FeatureCollection as a string, or error message.
     """
     if layer_name not in LAYER_MAPPING:
         return f"Error: Invalid layer name '{layer_name}'. Available: {list(LAYER_MAPPING.keys())}"
-
-    layer_url = LAYER_MAPPING[layer_name]
-    query_url = f"{layer_url}/query?f=json"
+    if resolution is not None and resolution <= 0:
+        return f"Error: Invalid resolution {resolution}. It must be a positive number of meters per pixel."
 
     params = {
         "where": where,
@@ -229,55 +744,32 @@ def query_geojson(layer_name: str, where: str = "1=1", out_fields: str = "*", li
     }
 
     try:
-        response = requests.post(query_url, data=params, headers={"Accept": "application/json"}, timeout=30)
-        response.raise_for_status()
-        data = response.json()
+        if resolution:
+            params.update(await _resolution_params(layer_name, resolution, 4326))
+        data = await _run_query(layer_name, params, strategy, max_features=limit)
 
         if "error" in data:
             return f"Query error: {data['error']}"
 
-        features = data.get("features", [])
-        geojson = {
-            "type": "FeatureCollection",
-            "features": []
-        }
+        with tracing.span("geojson.convert", features=len(data.get("features", []))):
+            features = esri_geojson.features_to_geojson(data.get("features", []), data.get("hasZ", False), precision)
+        with tracing.span("geojson.serialize") as serialize_span:
+            content = geojson_writer.dumps_feature_collection(features, indent)
+            if serialize_span is not None:
+                serialize_span.set(bytes=len(content))
+        return content
+    except Exception as e:
+        return f"Error: {str(e)}"
 
-        for feature in features:
-            geom = feature.get("geometry", {})
-            props = feature.get("attributes", {})
-
-            # Convert Esri geometry to GeoJSON
-            if "x" in geom and "y" in geom:
-                # Point
-                geojson_geom = {
-                    "type": "Point",
-                    "coordinates": [geom["x"], geom["y"]]
-                }
-            elif "rings" in geom:
-                # Polygon
-                geojson_geom = {
-                    "type": "Polygon",
-                    "coordinates": geom["rings"]
-                }
-            elif "paths" in geom:
-                # Polyline
-                geojson_geom = {
-                    "type": "LineString",
-                    "coordinates": geom["paths"][0] if geom["paths"] else []
-                }
-            else:
-                geojson_geom = None
 
-            if geojson_geom:
-                geojson["features"].append({
-                    "type": "Feature",
-                    "geometry": geojson_geom,
-                    "properties": props
-                })
+@app.tool()
+def get_upstream_stats() -> dict:
+    """
+    Gets connection pool and response cache statistics for the upstream ArcGIS REST hosts.
 
-        return json.dumps(geojson, indent=4)
-    except Exception as e:
-        return f"Error: {str(e)}"
+    :return: Per-host pool limits, open/idle connections, request, error, retry and hedge counts, circuit breaker state, p50/p95 latency, HTTP versions used, per-host rate limiter state (current rate, queued requests, throttling responses), response cache hit/miss counters, metadata store size, and local replica sizes and ages, and per-layer sync watermarks and last delta sizes.
+    """
+    return {**upstream.pool_stats(), "response_cache": response_cache.stats(), "metadata": metadata.stats(), "replicas": replica.stats(), "sync": sync.stats(), "tracing": tracing.stats()}
 
 
 @app.tool()
@@ -895,6 +1387,6 @@ def create_embeddable_water_map(state: str) -> str:
 if __name__ == "__main__":
     import sys
     if "--http" in sys.argv:
-        app.run(transport="http", port=8000)
+        app.run(transport="http", port=int(os.environ.get("ESRI_MCP_HTTP_PORT", "8000")))
     else:
         app.run()
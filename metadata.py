@@ -0,0 +1,136 @@
+"""
+Persistent layer metadata store.
+
+Layer definitions (fields, geometry type, maxRecordCount, capabilities,
+extent, ...) rarely change, so they are kept in a SQLite database and in
+memory instead of being fetched from upstream on every call. The database
+survives restarts; a background task revalidates entries older than
+ESRI_MCP_METADATA_REFRESH seconds with conditional requests
+(If-None-Match / If-Modified-Since), so unchanged layers cost a 304.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+
+import upstream
+
+DB_PATH = os.environ.get("ESRI_MCP_METADATA_DB", os.path.expanduser("~/.cache/esri-mcp/metadata.sqlite"))
+REFRESH_INTERVAL = float(os.environ.get("ESRI_MCP_METADATA_REFRESH", str(24 * 3600)))
+
+# Keys of the layer definition that are kept; the rest (drawingInfo, etc.) is dropped.
+METADATA_KEYS = (
+    "name", "type", "geometryType", "objectIdField", "globalIdField", "displayField", "fields",
+    "maxRecordCount", "capabilities", "advancedQueryCapabilities", "supportedQueryFormats",
+    "extent", "editingInfo", "editFieldsInfo", "currentVersion",
+)
+
+logger = logging.getLogger(__name__)
+
+_memory = {}
+_connection = None
+_refresh_task = None
+
+
+def _db() -> sqlite3.Connection:
+    global _connection
+    if _connection is None:
+        os.makedirs(os.path.dirname(DB_PATH) or ".", exist_ok=True)
+        _connection = sqlite3.connect(DB_PATH, check_same_thread=False)
+        _connection.execute(
+            "CREATE TABLE IF NOT EXISTS layer_metadata ("
+            "url TEXT PRIMARY KEY, body TEXT NOT NULL, etag TEXT, last_modified TEXT, fetched_at REAL NOT NULL)"
+        )
+        _connection.commit()
+    return _connection
+
+
+def _load(url: str):
+    row = _db().execute(
+        "SELECT body, etag, last_modified, fetched_at FROM layer_metadata WHERE url = ?", (url,)
+    ).fetchone()
+    if row is None:
+        return None
+    entry = {"info": json.loads(row[0]), "etag": row[1], "last_modified": row[2], "fetched_at": row[3]}
+    _memory[url] = entry
+    return entry
+
+
+def _save(url: str, info: dict, etag, last_modified) -> dict:
+    entry = {"info": info, "etag": etag, "last_modified": last_modified, "fetched_at": time.time()}
+    _db().execute(
+        "INSERT OR REPLACE INTO layer_metadata (url, body, etag, last_modified, fetched_at) VALUES (?, ?, ?, ?, ?)",
+        (url, json.dumps(info), etag, last_modified, entry["fetched_at"]),
+    )
+    _db().commit()
+    _memory[url] = entry
+    return entry
+
+
+def _touch(url: str) -> None:
+    entry = _memory[url]
+    entry["fetched_at"] = time.time()
+    _db().execute("UPDATE layer_metadata SET fetched_at = ? WHERE url = ?", (entry["fetched_at"], url))
+    _db().commit()
+
+
+async def refresh(url: str) -> dict:
+    """Revalidates one layer's metadata upstream and returns the current definition."""
+    entry = _memory.get(url) or _load(url)
+    headers = {}
+    if entry is not None:
+        if entry["etag"]:
+            headers["If-None-Match"] = entry["etag"]
+        if entry["last_modified"]:
+            headers["If-Modified-Since"] = entry["last_modified"]
+    response = await upstream.get(url, params={"f": "json"}, headers=headers)
+    if response.status_code == 304 and entry is not None:
+        _touch(url)
+        return entry["info"]
+    response.raise_for_status()
+    body = response.json()
+    if "error" in body:
+        return body
+    info = {key: body[key] for key in METADATA_KEYS if key in body}
+    _save(url, info, response.headers.get("ETag"), response.headers.get("Last-Modified"))
+    return info
+
+
+async def get_layer_info(url: str) -> dict:
+    """Returns the stored layer definition, fetching it upstream only when it has never been seen."""
+    entry = _memory.get(url) or _load(url)
+    if entry is not None:
+        return entry["info"]
+    return await refresh(url)
+
+
+async def _refresh_loop(urls: list) -> None:
+    while True:
+        for url in urls:
+            # Layers never requested stay lazy; only known entries are revalidated.
+            entry = _memory.get(url) or _load(url)
+            if entry is not None and time.time() - entry["fetched_at"] >= REFRESH_INTERVAL:
+                try:
+                    await refresh(url)
+                except Exception as e:
+                    logger.warning("Metadata refresh failed for %s: %s", url, e)
+        await asyncio.sleep(min(REFRESH_INTERVAL, 3600))
+
+
+def ensure_refresher(urls) -> None:
+    """Starts the background revalidation task on the running loop if it is not already running."""
+    global _refresh_task
+    if _refresh_task is None or _refresh_task.done() or _refresh_task.get_loop() is not asyncio.get_running_loop():
+        _refresh_task = asyncio.get_running_loop().create_task(_refresh_loop(list(urls)))
+
+
+def stats() -> dict:
+    now = time.time()
+    return {
+        "db_path": DB_PATH,
+        "layers": len(_memory),
+        "oldest_age_seconds": round(now - min(entry["fetched_at"] for entry in _memory.values()), 1) if _memory else None,
+    }
@@ -0,0 +1,146 @@
+"""
+Prometheus text-format metrics for the HTTP transport.
+
+Counters and histograms are plain dicts keyed by label values, so recording
+a sample is a dict lookup and a few additions; nothing is formatted until
+/metrics is scraped. Gauges that other modules already track (pool usage,
+cache counters, rate limiter state) are read at scrape time through
+collectors registered with `register_collector`.
+"""
+
+import bisect
+import time
+from typing import Callable, Optional
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_metrics = []
+_collectors = []
+# Layer URL -> layer name, for labelling upstream requests.
+_layers = {}
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = labels
+        self.values = {}
+        _metrics.append(self)
+
+    def inc(self, labels: tuple = (), amount: float = 1) -> None:
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for labels, value in list(self.values.items()):
+            lines.append(f"{self.name}{_labels(self.label_names, labels)} {_number(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = labels
+        self.buckets = tuple(buckets)
+        # labels -> [per-bucket counts (last is +Inf), sum, count]
+        self.values = {}
+        _metrics.append(self)
+
+    def observe(self, labels: tuple, value: float) -> None:
+        entry = self.values.get(labels)
+        if entry is None:
+            entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total, count) in list(self.values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                bound_label = 'le="' + _number(bound) + '"'
+                lines.append(f"{self.name}_bucket{_labels(self.label_names, labels, bound_label)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, labels)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, labels)} {count}")
+        return lines
+
+
+tool_calls = Counter("esri_mcp_tool_calls_total", "Tool calls by tool and outcome.", ("tool", "status"))
+tool_duration = Histogram("esri_mcp_tool_duration_seconds", "Tool call latency.", ("tool",))
+tool_bytes_sent = Counter("esri_mcp_tool_response_bytes_total", "Bytes of tool results returned to clients.", ("tool",))
+upstream_duration = Histogram("esri_mcp_upstream_request_duration_seconds", "Upstream request latency.", ("host", "layer"))
+upstream_bytes = Counter("esri_mcp_upstream_bytes_received_total", "Response bytes received from upstream.", ("host", "layer"))
+upstream_errors = Counter("esri_mcp_upstream_errors_total", "Upstream requests that failed or returned 4xx/5xx.", ("host", "layer"))
+
+
+def register_layers(layer_mapping: dict) -> None:
+    """Registers layer name -> URL so upstream series can be labelled by layer."""
+    _layers.update({url.rstrip("/"): name for name, url in layer_mapping.items()})
+
+
+def layer_for(url: str) -> str:
+    path = url.split("?", 1)[0].rstrip("/")
+    if path.endswith("/query"):
+        path = path[:-len("/query")]
+    return _layers.get(path, "")
+
+
+def observe_upstream(host: str, url: str, seconds: Optional[float], received: int = 0, error: bool = False) -> None:
+    labels = (host, layer_for(url))
+    if seconds is not None:
+        upstream_duration.observe(labels, seconds)
+    if received:
+        upstream_bytes.inc(labels, received)
+    if error:
+        upstream_errors.inc(labels)
+
+
+def observe_tool(tool: str, started: float, ok: bool, sent: int) -> None:
+    tool_calls.inc((tool, "ok" if ok else "error"))
+    tool_duration.observe((tool,), time.perf_counter() - started)
+    if sent:
+        tool_bytes_sent.inc((tool,), sent)
+
+
+def register_collector(collector: Callable[[], list]) -> None:
+    """
+    Adds a scrape-time collector returning [(name, type, help, [(labels dict, value), ...]), ...]
+    for values that are already tracked elsewhere.
+    """
+    _collectors.append(collector)
+
+
+def render() -> str:
+    """Returns every metric in the Prometheus text exposition format."""
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    for collector in _collectors:
+        for name, metric_type, help_text, samples in collector():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for labels, value in samples:
+                if value is not None:
+                    lines.append(f"{name}{_labels(tuple(labels), tuple(labels.values()))} {_number(value)}")
+    return "\n".join(lines) + "\n"
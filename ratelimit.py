@@ -0,0 +1,187 @@
+"""
+Per-host outbound rate limiting for upstream requests.
+
+Every upstream host gets a token bucket (`rate` requests per second, up to
+`burst` at once) and a cap on requests in flight (`max_in_flight`), from
+ESRI_MCP_HOST_RATE / ESRI_MCP_HOST_BURST / ESRI_MCP_HOST_MAX_IN_FLIGHT or per
+host via HOST_LIMITS. Requests that have to wait are queued per MCP session
+and admitted round-robin across sessions, so one session's paged or fan-out
+query cannot starve the others.
+
+A 429, or a 503 with Retry-After, pauses the host for the Retry-After delay
+(one second if absent) and halves its rate; each later success adds back a
+twentieth of the configured rate until it is reached again.
+"""
+
+import asyncio
+import contextvars
+import os
+import time
+from collections import OrderedDict, deque
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+DEFAULT_RATE = float(os.environ.get("ESRI_MCP_HOST_RATE", "20"))
+DEFAULT_BURST = int(os.environ.get("ESRI_MCP_HOST_BURST", "40"))
+DEFAULT_MAX_IN_FLIGHT = int(os.environ.get("ESRI_MCP_HOST_MAX_IN_FLIGHT", "16"))
+DEFAULT_RETRY_AFTER = 1.0
+# The rate never drops below this fraction of the configured rate.
+MIN_RATE_FRACTION = 0.05
+RECOVERY_FRACTION = 0.05
+
+# Per-host overrides: {"mapservices.weather.noaa.gov": {"rate": 5, "burst": 10, "max_in_flight": 4}}
+HOST_LIMITS = {}
+
+# The MCP session a request is made for; set by the server for each tool call.
+session = contextvars.ContextVar("esri_mcp_session", default=None)
+
+_limiters = {}
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds to wait from a Retry-After header given as seconds or an HTTP date."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class HostLimiter:
+    def __init__(self, host: str, rate: float, burst: int, max_in_flight: int):
+        self.host = host
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.max_in_flight = max_in_flight
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.in_flight = 0
+        self.paused_until = 0.0
+        # Session -> waiting futures, in round-robin order.
+        self.queues = OrderedDict()
+        self.timer = None
+        self.loop = asyncio.get_running_loop()
+        self.stats = {"admitted": 0, "queued": 0, "throttled": 0, "wait_seconds": 0.0}
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _has_capacity(self, now: float) -> bool:
+        return self.in_flight < self.max_in_flight and now >= self.paused_until and self.tokens >= 1
+
+    def _admit(self) -> None:
+        self.tokens -= 1
+        self.in_flight += 1
+        self.stats["admitted"] += 1
+
+    def _wake(self) -> None:
+        self.timer = None
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        now = time.monotonic()
+        self._refill(now)
+        while self.queues and self._has_capacity(now):
+            session_id, queue = next(iter(self.queues.items()))
+            future = queue.popleft()
+            if queue:
+                self.queues.move_to_end(session_id)
+            else:
+                del self.queues[session_id]
+            if not future.done():
+                self._admit()
+                future.set_result(None)
+        if not self.queues or self.in_flight >= self.max_in_flight or self.timer is not None:
+            # Releases re-run the dispatch when in-flight slots are the limit.
+            return
+        wait = max(self.paused_until - now, (1 - self.tokens) / self.rate, 0.001)
+        self.timer = self.loop.call_later(wait, self._wake)
+
+    async def acquire(self) -> None:
+        """Waits for an in-flight slot and a token, behind other sessions' queued requests in round-robin order."""
+        now = time.monotonic()
+        self._refill(now)
+        if not self.queues and self._has_capacity(now):
+            self._admit()
+            return
+        self.stats["queued"] += 1
+        future = self.loop.create_future()
+        self.queues.setdefault(session.get(), deque()).append(future)
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Admitted just as the caller gave up.
+                self.release()
+            else:
+                future.cancel()
+            raise
+        finally:
+            self.stats["wait_seconds"] += time.monotonic() - now
+
+    def try_acquire(self) -> bool:
+        """Takes a slot only if one is free right now and nobody is queued (used for optional extra requests)."""
+        now = time.monotonic()
+        self._refill(now)
+        if self.queues or not self._has_capacity(now):
+            return False
+        self._admit()
+        return True
+
+    def release(self) -> None:
+        self.in_flight -= 1
+        self._dispatch()
+
+    def feedback(self, status_code: int, retry_after: Optional[str]) -> None:
+        """Adapts the rate to a response: backs off on throttling, recovers on success."""
+        delay = parse_retry_after(retry_after)
+        if status_code == 429 or (status_code == 503 and delay is not None):
+            self.stats["throttled"] += 1
+            self.rate = max(self.max_rate * MIN_RATE_FRACTION, self.rate / 2)
+            self.tokens = 0.0
+            self.paused_until = max(self.paused_until, time.monotonic() + (DEFAULT_RETRY_AFTER if delay is None else delay))
+        elif status_code < 400 and self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate + self.max_rate * RECOVERY_FRACTION)
+
+
+def get_limiter(host: str) -> HostLimiter:
+    """Returns the limiter for `host`, creating it on first use."""
+    limiter = _limiters.get(host)
+    # Queued futures belong to the loop that created them.
+    if limiter is not None and limiter.loop is asyncio.get_running_loop():
+        return limiter
+    limits = HOST_LIMITS.get(host, {})
+    limiter = HostLimiter(
+        host,
+        limits.get("rate", DEFAULT_RATE),
+        limits.get("burst", DEFAULT_BURST),
+        limits.get("max_in_flight", DEFAULT_MAX_IN_FLIGHT),
+    )
+    _limiters[host] = limiter
+    return limiter
+
+
+def stats() -> dict:
+    result = {}
+    for host, limiter in list(_limiters.items()):
+        result[host] = {
+            "rate": round(limiter.rate, 3),
+            "max_rate": limiter.max_rate,
+            "burst": limiter.burst,
+            "max_in_flight": limiter.max_in_flight,
+            "in_flight": limiter.in_flight,
+            "waiting": sum(len(queue) for queue in limiter.queues.values()),
+            "waiting_sessions": len(limiter.queues),
+            "paused_seconds": round(max(0.0, limiter.paused_until - time.monotonic()), 3),
+            **limiter.stats,
+        }
+        result[host]["wait_seconds"] = round(result[host]["wait_seconds"], 3)
+    return result
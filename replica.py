@@ -0,0 +1,423 @@
+"""
+Local replicas of point layers.
+
+Layers listed in ESRI_MCP_REPLICA_LAYERS are copied into a compact columnar
+store (one NumPy array per numeric attribute plus x/y coordinates, saved as
+.npz under ESRI_MCP_REPLICA_DIR) with a uniform grid spatial index. They are
+kept up to date by the sync engine (see sync.py), which hands each replica
+only the features added, edited or deleted since its last sync.
+
+`get` returns None when a layer is not replicated or its replica is older
+than ESRI_MCP_REPLICA_MAX_AGE. `PointReplica.query` answers attribute and
+envelope/polygon queries in upstream's JSON shape and raises UnsupportedQuery
+whenever it cannot answer exactly like upstream would: the where clause uses
+syntax the local evaluator does not support (only AND-ed comparisons and IN
+lists) or the spatial filter is in a different spatial reference. Callers
+fall back to upstream in both cases. Whether upstream string comparisons
+ignore case depends on its database, so they only ignore case here for
+layers in ESRI_MCP_REPLICA_CASE_INSENSITIVE; for other layers a comparison
+whose answer would depend on case raises UnsupportedQuery too. Layers that
+are not point layers are skipped with an error (see `stats()`) and always
+queried upstream.
+"""
+
+import json
+import logging
+import math
+import os
+import re
+import time
+from typing import Optional
+
+import numpy as np
+
+import fetch
+import geometry
+import sync
+
+REPLICA_DIR = os.environ.get("ESRI_MCP_REPLICA_DIR", os.path.expanduser("~/.cache/esri-mcp/replicas"))
+REPLICA_LAYERS = [name.strip() for name in os.environ.get("ESRI_MCP_REPLICA_LAYERS", "").split(",") if name.strip()]
+MAX_AGE = float(os.environ.get("ESRI_MCP_REPLICA_MAX_AGE", str(2 * sync.SYNC_INTERVAL)))
+# Replicated layers whose upstream string comparisons are known to ignore case.
+CASE_INSENSITIVE_LAYERS = [name.strip() for name in os.environ.get("ESRI_MCP_REPLICA_CASE_INSENSITIVE", "").split(",") if name.strip()]
+
+NUMERIC_FIELD_TYPES = {
+    "esriFieldTypeOID", "esriFieldTypeSmallInteger", "esriFieldTypeInteger", "esriFieldTypeBigInteger",
+    "esriFieldTypeSingle", "esriFieldTypeDouble", "esriFieldTypeDate",
+}
+INTEGER_FIELD_TYPES = {
+    "esriFieldTypeOID", "esriFieldTypeSmallInteger", "esriFieldTypeInteger", "esriFieldTypeBigInteger", "esriFieldTypeDate",
+}
+# Target number of points per grid cell.
+POINTS_PER_CELL = 16
+
+logger = logging.getLogger(__name__)
+
+
+class UnsupportedQuery(Exception):
+    pass
+
+
+class GridIndex:
+    """Uniform grid over the point extent; points are stored sorted by cell."""
+
+    def __init__(self, xs: np.ndarray, ys: np.ndarray):
+        self.xs = xs
+        self.ys = ys
+        count = len(xs)
+        if count:
+            self.xmin, self.xmax = float(xs.min()), float(xs.max())
+            self.ymin, self.ymax = float(ys.min()), float(ys.max())
+        else:
+            self.xmin = self.xmax = self.ymin = self.ymax = 0.0
+        self.columns = self.rows = max(1, int(math.sqrt(count / POINTS_PER_CELL)))
+        self.cell_width = (self.xmax - self.xmin) / self.columns or 1.0
+        self.cell_height = (self.ymax - self.ymin) / self.rows or 1.0
+        cells = self._column(xs) + self._row(ys) * self.columns
+        self.order = np.argsort(cells, kind="stable")
+        self.cell_starts = np.searchsorted(cells[self.order], np.arange(self.columns * self.rows + 1))
+
+    def _column(self, x):
+        return np.clip(((x - self.xmin) / self.cell_width).astype(np.int64), 0, self.columns - 1)
+
+    def _row(self, y):
+        return np.clip(((y - self.ymin) / self.cell_height).astype(np.int64), 0, self.rows - 1)
+
+    def query(self, xmin: float, ymin: float, xmax: float, ymax: float) -> np.ndarray:
+        """Indices of the points inside the envelope (inclusive)."""
+        if not len(self.xs) or xmax < self.xmin or xmin > self.xmax or ymax < self.ymin or ymin > self.ymax:
+            return np.empty(0, dtype=np.int64)
+        first_column, last_column = self._column(np.array([xmin, xmax]))
+        first_row, last_row = self._row(np.array([ymin, ymax]))
+        slices = []
+        for row in range(first_row, last_row + 1):
+            start = self.cell_starts[row * self.columns + first_column]
+            end = self.cell_starts[row * self.columns + last_column + 1]
+            slices.append(self.order[start:end])
+        candidates = np.concatenate(slices)
+        x = self.xs[candidates]
+        y = self.ys[candidates]
+        return np.sort(candidates[(x >= xmin) & (x <= xmax) & (y >= ymin) & (y <= ymax)])
+
+
+_TOKEN = re.compile(r"\s*(?:(?P<string>'(?:[^']|'')*')|(?P<number>-?\d+(?:\.\d+)?)|(?P<op><>|!=|<=|>=|=|<|>|\(|\)|,)|(?P<word>[A-Za-z_][A-Za-z0-9_]*))")
+
+
+def _tokenize(where: str) -> list:
+    tokens = []
+    position = 0
+    where = where.strip()
+    while position < len(where):
+        match = _TOKEN.match(where, position)
+        if not match or match.end() == position:
+            raise UnsupportedQuery(where)
+        kind = match.lastgroup
+        text = match.group(kind)
+        if kind == "string":
+            tokens.append(("value", text[1:-1].replace("''", "'")))
+        elif kind == "number":
+            tokens.append(("value", float(text)))
+        elif kind == "word" and text.upper() in ("AND", "IN", "OR", "NOT", "LIKE", "IS", "NULL", "BETWEEN"):
+            tokens.append(("keyword", text.upper()))
+        else:
+            tokens.append((kind, text))
+        position = match.end()
+    return tokens
+
+
+class PointReplica:
+    def __init__(self, layer_name: str, fields: list, object_id_field: str, spatial_reference: Optional[dict],
+                 xs: np.ndarray, ys: np.ndarray, columns: dict, synced_at: float, watermark: Optional[int] = None):
+        self.layer_name = layer_name
+        self.fields = fields
+        self.object_id_field = object_id_field
+        self.spatial_reference = spatial_reference
+        self.xs = xs
+        self.ys = ys
+        self.columns = columns
+        self.synced_at = synced_at
+        self.watermark = watermark
+        self.field_types = {field["name"]: field.get("type") for field in fields}
+        self._field_names = {field["name"].lower(): field["name"] for field in fields}
+        self._folded = {}
+        self.index = GridIndex(xs, ys)
+
+    @classmethod
+    def from_features(cls, layer_name: str, info: dict, data: dict, watermark: Optional[int] = None) -> "PointReplica":
+        features = [feature for feature in data.get("features", []) if feature.get("geometry")]
+        fields = info.get("fields") or data.get("fields") or []
+        xs = np.array([feature["geometry"]["x"] for feature in features], dtype=float)
+        ys = np.array([feature["geometry"]["y"] for feature in features], dtype=float)
+        columns = {}
+        for field in fields:
+            name = field["name"]
+            values = [feature["attributes"].get(name) for feature in features]
+            if field.get("type") in NUMERIC_FIELD_TYPES:
+                columns[name] = np.array([np.nan if value is None else value for value in values], dtype=float)
+            else:
+                columns[name] = np.array(values, dtype=object)
+        spatial_reference = data.get("spatialReference") or info.get("extent", {}).get("spatialReference")
+        return cls(layer_name, fields, fetch.object_id_field(info), spatial_reference, xs, ys, columns, time.time(), watermark)
+
+    def merged(self, keep: np.ndarray, other: "PointReplica") -> "PointReplica":
+        """New replica holding the rows selected by `keep` followed by every row of `other`."""
+        columns = {name: np.concatenate((column[keep], other.columns[name])) for name, column in self.columns.items()}
+        return PointReplica(
+            self.layer_name, self.fields, self.object_id_field, other.spatial_reference or self.spatial_reference,
+            np.concatenate((self.xs[keep], other.xs)), np.concatenate((self.ys[keep], other.ys)), columns,
+            other.synced_at, other.watermark,
+        )
+
+    def save(self, path: str) -> None:
+        numeric = {f"num_{name}": column for name, column in self.columns.items() if column.dtype != object}
+        text = {name: column.tolist() for name, column in self.columns.items() if column.dtype == object}
+        meta = {
+            "layer_name": self.layer_name,
+            "fields": self.fields,
+            "object_id_field": self.object_id_field,
+            "spatial_reference": self.spatial_reference,
+            "synced_at": self.synced_at,
+            "watermark": self.watermark,
+            "text_columns": text,
+        }
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp.npz"
+        np.savez_compressed(
+            tmp_path, xs=self.xs, ys=self.ys, meta=np.frombuffer(json.dumps(meta).encode(), dtype=np.uint8), **numeric
+        )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "PointReplica":
+        with np.load(path) as archive:
+            meta = json.loads(archive["meta"].tobytes())
+            columns = {key[len("num_"):]: archive[key] for key in archive.files if key.startswith("num_")}
+            xs, ys = archive["xs"], archive["ys"]
+        for name, values in meta["text_columns"].items():
+            columns[name] = np.array(values, dtype=object)
+        return cls(meta["layer_name"], meta["fields"], meta["object_id_field"], meta["spatial_reference"],
+                   xs, ys, columns, meta["synced_at"], meta.get("watermark"))
+
+    def age(self) -> float:
+        return time.time() - self.synced_at
+
+    def _field(self, name: str) -> str:
+        field = self._field_names.get(name.lower())
+        if field is None:
+            raise UnsupportedQuery(f"Unknown field: {name}")
+        return field
+
+    def _folded_column(self, name: str) -> np.ndarray:
+        """The string column `name` lowercased, for case-insensitive comparisons."""
+        folded = self._folded.get(name)
+        if folded is None:
+            folded = self._folded[name] = np.array([item.lower() if isinstance(item, str) else item for item in self.columns[name]], dtype=object)
+        return folded
+
+    def _comparison(self, name: str, operator: str, value) -> np.ndarray:
+        column = self.columns[name]
+        if column.dtype != object and not isinstance(value, float):
+            raise UnsupportedQuery("String compared with numeric field")
+        if column.dtype == object and isinstance(value, float):
+            raise UnsupportedQuery("Number compared with string field")
+        if column.dtype == object and operator not in ("=", "<>", "!="):
+            raise UnsupportedQuery("Ordering comparison on string field")
+        if column.dtype == object:
+            return self._string_comparison(name, operator, value)
+        not_null = ~np.isnan(column)
+        with np.errstate(invalid="ignore"):
+            if operator == "=":
+                result = column == value
+            elif operator in ("<>", "!="):
+                result = column != value
+            elif operator == "<":
+                result = column < value
+            elif operator == ">":
+                result = column > value
+            elif operator == "<=":
+                result = column <= value
+            else:
+                result = column >= value
+        # SQL comparisons with NULL are never true.
+        return np.asarray(result, dtype=bool) & not_null
+
+    def _string_comparison(self, name: str, operator: str, value: str) -> np.ndarray:
+        """
+        Evaluates = or <> on a string column.
+
+        Upstream's collation decides whether case matters. Layers listed in
+        CASE_INSENSITIVE_LAYERS compare lowercased values; for any other layer
+        the comparison is only answered when both collations agree on every row.
+        """
+        not_null = np.array([item is not None for item in self.columns[name]], dtype=bool)
+        folded = np.asarray(self._folded_column(name) == value.lower(), dtype=bool)
+        if self.layer_name not in CASE_INSENSITIVE_LAYERS:
+            exact = np.asarray(self.columns[name] == value, dtype=bool)
+            if not np.array_equal(exact & not_null, folded & not_null):
+                raise UnsupportedQuery(f"Comparison on {name} depends on upstream's case sensitivity")
+        result = folded if operator == "=" else ~folded
+        # SQL comparisons with NULL are never true.
+        return result & not_null
+
+    def where_mask(self, where: str) -> np.ndarray:
+        """Evaluates a where clause of AND-ed comparisons / IN lists; raises UnsupportedQuery otherwise."""
+        tokens = _tokenize(where)
+        mask = np.ones(len(self.xs), dtype=bool)
+        if not tokens or [text for _, text in tokens] == [1.0, "=", 1.0]:
+            return mask
+        position = 0
+        while position < len(tokens):
+            kind, text = tokens[position]
+            if kind != "word":
+                raise UnsupportedQuery(where)
+            name = self._field(text)
+            kind, operator = tokens[position + 1] if position + 1 < len(tokens) else (None, None)
+            if kind == "op" and operator in ("=", "<>", "!=", "<", ">", "<=", ">="):
+                value_kind, value = tokens[position + 2] if position + 2 < len(tokens) else (None, None)
+                if value_kind != "value":
+                    raise UnsupportedQuery(where)
+                mask &= self._comparison(name, operator, value)
+                position += 3
+            elif kind == "keyword" and operator == "IN":
+                if position + 2 >= len(tokens) or tokens[position + 2] != ("op", "("):
+                    raise UnsupportedQuery(where)
+                position += 3
+                matched = np.zeros(len(self.xs), dtype=bool)
+                while True:
+                    value_kind, value = tokens[position] if position < len(tokens) else (None, None)
+                    if value_kind != "value":
+                        raise UnsupportedQuery(where)
+                    matched |= self._comparison(name, "=", value)
+                    separator = tokens[position + 1] if position + 1 < len(tokens) else None
+                    position += 2
+                    if separator == ("op", ")"):
+                        break
+                    if separator != ("op", ","):
+                        raise UnsupportedQuery(where)
+                mask &= matched
+            else:
+                raise UnsupportedQuery(where)
+            if position < len(tokens):
+                if tokens[position] != ("keyword", "AND"):
+                    raise UnsupportedQuery(where)
+                position += 1
+        return mask
+
+    def _spatial_candidates(self, spatial_filter: Optional[dict]) -> Optional[np.ndarray]:
+        if spatial_filter is None:
+            return None
+        filter_reference = spatial_filter.get("spatialReference")
+        if filter_reference:
+            own = self.spatial_reference or {}
+            filter_wkid = filter_reference.get("latestWkid") or filter_reference.get("wkid")
+            if filter_wkid not in (own.get("latestWkid"), own.get("wkid")):
+                raise UnsupportedQuery("Spatial filter is in a different spatial reference")
+        if "rings" in spatial_filter:
+            envelope = geometry.polygon_envelope(spatial_filter)
+        else:
+            envelope = spatial_filter
+        indices = self.index.query(envelope["xmin"], envelope["ymin"], envelope["xmax"], envelope["ymax"])
+        if "rings" in spatial_filter:
+            indices = indices[geometry.points_in_polygon(self.xs[indices], self.ys[indices], spatial_filter)]
+        return indices
+
+    def _value(self, name: str, value):
+        if isinstance(value, float):
+            if math.isnan(value):
+                return None
+            if self.field_types.get(name) in INTEGER_FIELD_TYPES:
+                return int(value)
+        return value
+
+    def query(self, where: str, out_fields: str, return_count_only: bool, spatial_filter: Optional[dict], return_geometry: bool) -> dict:
+        """Answers a query in upstream's JSON shape; raises UnsupportedQuery when it cannot."""
+        mask = self.where_mask(where)
+        candidates = self._spatial_candidates(spatial_filter)
+        indices = np.flatnonzero(mask) if candidates is None else candidates[mask[candidates]]
+        if return_count_only:
+            return {"count": int(len(indices))}
+
+        if out_fields.strip() == "*":
+            names = [field["name"] for field in self.fields]
+        else:
+            names = [self._field(name.strip()) for name in out_fields.split(",") if name.strip()]
+        selected = {name: self.columns[name][indices].tolist() for name in names}
+        features = []
+        for row in range(len(indices)):
+            feature = {"attributes": {name: self._value(name, selected[name][row]) for name in names}}
+            if return_geometry:
+                feature["geometry"] = {"x": float(self.xs[indices[row]]), "y": float(self.ys[indices[row]])}
+            features.append(feature)
+        result = {
+            "objectIdFieldName": self.object_id_field,
+            "fields": [field for field in self.fields if field["name"] in names],
+            "features": features,
+        }
+        if return_geometry:
+            result["geometryType"] = "esriGeometryPoint"
+            result["spatialReference"] = self.spatial_reference
+        return result
+
+
+_replicas = {}
+# Layers in REPLICA_LAYERS that cannot be replicated, with the reason.
+_skipped = {}
+
+
+def _path(layer_name: str) -> str:
+    return os.path.join(REPLICA_DIR, f"{layer_name}.npz")
+
+
+def get(layer_name: str) -> Optional[PointReplica]:
+    """Returns the replica for a layer if replication is enabled and it is fresh enough to use."""
+    if layer_name not in REPLICA_LAYERS:
+        return None
+    replica = _replicas.get(layer_name)
+    if replica is None and os.path.exists(_path(layer_name)):
+        replica = _replicas[layer_name] = PointReplica.load(_path(layer_name))
+    if replica is None or replica.age() > MAX_AGE:
+        return None
+    return replica
+
+
+def _apply(delta: dict) -> None:
+    """Sync subscriber: applies a layer delta to its replica and saves it."""
+    layer_name = delta["layer"]
+    geometry_type = delta["info"].get("geometryType")
+    if geometry_type != "esriGeometryPoint":
+        if layer_name not in _skipped:
+            logger.error("Not replicating %s: only point layers can be replicated, it has %s geometry", layer_name, geometry_type)
+        _skipped[layer_name] = f"Not a point layer ({geometry_type})"
+        return
+    if delta["full"]:
+        replica = PointReplica.from_features(layer_name, delta["info"], delta["data"], delta["watermark"])
+    else:
+        current = _replicas.get(layer_name)
+        if current is None and os.path.exists(_path(layer_name)):
+            current = PointReplica.load(_path(layer_name))
+        if current is None or current.watermark != delta["since"]:
+            raise sync.ResyncRequired(layer_name)
+        if delta["data"] is None:
+            current.synced_at = time.time()
+            _replicas[layer_name] = current
+            return
+        changes = PointReplica.from_features(layer_name, delta["info"], delta["data"], delta["watermark"])
+        if set(changes.columns) != set(current.columns):
+            # The layer's fields changed; rebuild from a full download.
+            raise sync.ResyncRequired(layer_name)
+        replaced = np.concatenate((np.asarray(delta["deletes"], dtype=float), changes.columns[current.object_id_field]))
+        keep = ~np.isin(current.columns[current.object_id_field], replaced)
+        replica = current.merged(keep, changes)
+    replica.save(_path(layer_name))
+    _replicas[layer_name] = replica
+
+
+for _layer_name in REPLICA_LAYERS:
+    sync.subscribe(_layer_name, _apply)
+
+
+def stats() -> dict:
+    return {
+        **{name: {"error": reason} for name, reason in _skipped.items()},
+        **{name: {"features": len(replica.xs), "age_seconds": round(replica.age(), 1)} for name, replica in _replicas.items()},
+    }
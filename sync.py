@@ -0,0 +1,266 @@
+"""
+Incremental layer sync engine.
+
+Keeps local copies of layers (replicas, cached responses) fresh at a cost
+proportional to what changed upstream rather than to the layer size. For
+every subscribed layer it tracks the last-edit watermark
+(editingInfo.lastEditDate) and the set of object IDs, and on each pass:
+
+1. Revalidates the layer definition; an unchanged lastEditDate means no
+   work beyond that conditional request.
+2. Requests the current object IDs (returnIdsOnly) and diffs them against
+   the stored set to find deletions and additions.
+3. Fetches only the features whose edit-date field (editFieldsInfo) is newer
+   than the watermark, plus any added IDs not among them.
+
+Layers without edit tracking fall back to a full download. Subscribers are
+called with the resulting delta; one that cannot apply it (e.g. its copy is
+missing) raises ResyncRequired and gets a full snapshot instead. State is
+persisted in SQLite next to the metadata store, and layers are re-synced
+every ESRI_MCP_SYNC_INTERVAL seconds by a background task.
+"""
+
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+import zlib
+from datetime import datetime, timezone
+from typing import Optional
+
+import numpy as np
+
+import fetch
+import metadata
+
+DB_PATH = os.environ.get("ESRI_MCP_SYNC_DB", metadata.DB_PATH)
+SYNC_INTERVAL = float(os.environ.get("ESRI_MCP_SYNC_INTERVAL", "900"))
+# Layers whose cached responses are invalidated by sync, in addition to replicated layers.
+SYNC_LAYERS = [name.strip() for name in os.environ.get("ESRI_MCP_SYNC_LAYERS", "").split(",") if name.strip()]
+
+FEATURE_PARAMS = {"outFields": "*", "returnGeometry": "true", "returnCountOnly": "false"}
+
+
+class ResyncRequired(Exception):
+    """Raised by a subscriber that cannot apply an incremental delta."""
+
+
+logger = logging.getLogger(__name__)
+
+_subscribers = {}
+_states = {}
+_last_deltas = {}
+_connection = None
+_sync_task = None
+
+
+def _db() -> sqlite3.Connection:
+    global _connection
+    if _connection is None:
+        os.makedirs(os.path.dirname(DB_PATH) or ".", exist_ok=True)
+        _connection = sqlite3.connect(DB_PATH, check_same_thread=False)
+        _connection.execute(
+            "CREATE TABLE IF NOT EXISTS sync_state ("
+            "layer TEXT PRIMARY KEY, url TEXT NOT NULL, watermark INTEGER, object_ids BLOB NOT NULL, synced_at REAL NOT NULL)"
+        )
+        _connection.commit()
+    return _connection
+
+
+def _load(layer_name: str) -> Optional[dict]:
+    state = _states.get(layer_name)
+    if state is None:
+        row = _db().execute(
+            "SELECT url, watermark, object_ids, synced_at FROM sync_state WHERE layer = ?", (layer_name,)
+        ).fetchone()
+        if row is None:
+            return None
+        object_ids = np.frombuffer(zlib.decompress(row[2]), dtype=np.int64)
+        state = _states[layer_name] = {"url": row[0], "watermark": row[1], "object_ids": object_ids, "synced_at": row[3]}
+    return state
+
+
+def _save(layer_name: str, url: str, watermark: Optional[int], object_ids: np.ndarray) -> dict:
+    state = {"url": url, "watermark": watermark, "object_ids": object_ids, "synced_at": time.time()}
+    _db().execute(
+        "INSERT OR REPLACE INTO sync_state (layer, url, watermark, object_ids, synced_at) VALUES (?, ?, ?, ?, ?)",
+        (layer_name, url, watermark, zlib.compress(object_ids.astype(np.int64).tobytes()), state["synced_at"]),
+    )
+    _db().commit()
+    _states[layer_name] = state
+    return state
+
+
+def reset(layer_name: str) -> None:
+    """Forgets a layer's sync state so the next pass downloads it in full."""
+    _states.pop(layer_name, None)
+    _db().execute("DELETE FROM sync_state WHERE layer = ?", (layer_name,))
+    _db().commit()
+
+
+def subscribe(layer_name: str, callback, features: bool = True) -> None:
+    """
+    Registers `callback(delta)` to run after every sync of `layer_name`.
+
+    Pass features=False for subscribers that only need to know that the layer
+    changed (such as cache invalidation); changed features are then only
+    downloaded if another subscriber wants them.
+    """
+    _subscribers.setdefault(layer_name, []).append((callback, features))
+
+
+def _timestamp(epoch_ms: int) -> str:
+    return datetime.fromtimestamp(epoch_ms / 1000, timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+
+async def _object_ids(layer_url: str) -> np.ndarray:
+    data, _ = await fetch.post_query(
+        f"{layer_url}/query?f=json", {"where": "1=1", "returnIdsOnly": "true", "returnCountOnly": "false"}
+    )
+    if "error" in data:
+        raise RuntimeError(f"Object ID request failed for {layer_url}: {data['error']}")
+    return np.unique(np.asarray(data.get("objectIds") or [], dtype=np.int64))
+
+
+async def _fetch(layer_url: str, params: dict) -> dict:
+    data = await fetch.fetch_all(layer_url, {**params, **FEATURE_PARAMS}, "auto")
+    if "error" in data:
+        raise RuntimeError(f"Sync fetch failed for {layer_url}: {data['error']}")
+    return data
+
+
+def _feature_ids(features: list, object_id_field: str) -> np.ndarray:
+    return np.unique(np.asarray([feature["attributes"][object_id_field] for feature in features], dtype=np.int64))
+
+
+async def _full_delta(layer_name: str, layer_url: str, info: dict, wants_features: bool) -> dict:
+    watermark = info.get("editingInfo", {}).get("lastEditDate")
+    if wants_features:
+        data = await _fetch(layer_url, {"where": "1=1"})
+        object_ids = _feature_ids(data["features"], fetch.object_id_field(info))
+    else:
+        data = None
+        object_ids = await _object_ids(layer_url)
+    return {
+        "layer": layer_name, "full": True, "since": None, "watermark": watermark, "info": info,
+        "data": data, "deletes": [], "object_ids": object_ids,
+    }
+
+
+async def _incremental_delta(layer_name: str, layer_url: str, info: dict, state: dict, wants_features: bool) -> Optional[dict]:
+    """Delta since `state`, or None when the layer cannot be synced incrementally."""
+    watermark = info.get("editingInfo", {}).get("lastEditDate")
+    edit_date_field = info.get("editFieldsInfo", {}).get("editDateField")
+    if watermark is None or state["watermark"] is None:
+        return None
+    delta = {
+        "layer": layer_name, "full": False, "since": state["watermark"], "watermark": watermark, "info": info,
+        "data": None, "deletes": [], "object_ids": state["object_ids"],
+    }
+    if watermark == state["watermark"]:
+        return delta
+
+    object_ids = await _object_ids(layer_url)
+    deleted = np.setdiff1d(state["object_ids"], object_ids, assume_unique=True)
+    added = np.setdiff1d(object_ids, state["object_ids"], assume_unique=True)
+    delta["deletes"] = deleted.tolist()
+    delta["object_ids"] = object_ids
+    if wants_features:
+        if not edit_date_field:
+            # Modified features cannot be told apart from unchanged ones.
+            return None
+        # Timestamps are compared at second precision, so re-fetch the watermark's second too.
+        data = await _fetch(layer_url, {"where": f"{edit_date_field} >= timestamp '{_timestamp(state['watermark'])}'"})
+        missing = np.setdiff1d(added, _feature_ids(data["features"], fetch.object_id_field(info)), assume_unique=True)
+        if len(missing):
+            extra = await fetch.fetch_by_object_ids(
+                layer_url, {"where": "1=1", "objectIds": ",".join(str(oid) for oid in missing.tolist()), **FEATURE_PARAMS}
+            )
+            if "error" in extra:
+                raise RuntimeError(f"Sync fetch failed for {layer_url}: {extra['error']}")
+            data["features"] += extra["features"]
+            data["bytes"] = data.get("bytes", 0) + extra.get("bytes", 0)
+        # Deleted features can still match the edit-date query on some servers,
+        # including ones deleted in an earlier pass within the watermark's second.
+        current = set(object_ids.tolist())
+        object_id_field = fetch.object_id_field(info)
+        data["features"] = [feature for feature in data["features"] if feature["attributes"][object_id_field] in current]
+        delta["data"] = data
+    return delta
+
+
+def _notify(delta: dict) -> None:
+    for callback, _ in _subscribers.get(delta["layer"], []):
+        callback(delta)
+
+
+def _summary(delta: dict) -> dict:
+    return {
+        "full": delta["full"],
+        "upserts": len(delta["data"]["features"]) if delta["data"] else None,
+        "deletes": len(delta["deletes"]),
+        "bytes": delta["data"].get("bytes") if delta["data"] else None,
+        "watermark": delta["watermark"],
+        "at": time.time(),
+    }
+
+
+async def sync_layer(layer_name: str, layer_url: str, full: bool = False) -> dict:
+    """Brings every subscriber of a layer up to date and returns a summary of the delta applied."""
+    info = await metadata.refresh(layer_url)
+    if "error" in info:
+        raise RuntimeError(f"Layer metadata unavailable for {layer_name}: {info['error']}")
+    wants_features = any(features for _, features in _subscribers.get(layer_name, []))
+    state = None if full else _load(layer_name)
+    if state is not None and state["url"] != layer_url:
+        state = None
+
+    delta = None
+    if state is not None:
+        delta = await _incremental_delta(layer_name, layer_url, info, state, wants_features)
+    if delta is None:
+        delta = await _full_delta(layer_name, layer_url, info, wants_features)
+    try:
+        _notify(delta)
+    except ResyncRequired:
+        if delta["full"]:
+            raise
+        delta = await _full_delta(layer_name, layer_url, info, wants_features)
+        _notify(delta)
+    _save(layer_name, layer_url, delta["watermark"], delta["object_ids"])
+    _last_deltas[layer_name] = _summary(delta)
+    return _last_deltas[layer_name]
+
+
+async def _sync_loop(layer_urls: dict) -> None:
+    while True:
+        for layer_name in list(_subscribers):
+            state = _states.get(layer_name) or _load(layer_name)
+            if layer_name in _last_deltas and state is not None and time.time() - state["synced_at"] < SYNC_INTERVAL:
+                continue
+            try:
+                await sync_layer(layer_name, layer_urls[layer_name])
+            except Exception as e:
+                logger.warning("Sync failed for %s: %s", layer_name, e)
+        await asyncio.sleep(min(SYNC_INTERVAL, 60))
+
+
+def ensure_sync_task(layer_urls: dict) -> None:
+    """Starts the background sync task on the running loop if any layer has subscribers."""
+    global _sync_task
+    if not _subscribers:
+        return
+    if _sync_task is None or _sync_task.done() or _sync_task.get_loop() is not asyncio.get_running_loop():
+        _sync_task = asyncio.get_running_loop().create_task(_sync_loop(dict(layer_urls)))
+
+
+def stats() -> dict:
+    return {
+        layer_name: {
+            "object_ids": len(_states[layer_name]["object_ids"]) if layer_name in _states else None,
+            "watermark": _states[layer_name]["watermark"] if layer_name in _states else None,
+            "last_delta": _last_deltas.get(layer_name),
+        }
+        for layer_name in _subscribers
+    }
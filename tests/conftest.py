@@ -0,0 +1,33 @@
+import asyncio
+import os
+import sys
+
+import httpx
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import upstream  # noqa: E402
+
+
+@pytest.fixture
+def mock_transport(monkeypatch):
+    """Returns use(handler), which makes get_client build clients that answer from `handler` instead of the network."""
+    hosts = set()
+
+    def use(handler) -> None:
+        def get_client(url):
+            host, loop = upstream._host(url), asyncio.get_running_loop()
+            entry = upstream._clients.get(host)
+            if entry is None or entry[1] is not loop:
+                upstream._clients[host] = (httpx.AsyncClient(transport=httpx.MockTransport(handler)), loop)
+                upstream._stats.setdefault(host, upstream._new_stats())
+                hosts.add(host)
+            return upstream._clients[host][0]
+
+        monkeypatch.setattr(upstream, "get_client", get_client)
+
+    yield use
+    # Clients are bound to the event loop of the test that created them.
+    for host in hosts:
+        upstream._clients.pop(host, None)
@@ -0,0 +1,41 @@
+import cache
+
+
+def test_normalize_where_collapses_whitespace_outside_literals():
+    assert cache.normalize_where("  STATE =\n 'MI'\tAND  x > 1 ") == "STATE = 'MI' AND x > 1"
+    assert cache.normalize_where("NAME = 'A  B'") != cache.normalize_where("NAME = 'A B'")
+    assert cache.normalize_where("NAME  = 'O''Brien  Lake'") == "NAME = 'O''Brien  Lake'"
+    assert cache.normalize_where("   ") == "1=1"
+
+
+def test_size_cap_counts_the_upstream_size(monkeypatch):
+    response_cache = cache.TTLCache(max_bytes=1000)
+    value = {"features": [{"attributes": {"NAME": "x" * 100}}] * 5}
+    # A size from upstream is trusted as is; the value is not serialized again.
+    monkeypatch.setattr(cache, "json", None)
+    response_cache.set("key", value, ttl=60, size=600)
+    assert response_cache.stats()["bytes"] == 600
+    response_cache.set("other", value, ttl=60, size=600)
+    assert response_cache.get("key") is None
+    assert response_cache.get("other") == value
+    response_cache.set("too big", value, ttl=60, size=1001)
+    assert response_cache.get("too big") is None
+
+
+def test_size_defaults_to_the_compact_json_size():
+    response_cache = cache.TTLCache(max_bytes=1000)
+    response_cache.set("key", {"count": 12}, ttl=60)
+    assert response_cache.stats()["bytes"] == len('{"count":12}')
+
+
+def test_get_returns_a_shallow_copy():
+    response_cache = cache.TTLCache(max_bytes=1000)
+    value = {"features": [{"attributes": {"NAME": "a"}}], "exceededTransferLimit": False}
+    response_cache.set("key", value, ttl=60, size=100)
+    hit = response_cache.get("key")
+    hit["features"] = hit["features"][:0]
+    hit["exceededTransferLimit"] = True
+    again = response_cache.get("key")
+    assert again == value and again is not hit
+    # Nested values are shared: callers must not modify them in place.
+    assert again["features"] is value["features"]
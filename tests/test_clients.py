@@ -0,0 +1,23 @@
+import pytest
+
+import clients
+
+
+@pytest.mark.parametrize("count, fraction, expected", [
+    (10, 0.5, 5),
+    (10, 0.25, 3),
+    (10, 0.95, 10),
+    (20, 0.95, 19),
+    (100, 0.99, 99),
+    (100, 0.07, 7),
+    (10, 0.0, 1),
+    (10, 1.0, 10),
+    (1, 0.5, 1),
+])
+def test_percentile_is_nearest_rank(count, fraction, expected):
+    values = list(range(count, 0, -1))
+    assert clients.percentile(values, fraction) == expected
+
+
+def test_percentile_of_nothing_is_none():
+    assert clients.percentile([], 0.5) is None
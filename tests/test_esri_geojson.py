@@ -0,0 +1,70 @@
+import esri_geojson
+import geometry
+
+
+def _square(xmin: float, ymin: float, size: float, clockwise: bool = True) -> list:
+    ring = [[xmin, ymin], [xmin, ymin + size], [xmin + size, ymin + size], [xmin + size, ymin], [xmin, ymin]]
+    return ring if clockwise else ring[::-1]
+
+
+def _convert(esri_geometry: dict, has_z: bool = False) -> dict:
+    return esri_geojson.geometry_to_geojson(esri_geometry, has_z)
+
+
+def test_polygon_with_hole_follows_the_right_hand_rule():
+    outer, hole = _square(0, 0, 10), _square(2, 2, 2, clockwise=False)
+    converted = _convert({"rings": [outer, hole]})
+    assert converted["type"] == "Polygon"
+    exterior, interior = converted["coordinates"]
+    # RFC 7946: exteriors counter-clockwise (positive area), holes clockwise.
+    assert geometry.ring_area(exterior) > 0
+    assert geometry.ring_area(interior) < 0
+    assert sorted(map(tuple, exterior)) == sorted(map(tuple, outer))
+    assert sorted(map(tuple, interior)) == sorted(map(tuple, hole))
+
+
+def test_holes_nest_in_the_smallest_containing_exterior():
+    big, small, far = _square(0, 0, 100), _square(10, 10, 20), _square(200, 200, 10)
+    hole_in_small, hole_in_big, orphan = _square(15, 15, 2, False), _square(60, 60, 5, False), _square(500, 500, 1, False)
+    converted = _convert({"rings": [big, small, hole_in_small, far, hole_in_big, orphan]})
+    assert converted["type"] == "MultiPolygon"
+    polygons = converted["coordinates"]
+    assert [len(polygon) for polygon in polygons] == [2, 2, 1, 1]
+    # Exteriors keep their input order; each hole lands in its tightest exterior.
+    assert polygons[0][1][0] in [list(vertex) for vertex in hole_in_big]
+    assert polygons[1][1][0] in [list(vertex) for vertex in hole_in_small]
+    assert sorted(map(tuple, polygons[3][0])) == sorted(map(tuple, orphan))
+    for polygon in polygons:
+        assert geometry.ring_area(polygon[0]) > 0
+        assert all(geometry.ring_area(ring) < 0 for ring in polygon[1:])
+
+
+def test_polylines_become_line_strings_or_multi_line_strings():
+    single = [[0, 0], [1, 1]]
+    assert _convert({"paths": [single]}) == {"type": "LineString", "coordinates": single}
+    paths = [[[0, 0], [1, 1]], [[2, 2], [3, 3], [4, 4]]]
+    assert _convert({"paths": paths}) == {"type": "MultiLineString", "coordinates": paths}
+
+
+def test_mixed_vertex_widths_keep_x_and_y():
+    # 2 + 4 values add up to two 3D vertices; they must not be reshaped as such.
+    converted = _convert({"paths": [[[0, 1], [2, 3, 4, 5]]]}, has_z=True)
+    assert converted["coordinates"] == [[0.0, 1.0], [2.0, 3.0]]
+    converted = _convert({"paths": [[[0, 1], [2, 3, 4, 5]]]})
+    assert converted["coordinates"] == [[0.0, 1.0], [2.0, 3.0]]
+
+
+def test_z_kept_m_dropped_and_precision():
+    converted = esri_geojson.features_to_geojson(
+        [{"attributes": {"ID": 1}, "geometry": {"paths": [[[0.123456, 1.987654, 5.5, 9], [1.5, 2.5, 6.5, 9]]]}}], has_z=True, precision=2,
+    )
+    assert converted == [{"type": "Feature", "geometry": {"type": "LineString", "coordinates": [[0.12, 1.99, 5.5], [1.5, 2.5, 6.5]]}, "properties": {"ID": 1}}]
+
+
+def test_points_envelopes_and_empty_geometries():
+    assert _convert({"x": 1, "y": 2}) == {"type": "Point", "coordinates": [1, 2]}
+    assert _convert({"points": [[1, 2], [3, 4]]}) == {"type": "MultiPoint", "coordinates": [[1, 2], [3, 4]]}
+    envelope = _convert({"xmin": 0, "ymin": 0, "xmax": 2, "ymax": 1})
+    assert envelope["type"] == "Polygon" and geometry.ring_area(envelope["coordinates"][0]) > 0
+    for empty in ({"x": "NaN", "y": "NaN"}, {"rings": []}, {"paths": [[]]}, None):
+        assert _convert(empty) is None
@@ -0,0 +1,91 @@
+import asyncio
+from typing import Optional
+
+import fetch
+import metadata
+
+FEATURES = [{"attributes": {"OBJECTID": oid, "NAME": name}} for oid, name in enumerate("dbeac", 1)]
+
+
+def _use_fake_layer(monkeypatch, supports_pagination: bool, reported_count: Optional[int] = None) -> list:
+    """
+    Serves FEATURES from a fake layer with maxRecordCount 2; returns the list of requests made.
+
+    `reported_count` stands in for a layer that grew after the count request.
+    """
+    requests = []
+    info = {"maxRecordCount": 2, "advancedQueryCapabilities": {"supportsPagination": supports_pagination}}
+
+    async def get_layer_info(layer_url):
+        return info
+
+    async def post_query(query_url, params):
+        requests.append(params)
+        if params.get("returnCountOnly") == "true":
+            return {"count": len(FEATURES) if reported_count is None else reported_count}, 0
+        if params.get("returnIdsOnly") == "true":
+            # Servers return IDs in no particular order.
+            return {"objectIds": [feature["attributes"]["OBJECTID"] for feature in reversed(FEATURES)]}, 0
+        features = FEATURES
+        if "objectIds" in params:
+            ids = {int(oid) for oid in params["objectIds"].split(",")}
+            features = [feature for feature in features if feature["attributes"]["OBJECTID"] in ids]
+        field, _, direction = params.get("orderByFields", "OBJECTID").partition(" ")
+        features = sorted(features, key=lambda feature: feature["attributes"][field], reverse=direction == "DESC")
+        if "resultOffset" in params:
+            offset, limit = int(params["resultOffset"]), int(params["resultRecordCount"])
+            if offset + limit < len(features):
+                return {"features": features[offset:offset + limit], "exceededTransferLimit": True}, 0
+            features = features[offset:]
+        return {"features": features}, 0
+
+    monkeypatch.setattr(metadata, "get_layer_info", get_layer_info)
+    monkeypatch.setattr(fetch, "post_query", post_query)
+    return requests
+
+
+def test_ordered_objectids_query_is_paged_in_order(monkeypatch):
+    requests = _use_fake_layer(monkeypatch, supports_pagination=True)
+    data = asyncio.run(fetch.fetch_all("https://example.com/layer/0", {"where": "1=1", "orderByFields": "NAME DESC"}, "objectids"))
+    assert [feature["attributes"]["NAME"] for feature in data["features"]] == list("edcba")
+    assert not any("objectIds" in params for params in requests)
+
+
+def test_ordered_query_without_pagination_is_an_error(monkeypatch):
+    _use_fake_layer(monkeypatch, supports_pagination=False)
+    data = asyncio.run(fetch.fetch_all("https://example.com/layer/0", {"where": "1=1", "orderByFields": "NAME"}, "auto"))
+    assert "error" in data
+    unordered = asyncio.run(fetch.fetch_all("https://example.com/layer/0", {"where": "1=1"}, "objectids"))
+    assert [feature["attributes"]["OBJECTID"] for feature in unordered["features"]] == [1, 2, 3, 4, 5]
+
+
+def test_paged_fetch_drains_pages_while_the_transfer_limit_is_exceeded(monkeypatch):
+    requests = _use_fake_layer(monkeypatch, supports_pagination=True, reported_count=3)
+    data = asyncio.run(fetch.fetch_paged("https://example.com/layer/0", {"where": "1=1"}))
+    assert [feature["attributes"]["OBJECTID"] for feature in data["features"]] == [1, 2, 3, 4, 5]
+    assert data["pages"] == 3 and "exceededTransferLimit" not in data
+    assert [params["resultOffset"] for params in requests if "resultOffset" in params] == ["0", "2", "4"]
+
+    # A max_features cap is already met by the counted pages, so nothing is drained.
+    requests.clear()
+    capped = asyncio.run(fetch.fetch_paged("https://example.com/layer/0", {"where": "1=1"}, max_features=3))
+    assert [feature["attributes"]["OBJECTID"] for feature in capped["features"]] == [1, 2, 3]
+    assert [params["resultOffset"] for params in requests if "resultOffset" in params] == ["0", "2"]
+
+
+def test_objectids_fetch_batches_sorted_ids_by_max_record_count(monkeypatch):
+    requests = _use_fake_layer(monkeypatch, supports_pagination=False)
+    data = asyncio.run(fetch.fetch_by_object_ids("https://example.com/layer/0", {"where": "NAME <> 'z'", "outFields": "*"}))
+    assert [feature["attributes"]["OBJECTID"] for feature in data["features"]] == [1, 2, 3, 4, 5]
+    assert data["pages"] == 3
+    batches = [params for params in requests if "objectIds" in params]
+    assert [params["objectIds"] for params in batches] == ["1,2", "3,4", "5"]
+    # The IDs already satisfy the where clause, so batches select by ID only.
+    assert all("where" not in params and params["outFields"] == "*" for params in batches)
+
+
+def test_objectids_fetch_truncates_to_max_features(monkeypatch):
+    requests = _use_fake_layer(monkeypatch, supports_pagination=False)
+    data = asyncio.run(fetch.fetch_by_object_ids("https://example.com/layer/0", {"where": "1=1"}, max_features=3))
+    assert [feature["attributes"]["OBJECTID"] for feature in data["features"]] == [1, 2, 3]
+    assert [params["objectIds"] for params in requests if "objectIds" in params] == ["1,2", "3"]
@@ -0,0 +1,87 @@
+import asyncio
+
+import pytest
+
+import gazetteer
+
+MICHIGAN = {"rings": [[[-90.0, 41.7], [-90.0, 48.3], [-82.4, 48.3], [-82.4, 41.7], [-90.0, 41.7]]]}
+KENT = {"rings": [[[-85.8, 42.8], [-85.8, 43.3], [-85.3, 43.3], [-85.3, 42.8], [-85.8, 42.8]]]}
+PRINCE_GEORGES = {"rings": [[[-77.1, 38.5], [-77.1, 39.1], [-76.6, 39.1], [-76.6, 38.5], [-77.1, 38.5]]]}
+
+
+@pytest.fixture
+def gazetteer_file(tmp_path, monkeypatch):
+    path = str(tmp_path / "gazetteer.bin")
+    monkeypatch.setattr(gazetteer, "GAZETTEER_PATH", path)
+    gazetteer.reset()
+    yield path
+    gazetteer.reset()
+
+
+def _write(path: str) -> None:
+    states = [
+        {"name": "Michigan", "abbr": "MI", "fips": "26", "geometry": MICHIGAN},
+        {"name": "Maryland", "abbr": "MD", "fips": "24", "geometry": {"rings": [[[-79.5, 37.9], [-79.5, 39.7], [-75.0, 39.7], [-79.5, 37.9]]]}},
+    ]
+    counties = [
+        {"name": "Kent", "state_fips": "26", "fips": "26081", "geometry": KENT},
+        {"name": "Prince George's", "state_fips": "24", "fips": "24033", "geometry": PRINCE_GEORGES},
+    ]
+    gazetteer.write(path, states, counties, {"states": {"wkid": 4326}, "counties": {"wkid": 4326}})
+
+
+def test_write_and_look_up(gazetteer_file):
+    assert not gazetteer.available()
+    _write(gazetteer_file)
+    assert gazetteer.available()
+    for key in ("Michigan", "mi", "26", " MICHIGAN "):
+        assert gazetteer.find_state(key)["fips"] == "26"
+    state = gazetteer.find_state("MI")
+    assert state["geometry"] == MICHIGAN
+    assert state["bbox"] == {"xmin": -90.0, "ymin": 41.7, "xmax": -82.4, "ymax": 48.3}
+    assert "geometry" not in gazetteer.find_state("MI", include_geometry=False)
+    assert gazetteer.find_state("Ontario") is None
+    assert gazetteer.spatial_reference("counties") == {"wkid": 4326}
+
+
+def test_find_county_with_and_without_suffix(gazetteer_file):
+    _write(gazetteer_file)
+    for name in ("Kent", "kent county", "KENT COUNTY"):
+        county = gazetteer.find_county(name, "Michigan")
+        assert county["fips"] == "26081"
+        assert county["geometry"] == KENT
+    assert gazetteer.find_county("Prince George's County", "MD")["geometry"] == PRINCE_GEORGES
+    assert gazetteer.find_county("Kent", "Maryland") is None
+    assert gazetteer.find_county("Kent", "Ontario") is None
+
+
+def test_unsupported_file_is_ignored(gazetteer_file):
+    with open(gazetteer_file, "wb") as f:
+        f.write(b"XXXX" + bytes(6))
+    assert gazetteer.find_state("MI") is None
+
+
+def test_failed_build_is_retried(gazetteer_file, monkeypatch):
+    attempts = []
+
+    async def refresh(path, states_url, counties_url):
+        attempts.append(path)
+        if len(attempts) == 1:
+            raise RuntimeError("upstream unavailable")
+        _write(path)
+        gazetteer.reset()
+        return {"path": path, "states": 2, "counties": 2, "bytes": 0}
+
+    monkeypatch.setattr(gazetteer, "refresh", refresh)
+    monkeypatch.setattr(gazetteer, "_build_task", None)
+    monkeypatch.setattr(gazetteer, "_build_failed_at", None)
+    monkeypatch.setattr(gazetteer, "BUILD_RETRY_INTERVAL", 0)
+
+    async def lookup():
+        gazetteer.ensure_built("states", "counties")
+        await gazetteer._build_task
+        return gazetteer.available()
+
+    assert asyncio.run(lookup()) is False
+    assert asyncio.run(lookup()) is True
+    assert len(attempts) == 2
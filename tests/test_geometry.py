@@ -0,0 +1,56 @@
+import math
+import random
+
+import numpy as np
+import pytest
+
+import geometry
+
+
+def _random_ring(rng: random.Random) -> list:
+    """A random simple, clockwise, star-shaped ring with spiky reflex vertices and short edges."""
+    count = rng.randint(5, 60)
+    angles = sorted(rng.uniform(0, 2 * math.pi) for _ in range(count))
+    cx, cy = rng.uniform(-100, 100), rng.uniform(-50, 50)
+    ring = []
+    for angle in angles:
+        radius = rng.uniform(0.05, 1) * rng.choice([0.1, 1, 5])
+        ring.append([cx + radius * math.cos(angle), cy + radius * math.sin(angle)])
+    ring.append(ring[0])
+    # Sorted angles give a counter-clockwise ring unless one gap exceeds half a turn.
+    return ring[::-1] if geometry.ring_area(ring) > 0 else ring
+
+
+def test_optimized_polygon_contains_every_original_vertex():
+    rng = random.Random(8)
+    for _ in range(1000):
+        ring = _random_ring(rng)
+        tolerance = rng.choice([0.001, 0.01, 0.05, 0.2, 1])
+        optimized = geometry.optimize_polygon({"rings": [ring]}, tolerance)
+        assert len(optimized["rings"]) == 1
+        if optimized["rings"][0] is ring:
+            # Sent unsimplified because the offset failed validation.
+            continue
+        points = np.asarray(ring)
+        inside = geometry.points_in_polygon(points[:, 0], points[:, 1], optimized)
+        assert inside.all(), (ring, tolerance)
+
+
+def test_optimized_polygon_keeps_vertices_outside_holes():
+    outer = [[0, 0], [0, 10], [10, 10], [10, 0], [0, 0]]
+    hole = [[2, 2], [4, 2], [4.05, 3], [4, 4], [2, 4], [2, 2]]
+    optimized = geometry.optimize_polygon({"rings": [outer, hole]}, 0.1)
+    points = np.asarray(outer[:-1] + hole[:-1])
+    assert geometry.points_in_polygon(points[:, 0], points[:, 1], optimized).all()
+
+
+def test_douglas_peucker_keeps_vertices_beyond_segment_ends():
+    # The middle vertex is on the chord's line but far past its end.
+    points = np.array([[0, 0], [10, 0], [1, 0]], dtype=float)
+    assert len(geometry._douglas_peucker(points, 0.5)) == 3
+
+
+@pytest.mark.parametrize("tolerance", [0, -1])
+def test_optimize_polygon_rejects_non_positive_tolerance(tolerance):
+    with pytest.raises(ValueError, match="tolerance"):
+        geometry.optimize_polygon({"rings": [[[0, 0], [0, 1], [1, 1], [0, 0]]]}, tolerance)
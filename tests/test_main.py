@@ -0,0 +1,68 @@
+import asyncio
+import json
+from urllib.parse import parse_qs
+
+import httpx
+
+import gazetteer
+import main
+import metadata
+import replica
+import upstream
+
+
+def test_county_fallback_escapes_quotes(monkeypatch):
+    sent = []
+
+    async def get(url, params=None, **kwargs):
+        sent.append(params)
+        return httpx.Response(200, json={"features": [{"attributes": {"STATE_FIPS": "24"}, "geometry": {"rings": [[[0, 0], [0, 1], [1, 1], [0, 0]]]}}]}, request=httpx.Request("GET", url))
+
+    monkeypatch.setattr(gazetteer, "ensure_built", lambda *urls: None)
+    monkeypatch.setattr(gazetteer, "find_county", lambda *args, **kwargs: None)
+    monkeypatch.setattr(gazetteer, "find_state", lambda *args, **kwargs: None)
+    monkeypatch.setattr(upstream, "get", get)
+
+    result = asyncio.run(main.get_county_geometry("Prince George's County", "Maryland"))
+    assert "rings" in result
+    assert sent[0]["where"] == "STATE_NAME = 'Maryland'"
+    assert sent[1]["where"] == "NAME = 'Prince George''s' AND STATEFP = '24'"
+
+    asyncio.run(main.get_state_geometry("Hawai'i"))
+    assert sent[2]["where"] == "STATE_NAME = 'Hawai''i'"
+
+
+def test_query_many_rejects_host_concurrency_below_one():
+    queries = [{"layer_name": "dams", "return_count_only": True}]
+    for host_concurrency in (0, -1):
+        result = asyncio.run(main.query_many(queries, host_concurrency=host_concurrency))
+        assert result == {"error": f"Invalid host_concurrency: {host_concurrency}. It must be at least 1."}
+
+
+def test_spatial_filter_is_sent_as_compact_json_encoded_once(monkeypatch, mock_transport):
+    bodies = []
+
+    def handler(request):
+        bodies.append(request.content.decode())
+        return httpx.Response(200, json={"features": []})
+
+    async def get_layer_info(url):
+        return {}
+
+    mock_transport(handler)
+    monkeypatch.setattr(metadata, "get_layer_info", get_layer_info)
+    monkeypatch.setattr(metadata, "ensure_refresher", lambda urls: None)
+    monkeypatch.setattr(replica, "get", lambda layer_name: None)
+
+    polygon = {"rings": [[[-77.1, 38.8], [-77.1, 39.0], [-76.9, 39.0], [-77.1, 38.8]]], "spatialReference": {"wkid": 4326}}
+    envelope = {"xmin": -77.1, "ymin": 38.8, "xmax": -76.9, "ymax": 39.0}
+    for spatial_filter in (polygon, envelope):
+        asyncio.run(main.query_layer("dams", where="STATE = 'VA'", spatial_filter=json.dumps(spatial_filter)))
+
+    polygon_form, envelope_form = (parse_qs(body) for body in bodies)
+    assert polygon_form["geometry"] == ['{"rings":[[[-77.1,38.8],[-77.1,39.0],[-76.9,39.0],[-77.1,38.8]]],"spatialReference":{"wkid":4326}}']
+    assert polygon_form["geometryType"] == ["esriGeometryPolygon"]
+    # Form encoding is the only layer of escaping; the value is not URL-quoted beforehand.
+    assert "geometry=%7B%22rings%22%3A%5B%5B%5B-77.1%2C38.8%5D" in bodies[0]
+    assert envelope_form["geometry"] == ["-77.1,38.8,-76.9,39.0"]
+    assert envelope_form["geometryType"] == ["esriGeometryEnvelope"]
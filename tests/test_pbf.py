@@ -0,0 +1,76 @@
+import fake_arcgis
+import pbf
+
+FIELDS = [
+    {"name": "OBJECTID", "type": "esriFieldTypeOID", "alias": "OBJECTID"},
+    {"name": "NAME", "type": "esriFieldTypeString", "alias": "NAME"},
+    {"name": "COUNT", "type": "esriFieldTypeInteger", "alias": "COUNT"},
+    {"name": "HEIGHT", "type": "esriFieldTypeDouble", "alias": "HEIGHT"},
+    {"name": "EDITED", "type": "esriFieldTypeDate", "alias": "EDITED"},
+]
+QUANTIZATION = {
+    "mode": "view", "originPosition": "upperLeft", "tolerance": 0.001,
+    "extent": {"xmin": -90.0, "ymin": 40.0, "xmax": -80.0, "ymax": 50.0, "spatialReference": {"wkid": 4326}},
+}
+
+
+def _result(geometry_type: str, features: list, **extra) -> dict:
+    return {
+        "objectIdFieldName": "OBJECTID", "geometryType": geometry_type,
+        "spatialReference": {"wkid": 4326, "latestWkid": 4326}, "fields": FIELDS, "features": features, **extra,
+    }
+
+
+def _attributes(object_id: int, **values) -> dict:
+    return {"OBJECTID": object_id, "NAME": None, "COUNT": None, "HEIGHT": None, "EDITED": None, **values}
+
+
+def test_points_use_the_upper_left_transform():
+    features = [
+        {"attributes": _attributes(1, NAME="a"), "geometry": {"x": -85.123, "y": 42.456}},
+        {"attributes": _attributes(2, NAME="b"), "geometry": {"x": -89.999, "y": 49.999}},
+    ]
+    decoded = pbf.decode(fake_arcgis.encode_pbf(_result("esriGeometryPoint", features), QUANTIZATION))
+    assert [feature["geometry"] for feature in decoded["features"]] == [{"x": -85.123, "y": 42.456}, {"x": -89.999, "y": 49.999}]
+    assert decoded["geometryType"] == "esriGeometryPoint"
+    assert decoded["spatialReference"] == {"wkid": 4326, "latestWkid": 4326}
+
+
+def test_multipart_deltas_carry_over_between_parts_and_reset_per_feature():
+    outer = [[-85.0, 45.0], [-85.0, 46.0], [-84.0, 46.0], [-84.0, 45.0], [-85.0, 45.0]]
+    hole = [[-84.75, 45.25], [-84.25, 45.25], [-84.25, 45.75], [-84.75, 45.75], [-84.75, 45.25]]
+    second = [[-82.5, 41.5], [-82.5, 42.5], [-81.5, 42.5], [-82.5, 41.5]]
+    features = [
+        {"attributes": _attributes(1), "geometry": {"rings": [outer, hole]}},
+        {"attributes": _attributes(2), "geometry": {"rings": [second]}},
+    ]
+    decoded = pbf.decode(fake_arcgis.encode_pbf(_result("esriGeometryPolygon", features), QUANTIZATION))
+    assert decoded["features"][0]["geometry"] == {"rings": [outer, hole]}
+    assert decoded["features"][1]["geometry"] == {"rings": [second]}
+
+    paths = [[[-85.0, 45.0], [-84.0, 45.5]], [[-83.0, 44.0], [-82.0, 43.0], [-81.0, 42.0]]]
+    decoded = pbf.decode(fake_arcgis.encode_pbf(_result("esriGeometryPolyline", [{"attributes": _attributes(1), "geometry": {"paths": paths}}])))
+    assert decoded["features"][0]["geometry"] == {"paths": paths}
+
+
+def test_attribute_types_and_nulls():
+    attributes = _attributes(7, NAME="O'Brien", COUNT=-3, HEIGHT=12.5, EDITED=1767225600000)
+    features = [{"attributes": attributes}, {"attributes": _attributes(8)}]
+    decoded = pbf.decode(fake_arcgis.encode_pbf(_result("esriGeometryPoint", features, exceededTransferLimit=True)))
+    assert [feature["attributes"] for feature in decoded["features"]] == [attributes, _attributes(8)]
+    assert all("geometry" not in feature for feature in decoded["features"])
+    assert [field["type"] for field in decoded["fields"]] == [field["type"] for field in FIELDS]
+    assert decoded["exceededTransferLimit"] is True
+
+
+def test_present_geometries_without_coordinates():
+    features = [{"attributes": _attributes(1), "geometry": {"rings": []}}, {"attributes": _attributes(2), "geometry": {"rings": []}}]
+    decoded = pbf.decode(fake_arcgis.encode_pbf(_result("esriGeometryPolygon", features)))
+    assert [feature["attributes"]["OBJECTID"] for feature in decoded["features"]] == [1, 2]
+    assert all("geometry" not in feature for feature in decoded["features"])
+
+
+def test_count_and_object_ids():
+    assert pbf.decode(fake_arcgis.encode_pbf({"count": 12345})) == {"count": 12345}
+    ids = {"objectIdFieldName": "FID", "objectIds": [3, 1, 200000]}
+    assert pbf.decode(fake_arcgis.encode_pbf(ids)) == ids
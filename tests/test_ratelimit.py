@@ -0,0 +1,132 @@
+import asyncio
+import types
+
+import pytest
+
+import ratelimit
+
+
+class FakeClock:
+    """Stands in for time.monotonic and the limiter's loop.call_later; time only moves on advance()."""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.now = 0.0
+        self.timers = []
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def call_later(self, delay, callback):
+        self.timers.append((self.now + delay, callback))
+
+    def create_future(self):
+        return self.loop.create_future()
+
+    async def advance(self, seconds: float) -> None:
+        self.now += seconds
+        due = [timer for timer in self.timers if timer[0] <= self.now]
+        self.timers = [timer for timer in self.timers if timer[0] > self.now]
+        for _, callback in due:
+            callback()
+        await _settle()
+
+
+async def _settle() -> None:
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+@pytest.fixture
+def make_limiter(monkeypatch):
+    """Returns make(rate, burst, max_in_flight) -> (limiter, clock), to be called on the running loop."""
+    def make(rate: float, burst: int, max_in_flight: int):
+        clock = FakeClock(asyncio.get_running_loop())
+        monkeypatch.setattr(ratelimit, "time", types.SimpleNamespace(monotonic=clock.monotonic, time=lambda: 0.0))
+        limiter = ratelimit.HostLimiter("limited.example.com", rate, burst, max_in_flight)
+        limiter.loop = clock
+        return limiter, clock
+
+    return make
+
+
+def _request(limiter, session_id: str, admitted: list) -> asyncio.Task:
+    async def request():
+        ratelimit.session.set(session_id)
+        await limiter.acquire()
+        admitted.append(session_id)
+
+    return asyncio.get_running_loop().create_task(request())
+
+
+def test_queued_requests_are_admitted_round_robin_across_sessions(make_limiter):
+    async def run():
+        limiter, clock = make_limiter(rate=4, burst=1, max_in_flight=100)
+        admitted = []
+        assert limiter.try_acquire()
+        tasks = [_request(limiter, session_id, admitted) for session_id in "AAABBC"]
+        await _settle()
+        assert admitted == [] and limiter.stats["queued"] == 6
+        for expected in range(1, 7):
+            await clock.advance(0.25)
+            assert len(admitted) == expected
+        await asyncio.gather(*tasks)
+        return admitted
+
+    assert asyncio.run(run()) == list("ABCABA")
+
+
+def test_in_flight_cap_holds_requests_until_a_release(make_limiter):
+    async def run():
+        limiter, clock = make_limiter(rate=1000, burst=100, max_in_flight=2)
+        admitted = []
+        await limiter.acquire()
+        await limiter.acquire()
+        assert not limiter.try_acquire()
+        tasks = [_request(limiter, session_id, admitted) for session_id in "AB"]
+        await _settle()
+        # No timer: only a release can free a slot.
+        assert admitted == [] and clock.timers == []
+        limiter.release()
+        await _settle()
+        assert admitted == ["A"] and limiter.in_flight == 2
+        # Queued requests go first even when a slot is free.
+        limiter.release()
+        assert not limiter.try_acquire()
+        await _settle()
+        assert admitted == ["A", "B"] and limiter.in_flight == 2
+        await asyncio.gather(*tasks)
+        limiter.release()
+        assert limiter.try_acquire()
+        assert limiter.in_flight == 2
+
+    asyncio.run(run())
+
+
+def test_429_pauses_for_retry_after_and_halves_the_rate(make_limiter):
+    async def run():
+        limiter, clock = make_limiter(rate=8, burst=8, max_in_flight=100)
+        limiter.feedback(429, "3")
+        assert (limiter.rate, limiter.tokens, limiter.stats["throttled"]) == (4, 0.0, 1)
+        assert not limiter.try_acquire()
+        admitted = []
+        task = _request(limiter, "A", admitted)
+        await _settle()
+        await clock.advance(2.5)
+        assert admitted == []
+        await clock.advance(0.5)
+        assert admitted == ["A"]
+        await task
+
+        limiter.feedback(200, None)
+        assert limiter.rate == 4.4
+        # A 503 only throttles when it says how long to wait; a 429 without Retry-After pauses a second.
+        limiter.feedback(503, None)
+        assert limiter.rate == 4.4
+        limiter.feedback(429, None)
+        assert limiter.paused_until == clock.now + ratelimit.DEFAULT_RETRY_AFTER
+        for _ in range(10):
+            limiter.feedback(429, "0")
+        assert limiter.rate == 8 * ratelimit.MIN_RATE_FRACTION
+
+    asyncio.run(run())
@@ -0,0 +1,52 @@
+import pytest
+
+import replica
+
+INFO = {
+    "geometryType": "esriGeometryPoint",
+    "objectIdField": "OBJECTID",
+    "fields": [
+        {"name": "OBJECTID", "type": "esriFieldTypeOID"},
+        {"name": "STATE", "type": "esriFieldTypeString"},
+    ],
+}
+
+
+def _replica() -> replica.PointReplica:
+    data = {"features": [
+        {"attributes": {"OBJECTID": 1, "STATE": "MI"}, "geometry": {"x": 0, "y": 0}},
+        {"attributes": {"OBJECTID": 2, "STATE": "mi"}, "geometry": {"x": 1, "y": 1}},
+        {"attributes": {"OBJECTID": 3, "STATE": "OH"}, "geometry": {"x": 2, "y": 2}},
+        {"attributes": {"OBJECTID": 4, "STATE": None}, "geometry": {"x": 3, "y": 3}},
+    ]}
+    return replica.PointReplica.from_features("points", INFO, data)
+
+
+def test_string_comparisons_ignore_case_on_case_insensitive_layers(monkeypatch):
+    monkeypatch.setattr(replica, "CASE_INSENSITIVE_LAYERS", ["points"])
+    local = _replica()
+    assert local.where_mask("state = 'Mi'").tolist() == [True, True, False, False]
+    assert local.where_mask("STATE <> 'mi'").tolist() == [False, False, True, False]
+    assert local.where_mask("STATE IN ('oh', 'MI')").tolist() == [True, True, True, False]
+
+
+def test_case_dependent_comparisons_go_upstream_elsewhere(monkeypatch):
+    monkeypatch.setattr(replica, "CASE_INSENSITIVE_LAYERS", [])
+    local = _replica()
+    for where in ("STATE = 'MI'", "STATE = 'mi'", "STATE <> 'Mi'", "STATE IN ('OH', 'MI')"):
+        with pytest.raises(replica.UnsupportedQuery):
+            local.where_mask(where)
+    # Only "OH" exists, in one case, so both collations give the same answer.
+    assert local.where_mask("STATE = 'OH'").tolist() == [False, False, True, False]
+    assert local.where_mask("STATE <> 'OH'").tolist() == [True, True, False, False]
+    assert local.where_mask("STATE = 'TX'").tolist() == [False, False, False, False]
+
+
+def test_non_point_layer_is_skipped(monkeypatch):
+    monkeypatch.setattr(replica, "_skipped", {})
+    polygons = {"features": [{"attributes": {"OBJECTID": 1}, "geometry": {"rings": [[[0, 0], [0, 1], [1, 1], [0, 0]]]}}]}
+    delta = {"layer": "counties", "full": True, "info": {**INFO, "geometryType": "esriGeometryPolygon"}, "data": polygons, "watermark": None}
+    replica._apply(delta)
+    assert "counties" not in replica._replicas
+    assert replica.get("counties") is None
+    assert replica.stats()["counties"] == {"error": "Not a point layer (esriGeometryPolygon)"}
@@ -0,0 +1,198 @@
+import asyncio
+import re
+from datetime import datetime, timezone
+from urllib.parse import parse_qsl
+
+import httpx
+import pytest
+
+import metadata
+import sync
+
+OLD_EDIT = 1_690_000_000_000
+WATERMARK = 1_700_000_000_000
+NEW_EDIT = 1_700_000_100_000
+
+
+class FakeLayer:
+    """An edit-tracked layer served over the mock transport; records every query it answers."""
+
+    def __init__(self):
+        self.last_edit_date = WATERMARK
+        self.rows = {oid: OLD_EDIT for oid in range(1, 6)}
+        # Deleted rows still match edit-date queries, as on servers that keep tombstones.
+        self.deleted = {}
+        self.queries = []
+
+    def edit(self, oid: int, edited: int = NEW_EDIT) -> None:
+        self.rows[oid] = edited
+        self.last_edit_date = max(self.last_edit_date, edited)
+
+    def delete(self, oid: int) -> None:
+        del self.rows[oid]
+        self.deleted[oid] = NEW_EDIT
+        self.last_edit_date = max(self.last_edit_date, NEW_EDIT)
+
+    def info(self) -> dict:
+        return {
+            "name": "Fake", "objectIdField": "OBJECTID", "maxRecordCount": 2, "supportedQueryFormats": "JSON",
+            "advancedQueryCapabilities": {"supportsPagination": True},
+            "editingInfo": {"lastEditDate": self.last_edit_date},
+            "editFieldsInfo": {"editDateField": "EDITED"},
+        }
+
+    def query(self, params: dict) -> dict:
+        self.queries.append(params)
+        oids = sorted(self.rows)
+        match = re.fullmatch(r"EDITED >= timestamp '(.+)'", params.get("where", "1=1"))
+        if match:
+            since = datetime.strptime(match.group(1), "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc).timestamp() * 1000
+            edits = {**self.deleted, **self.rows}
+            oids = sorted(oid for oid, edited in edits.items() if edited >= since)
+        if "objectIds" in params:
+            wanted = {int(oid) for oid in params["objectIds"].split(",")}
+            oids = [oid for oid in oids if oid in wanted]
+        if params.get("returnIdsOnly") == "true":
+            return {"objectIdFieldName": "OBJECTID", "objectIds": oids}
+        if params.get("returnCountOnly") == "true":
+            return {"count": len(oids)}
+        if "resultOffset" in params:
+            offset = int(params["resultOffset"])
+            oids = oids[offset:offset + int(params["resultRecordCount"])]
+        return {
+            "objectIdFieldName": "OBJECTID",
+            "features": [{"attributes": {"OBJECTID": oid, "EDITED": self.rows.get(oid, self.deleted.get(oid))}} for oid in oids],
+        }
+
+    def handler(self, request: httpx.Request) -> httpx.Response:
+        if request.url.path.endswith("/query"):
+            return httpx.Response(200, json=self.query(dict(parse_qsl(request.content.decode()))))
+        return httpx.Response(200, json=self.info())
+
+
+@pytest.fixture
+def layer(monkeypatch, tmp_path, mock_transport, request):
+    """A fake layer with sync and metadata state kept in tmp_path; each test gets its own host."""
+    monkeypatch.setattr(metadata, "DB_PATH", str(tmp_path / "metadata.sqlite"))
+    monkeypatch.setattr(metadata, "_connection", None)
+    monkeypatch.setattr(metadata, "_memory", {})
+    monkeypatch.setattr(sync, "DB_PATH", str(tmp_path / "sync.sqlite"))
+    monkeypatch.setattr(sync, "_connection", None)
+    monkeypatch.setattr(sync, "_states", {})
+    monkeypatch.setattr(sync, "_subscribers", {})
+    monkeypatch.setattr(sync, "_last_deltas", {})
+    fake = FakeLayer()
+    mock_transport(fake.handler)
+    fake.url = f"https://{request.node.name.replace('_', '-')}.example.com/arcgis/rest/services/Fake/FeatureServer/0"
+    yield fake
+    for module in (metadata, sync):
+        if module._connection is not None:
+            module._connection.close()
+
+
+def _ids(delta: dict) -> list:
+    return sorted(feature["attributes"]["OBJECTID"] for feature in delta["data"]["features"])
+
+
+def test_incremental_sync_fetches_only_features_edited_since_the_watermark(layer):
+    deltas = []
+    sync.subscribe("fake", deltas.append)
+
+    async def run():
+        await sync.sync_layer("fake", layer.url)
+        layer.edit(2)
+        layer.rows[6] = NEW_EDIT
+        # Added with a preserved edit date, so only the object ID diff finds it.
+        layer.rows[7] = OLD_EDIT
+        layer.queries.clear()
+        await sync.sync_layer("fake", layer.url)
+
+    asyncio.run(run())
+    first, second = deltas
+    assert first["full"] and _ids(first) == [1, 2, 3, 4, 5]
+    assert not second["full"]
+    assert (second["since"], second["watermark"]) == (WATERMARK, NEW_EDIT)
+    assert _ids(second) == [2, 6, 7]
+    assert not any(params.get("where") == "1=1" and "objectIds" not in params and params.get("returnIdsOnly") != "true"
+                   for params in layer.queries)
+    assert sync._load("fake")["watermark"] == NEW_EDIT
+
+
+def test_unchanged_watermark_makes_no_queries(layer):
+    deltas = []
+    sync.subscribe("fake", deltas.append)
+
+    async def run():
+        await sync.sync_layer("fake", layer.url)
+        layer.queries.clear()
+        return await sync.sync_layer("fake", layer.url)
+
+    summary = asyncio.run(run())
+    assert layer.queries == []
+    assert summary["upserts"] is None and summary["deletes"] == 0
+    assert deltas[-1]["data"] is None and not deltas[-1]["full"]
+
+
+def test_deletes_come_from_the_object_id_diff(layer):
+    deltas = []
+    sync.subscribe("fake", deltas.append)
+
+    async def run():
+        await sync.sync_layer("fake", layer.url)
+        layer.delete(3)
+        layer.delete(5)
+        layer.edit(4)
+        return await sync.sync_layer("fake", layer.url)
+
+    summary = asyncio.run(run())
+    assert deltas[-1]["deletes"] == [3, 5]
+    assert _ids(deltas[-1]) == [4]
+    assert deltas[-1]["object_ids"].tolist() == [1, 2, 4]
+    assert (summary["upserts"], summary["deletes"]) == (1, 2)
+    assert sync._load("fake")["object_ids"].tolist() == [1, 2, 4]
+
+
+def test_resync_required_falls_back_to_a_full_download(layer):
+    deltas = []
+
+    def subscriber(delta):
+        deltas.append(delta)
+        if not delta["full"]:
+            raise sync.ResyncRequired("copy missing")
+
+    sync.subscribe("fake", subscriber)
+
+    async def run():
+        await sync.sync_layer("fake", layer.url)
+        layer.edit(1)
+        layer.delete(2)
+        return await sync.sync_layer("fake", layer.url)
+
+    summary = asyncio.run(run())
+    assert [delta["full"] for delta in deltas] == [True, False, True]
+    assert _ids(deltas[-1]) == [1, 3, 4, 5]
+    assert summary["full"] and summary["upserts"] == 4
+    assert sync._load("fake")["object_ids"].tolist() == [1, 3, 4, 5]
+
+
+def test_subscribers_are_notified_and_change_only_subscribers_skip_feature_downloads(layer):
+    calls = []
+    sync.subscribe("fake", lambda delta: calls.append(("invalidate", delta["full"], delta["data"], delta["deletes"])), features=False)
+
+    async def run():
+        await sync.sync_layer("fake", layer.url)
+        layer.delete(1)
+        await sync.sync_layer("fake", layer.url)
+
+    asyncio.run(run())
+    assert calls == [("invalidate", True, None, []), ("invalidate", False, None, [1])]
+    # Only object IDs were requested; no features were downloaded.
+    assert layer.queries and all(params.get("returnIdsOnly") == "true" for params in layer.queries)
+
+    received = []
+    sync.subscribe("fake", lambda delta: received.append(("first", _ids(delta))))
+    sync.subscribe("fake", lambda delta: received.append(("second", _ids(delta))))
+    layer.edit(4, NEW_EDIT + 60_000)
+    asyncio.run(sync.sync_layer("fake", layer.url))
+    assert received == [("first", [4]), ("second", [4])]
+    assert calls[-1][:2] == ("invalidate", False)
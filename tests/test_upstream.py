@@ -0,0 +1,133 @@
+import asyncio
+
+import httpx
+
+import tracing
+import upstream
+
+
+def test_concurrent_identical_requests_to_fresh_host_are_coalesced(mock_transport):
+    host = "coalesce.example.com"
+    url = f"https://{host}/arcgis/rest/services/Layer/FeatureServer/0/query"
+    calls = []
+
+    async def handler(request):
+        calls.append(request)
+        await asyncio.sleep(0.05)
+        return httpx.Response(200, json={"count": 5000})
+
+    async def run():
+        try:
+            return await asyncio.gather(*(upstream.post(url, data={"where": "1=1", "returnCountOnly": "true"}) for _ in range(3)))
+        finally:
+            client, _ = upstream._clients.pop(host)
+            await client.aclose()
+
+    mock_transport(handler)
+    results = asyncio.run(run())
+    assert len(calls) == 1
+    assert [result.json() for result in results] == [{"count": 5000}] * 3
+    assert upstream._stats[host]["coalesced"] == 2
+
+
+def test_request_started_before_half_open_does_not_end_the_probe(monkeypatch, mock_transport):
+    host = "probe.example.com"
+    url = f"https://{host}/arcgis/rest/services/Layer/FeatureServer/0/query"
+    release = None
+
+    async def handler(request):
+        await release.wait()
+        return httpx.Response(503)
+
+    async def run():
+        nonlocal release
+        release = asyncio.Event()
+        straggler = asyncio.create_task(upstream.post(url, data={"where": "1=1"}))
+        await asyncio.sleep(0.01)
+        # Another request has become the half-open probe while this one is still in flight.
+        breaker = upstream._breakers[host]
+        breaker.state, breaker.probing = "half-open", True
+        release.set()
+        try:
+            await straggler
+        except upstream.CircuitOpenError:
+            pass
+        finally:
+            client, _ = upstream._clients.pop(host)
+            await client.aclose()
+        return breaker
+
+    mock_transport(handler)
+    monkeypatch.setitem(upstream.POLICIES, host, {"retries": 1, "backoff_base": 0})
+    breaker = asyncio.run(run())
+    assert breaker.probing
+
+
+def test_hedged_attempts_get_their_own_trace_hooks(monkeypatch, mock_transport):
+    host = "hedge.example.com"
+    url = f"https://{host}/arcgis/rest/services/Layer/FeatureServer/0/query"
+    hooks = []
+
+    async def handler(request):
+        hooks.append(request.extensions["trace"])
+        # The first attempt stalls past the hedge delay; the duplicate answers at once.
+        if len(hooks) == 1:
+            await asyncio.sleep(1)
+        return httpx.Response(200, json={"count": len(hooks)})
+
+    def httpx_trace_hook():
+        async def hook(event_name, info):
+            pass
+        return hook
+
+    async def run():
+        upstream._latencies[host] = [0.01] * upstream.MIN_HEDGE_SAMPLES
+        try:
+            return await upstream.get(url, params={"f": "json"})
+        finally:
+            upstream._latencies.pop(host)
+
+    mock_transport(handler)
+    monkeypatch.setattr(tracing, "httpx_trace_hook", httpx_trace_hook)
+    monkeypatch.setitem(upstream.POLICIES, host, {"hedge": True, "hedge_min_delay": 0.01})
+    response = asyncio.run(run())
+    assert response.json() == {"count": 2}
+    assert upstream._stats[host]["hedge_wins"] == 1
+    assert len(hooks) == 2 and hooks[0] is not hooks[1]
+
+
+def test_cancelling_the_leader_does_not_cancel_the_coalesced_request(mock_transport):
+    host = "cancel.example.com"
+    url = f"https://{host}/arcgis/rest/services/Layer/FeatureServer/0/query"
+    calls = []
+
+    async def handler(request):
+        calls.append(request)
+        await asyncio.sleep(0.05)
+        return httpx.Response(200, json={"count": 7})
+
+    async def run():
+        data = {"where": "1=1", "returnCountOnly": "true"}
+        leader = asyncio.create_task(upstream.post(url, data=data))
+        await asyncio.sleep(0)
+        followers = [asyncio.create_task(upstream.post(url, data=data)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        try:
+            await leader
+        except asyncio.CancelledError:
+            pass
+        responses = await asyncio.gather(*followers)
+        # Every waiter giving up still leaves the request to finish and clear its in-flight entry.
+        last = asyncio.create_task(upstream.post(url, data={**data, "where": "2=2"}))
+        await asyncio.sleep(0.01)
+        last.cancel()
+        await asyncio.sleep(0.1)
+        return responses
+
+    mock_transport(handler)
+    responses = asyncio.run(run())
+    assert [response.json() for response in responses] == [{"count": 7}] * 2
+    assert len(calls) == 2
+    assert upstream._stats[host]["coalesced"] == 2
+    assert not any(host in key for key in upstream._in_flight)
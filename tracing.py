@@ -0,0 +1,195 @@
+"""
+Lightweight per-tool-call tracing.
+
+Each sampled tool call gets a root span; code running inside it opens child
+spans with `span(...)` (the current span follows the call through awaits and
+tasks via a context variable), and upstream requests add their connection
+phases from httpcore's trace events: connect (including DNS), TLS, sending
+the request, waiting for the response headers and reading the body.
+
+Tracing is off unless ESRI_MCP_TRACE_FILE or ESRI_MCP_TRACE_ENDPOINT is set.
+Only ESRI_MCP_TRACE_SAMPLE_RATE of tool calls (default 0.1) are traced; for
+the rest `span` is a no-op. Finished traces are exported in the OpenTelemetry
+OTLP/JSON format, appended one per line to the file and/or POSTed to the
+collector endpoint (e.g. http://localhost:4318/v1/traces).
+"""
+
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import random
+import secrets
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+import httpx
+
+TRACE_FILE = os.environ.get("ESRI_MCP_TRACE_FILE")
+TRACE_ENDPOINT = os.environ.get("ESRI_MCP_TRACE_ENDPOINT")
+SAMPLE_RATE = float(os.environ.get("ESRI_MCP_TRACE_SAMPLE_RATE", "0.1"))
+ENABLED = bool(TRACE_FILE or TRACE_ENDPOINT)
+SERVICE_NAME = "esri-mcp"
+
+logger = logging.getLogger(__name__)
+
+_current = contextvars.ContextVar("esri_mcp_span", default=None)
+_exporter = None
+_export_tasks = set()
+_stats = {"sampled": 0, "exported": 0, "export_errors": 0}
+
+
+class Span:
+    __slots__ = ("trace", "span_id", "parent_id", "name", "start", "end", "attributes", "error")
+
+    def __init__(self, trace: list, name: str, parent_id: Optional[str], attributes: dict, start: Optional[int] = None):
+        self.trace = trace
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.start = time.time_ns() if start is None else start
+        self.end = None
+        self.attributes = {key: value for key, value in attributes.items() if value is not None}
+        self.error = None
+        trace.append(self)
+
+    def set(self, **attributes) -> None:
+        self.attributes.update({key: value for key, value in attributes.items() if value is not None})
+
+
+def _otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        # OTLP/JSON encodes 64-bit integers as strings.
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp(trace_id: str, spans: list) -> dict:
+    return {"resourceSpans": [{
+        "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": SERVICE_NAME}}]},
+        "scopeSpans": [{
+            "scope": {"name": SERVICE_NAME},
+            "spans": [{
+                "traceId": trace_id,
+                "spanId": item.span_id,
+                **({"parentSpanId": item.parent_id} if item.parent_id else {}),
+                "name": item.name,
+                "kind": 1 if item.parent_id else 2,
+                "startTimeUnixNano": str(item.start),
+                "endTimeUnixNano": str(item.end or item.start),
+                "attributes": [{"key": key, "value": _otlp_value(value)} for key, value in item.attributes.items()],
+                "status": {"code": 2, "message": item.error} if item.error else {"code": 1},
+            } for item in spans],
+        }],
+    }]}
+
+
+async def _post(payload: dict) -> None:
+    global _exporter
+    if _exporter is None or _exporter[1] is not asyncio.get_running_loop():
+        # Exports bypass the upstream pool so they are not traced, rate limited or counted themselves.
+        _exporter = (httpx.AsyncClient(timeout=5), asyncio.get_running_loop())
+    try:
+        response = await _exporter[0].post(TRACE_ENDPOINT, json=payload)
+        response.raise_for_status()
+    except httpx.HTTPError as e:
+        _stats["export_errors"] += 1
+        logger.warning("Trace export failed: %s", e)
+
+
+def _export(trace_id: str, spans: list) -> None:
+    payload = _otlp(trace_id, spans)
+    _stats["exported"] += 1
+    if TRACE_FILE:
+        with open(TRACE_FILE, "a") as file:
+            file.write(json.dumps(payload, separators=(",", ":")) + "\n")
+    if TRACE_ENDPOINT:
+        task = asyncio.get_running_loop().create_task(_post(payload))
+        _export_tasks.add(task)
+        task.add_done_callback(_export_tasks.discard)
+
+
+def _active(item: Optional[Span]) -> bool:
+    # Background tasks started during a traced call inherit its context; once
+    # the root span has ended, their work is no longer part of that trace.
+    return item is not None and item.trace[0].end is None
+
+
+@contextmanager
+def _activate(item: Span):
+    token = _current.set(item)
+    try:
+        yield item
+    except BaseException as e:
+        item.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _current.reset(token)
+        item.end = time.time_ns()
+
+
+@contextmanager
+def root_span(name: str, **attributes):
+    """Starts a trace for a tool call if it is sampled; yields the root span or None."""
+    if not ENABLED or random.random() >= SAMPLE_RATE:
+        yield None
+        return
+    _stats["sampled"] += 1
+    spans = []
+    root = Span(spans, name, None, attributes)
+    try:
+        with _activate(root):
+            yield root
+    finally:
+        _export(secrets.token_hex(16), spans)
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """Opens a child of the current span; yields None (and costs almost nothing) outside a sampled trace."""
+    parent = _current.get()
+    if not _active(parent):
+        yield None
+        return
+    with _activate(Span(parent.trace, name, parent.span_id, attributes)) as item:
+        yield item
+
+
+def set_attributes(**attributes) -> None:
+    """Adds attributes to the current span, if any."""
+    current = _current.get()
+    if _active(current):
+        current.set(**attributes)
+
+
+def httpx_trace_hook():
+    """
+    Returns an httpx "trace" extension callback that records httpcore's
+    connection phases as children of the current span, or None when not tracing.
+    """
+    parent = _current.get()
+    if not _active(parent):
+        return None
+    started = {}
+
+    async def hook(event_name: str, info: dict) -> None:
+        phase, _, state = event_name.rpartition(".")
+        if state == "started":
+            started[phase] = time.time_ns()
+        elif state in ("complete", "failed") and phase in started and _active(parent):
+            item = Span(parent.trace, phase, parent.span_id, {}, start=started.pop(phase))
+            item.end = time.time_ns()
+            if state == "failed":
+                item.error = repr(info.get("exception"))
+
+    return hook
+
+
+def stats() -> dict:
+    return {"enabled": ENABLED, "sample_rate": SAMPLE_RATE, **_stats}
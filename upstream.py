@@ -0,0 +1,367 @@
+"""
+Shared HTTP client for upstream ArcGIS REST requests.
+
+Every tool in main.py routes its requests through this module so that
+connections to services.arcgis.com, mapservices.weather.noaa.gov, etc. are
+kept alive and reused instead of paying a fresh TCP+TLS handshake per call.
+Each upstream host gets its own connection pool, sized by
+ESRI_MCP_POOL_MAX_CONNECTIONS / ESRI_MCP_POOL_MAX_KEEPALIVE or per host via
+POOL_LIMITS. HTTP/2 is negotiated when the `h2` package is installed and the
+host supports it.
+
+Requests are async so that a slow upstream (e.g. a NOAA gauge query) only
+suspends the tool call waiting on it while other MCP sessions keep running.
+Each request also waits for its host's rate limiter (see ratelimit.py).
+
+Identical concurrent requests (same method, URL, parameters, body and
+headers) are coalesced: the first one goes upstream and every caller that
+arrives while it is in flight shares its response. Set
+ESRI_MCP_SINGLE_FLIGHT=0 to disable.
+
+Idempotent requests (GETs and /query POSTs) that time out, fail to connect
+or get a 5xx are retried with jittered exponential backoff. Each host has a
+circuit breaker: after `breaker_threshold` consecutive failures, requests
+to it fail fast with CircuitOpenError for `breaker_cooldown` seconds, then
+a single probe decides whether it closes again. 429 responses are retried
+too, after the pause the rate limiter takes from Retry-After. With `hedge`
+enabled, a duplicate of a slow request is sent once it has taken longer than
+the host's recent p95 latency and the host's rate limit has room for it, and
+whichever answers first wins. These settings come from DEFAULT_POLICY and
+can be overridden per host or per layer URL in POLICIES.
+
+Responses can be recorded to disk and replayed without network access; see
+cassette.py.
+"""
+
+import asyncio
+import json
+import os
+import random
+import time
+from collections import deque
+from urllib.parse import urlsplit
+
+import httpx
+
+import cassette
+import metrics
+import ratelimit
+import tracing
+
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+TIMEOUT = float(os.environ.get("ESRI_MCP_UPSTREAM_TIMEOUT", "30"))
+DEFAULT_MAX_CONNECTIONS = int(os.environ.get("ESRI_MCP_POOL_MAX_CONNECTIONS", "20"))
+DEFAULT_MAX_KEEPALIVE = int(os.environ.get("ESRI_MCP_POOL_MAX_KEEPALIVE", "10"))
+KEEPALIVE_EXPIRY = float(os.environ.get("ESRI_MCP_POOL_KEEPALIVE_EXPIRY", "60"))
+SINGLE_FLIGHT = os.environ.get("ESRI_MCP_SINGLE_FLIGHT", "1") != "0"
+
+# Per-host overrides: {"services.arcgis.com": {"max_connections": 50, "max_keepalive": 20}}
+POOL_LIMITS = {}
+
+DEFAULT_POLICY = {
+    "retries": int(os.environ.get("ESRI_MCP_RETRIES", "2")),
+    "backoff_base": float(os.environ.get("ESRI_MCP_BACKOFF_BASE", "0.25")),
+    "backoff_max": float(os.environ.get("ESRI_MCP_BACKOFF_MAX", "4")),
+    "breaker_threshold": int(os.environ.get("ESRI_MCP_BREAKER_THRESHOLD", "5")),
+    "breaker_cooldown": float(os.environ.get("ESRI_MCP_BREAKER_COOLDOWN", "30")),
+    "hedge": os.environ.get("ESRI_MCP_HEDGE", "0") == "1",
+    "hedge_min_delay": float(os.environ.get("ESRI_MCP_HEDGE_MIN_DELAY", "0.05")),
+}
+# Overrides keyed by host or by layer URL (the longest matching key wins):
+# {"mapservices.weather.noaa.gov": {"retries": 4}, "https://.../MapServer/0": {"hedge": True}}
+POLICIES = {}
+
+RETRY_STATUSES = (500, 502, 503, 504)
+# Recent latencies kept per host for the hedging delay; hedging waits for this many first.
+LATENCY_WINDOW = 200
+MIN_HEDGE_SAMPLES = 20
+
+_clients = {}
+_stats = {}
+_in_flight = {}
+_breakers = {}
+_latencies = {}
+
+
+class CircuitOpenError(httpx.TransportError):
+    """Raised instead of sending a request while the host's circuit breaker is open."""
+
+
+class _CircuitBreaker:
+    def __init__(self):
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+
+    def check(self, host: str, policy: dict) -> bool:
+        """Raises CircuitOpenError if the request may not go out; returns whether it is the half-open probe."""
+        if self.state == "closed":
+            return False
+        if self.state == "open" and time.monotonic() - self.opened_at >= policy["breaker_cooldown"]:
+            self.state = "half-open"
+        if self.state == "half-open" and not self.probing:
+            self.probing = True
+            return True
+        _stats[host]["short_circuited"] += 1
+        raise CircuitOpenError(f"Circuit breaker open for {host}")
+
+    def record(self, host: str, policy: dict, success: bool) -> None:
+        if success:
+            self.state = "closed"
+            self.failures = 0
+            return
+        self.failures += 1
+        if self.state == "half-open" or self.failures >= policy["breaker_threshold"]:
+            if self.state != "open":
+                _stats[host]["breaker_opened"] += 1
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+
+def _host(url: str) -> str:
+    return urlsplit(url).netloc
+
+
+def _new_stats() -> dict:
+    return {
+        "requests": 0, "errors": 0, "in_flight": 0, "coalesced": 0, "bytes_received": 0, "http_versions": {},
+        "retries": 0, "hedged": 0, "hedge_wins": 0, "breaker_opened": 0, "short_circuited": 0,
+    }
+
+
+def policy_for(url: str) -> dict:
+    """Returns the resilience policy for `url`: DEFAULT_POLICY, then host overrides, then the longest matching layer URL's."""
+    policy = {**DEFAULT_POLICY, **POLICIES.get(_host(url), {})}
+    prefixes = [key for key in POLICIES if "/" in key and (url == key or url.startswith((key + "/", key + "?")))]
+    if prefixes:
+        policy.update(POLICIES[max(prefixes, key=len)])
+    return policy
+
+
+def _idempotent(method: str, url: str) -> bool:
+    # Feature service queries are read-only even when POSTed.
+    return method.upper() == "GET" or urlsplit(url).path.rstrip("/").endswith("/query")
+
+
+def _backoff(policy: dict, attempt: int) -> float:
+    return random.uniform(0, min(policy["backoff_max"], policy["backoff_base"] * 2 ** attempt))
+
+
+def _percentile(values, fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def get_client(url: str) -> httpx.AsyncClient:
+    """Returns the pooled client for the host of `url`, creating it on first use."""
+    host = _host(url)
+    loop = asyncio.get_running_loop()
+    entry = _clients.get(host)
+    # An AsyncClient's connections belong to the loop that opened them.
+    if entry is not None and entry[1] is loop:
+        return entry[0]
+    limits = POOL_LIMITS.get(host, {})
+    client = httpx.AsyncClient(
+        http2=HTTP2_AVAILABLE,
+        timeout=TIMEOUT,
+        limits=httpx.Limits(
+            max_connections=limits.get("max_connections", DEFAULT_MAX_CONNECTIONS),
+            max_keepalive_connections=limits.get("max_keepalive", DEFAULT_MAX_KEEPALIVE),
+            keepalive_expiry=KEEPALIVE_EXPIRY,
+        ),
+    )
+    _clients[host] = (client, loop)
+    _stats.setdefault(host, _new_stats())
+    return client
+
+
+async def _hedged(client: httpx.AsyncClient, limiter: ratelimit.HostLimiter, host: str, policy: dict, method: str, url: str, kwargs: dict) -> httpx.Response:
+    """Sends the request, and a duplicate if the first has not answered within the host's p95 latency."""
+    latencies = _latencies.get(host)
+    first = asyncio.ensure_future(client.request(method, url, **kwargs))
+    if not policy["hedge"] or latencies is None or len(latencies) < MIN_HEDGE_SAMPLES:
+        return await first
+    delay = max(policy["hedge_min_delay"], _percentile(latencies, 0.95))
+    done, _ = await asyncio.wait({first}, timeout=delay)
+    if done:
+        return first.result()
+    if not limiter.try_acquire():
+        return await first
+    _stats[host]["hedged"] += 1
+    if "trace" in kwargs.get("extensions", {}):
+        # Each attempt records its own connection phases; a shared hook would mix up their start times.
+        kwargs = {**kwargs, "extensions": {**kwargs["extensions"], "trace": tracing.httpx_trace_hook()}}
+    second = asyncio.ensure_future(client.request(method, url, **kwargs))
+    second.add_done_callback(lambda _: limiter.release())
+    pending = {first, second}
+    error = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is second:
+                        _stats[host]["hedge_wins"] += 1
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def _send(method: str, url: str, **kwargs) -> httpx.Response:
+    client = get_client(url)
+    host = _host(url)
+    stats = _stats[host]
+    policy = policy_for(url)
+    breaker = _breakers.setdefault(host, _CircuitBreaker())
+    limiter = ratelimit.get_limiter(host)
+    idempotent = _idempotent(method, url)
+    attempts = 1 + (policy["retries"] if idempotent else 0)
+    for attempt in range(attempts):
+        if attempt:
+            stats["retries"] += 1
+            await asyncio.sleep(_backoff(policy, attempt - 1))
+        is_probe = breaker.check(host, policy)
+        stats["requests"] += 1
+        stats["in_flight"] += 1
+        layer = metrics.layer_for(url)
+        with tracing.span("upstream.request", **{"http.request.method": method, "url.full": url, "server.address": host, "esri.layer": layer or None, "attempt": attempt}) as request_span:
+            try:
+                with tracing.span("ratelimit.wait"):
+                    await limiter.acquire()
+                started = time.monotonic()
+                hook = tracing.httpx_trace_hook()
+                # Added per attempt so the trace callback never becomes part of the single-flight key.
+                request_kwargs = {**kwargs, "extensions": {"trace": hook}} if hook else kwargs
+                try:
+                    if idempotent:
+                        response = await _hedged(client, limiter, host, policy, method, url, request_kwargs)
+                    else:
+                        response = await client.request(method, url, **request_kwargs)
+                finally:
+                    limiter.release()
+            except httpx.TransportError:
+                stats["errors"] += 1
+                metrics.observe_upstream(host, url, None, error=True)
+                breaker.record(host, policy, False)
+                if attempt == attempts - 1:
+                    raise
+                continue
+            except httpx.HTTPError:
+                stats["errors"] += 1
+                metrics.observe_upstream(host, url, None, error=True)
+                raise
+            finally:
+                stats["in_flight"] -= 1
+                # Only the probe itself hands probing on; requests already in flight when the breaker went half-open must not.
+                if is_probe:
+                    breaker.probing = False
+            elapsed = time.monotonic() - started
+            _latencies.setdefault(host, deque(maxlen=LATENCY_WINDOW)).append(elapsed)
+            metrics.observe_upstream(host, url, elapsed, len(response.content), error=response.status_code >= 400)
+            stats["bytes_received"] += len(response.content)
+            versions = stats["http_versions"]
+            versions[response.http_version] = versions.get(response.http_version, 0) + 1
+            limiter.feedback(response.status_code, response.headers.get("Retry-After"))
+            breaker.record(host, policy, response.status_code not in RETRY_STATUSES)
+            failed = response.status_code in RETRY_STATUSES or response.status_code == 429
+            if request_span is not None:
+                request_span.set(**{"http.response.status_code": response.status_code, "http.response.body.size": len(response.content), "network.protocol.version": response.http_version})
+            if not failed or attempt == attempts - 1:
+                return response
+
+
+async def _fetch(method: str, url: str, kwargs: dict) -> httpx.Response:
+    response = await _send(method, url, **kwargs)
+    if cassette.RECORD:
+        await cassette.record(method, url, kwargs, response)
+    return response
+
+
+def _flight_key(method: str, url: str, kwargs: dict) -> str:
+    return json.dumps([method.upper(), url, kwargs], sort_keys=True, separators=(",", ":"), default=str)
+
+
+def _finish_flight(key: str, task: asyncio.Task) -> None:
+    if _in_flight.get(key) is task:
+        del _in_flight[key]
+    if not task.cancelled():
+        # Mark the exception as retrieved even if every waiter was cancelled.
+        task.exception()
+
+
+async def request(method: str, url: str, **kwargs) -> httpx.Response:
+    """Sends a request through the shared pool for the URL's host, sharing it with identical in-flight requests."""
+    if cassette.REPLAY:
+        response = await cassette.replay(method, url, kwargs)
+        if response is not None:
+            return response
+        if not cassette.RECORD:
+            raise cassette.CassetteMissError(f"No recorded response for {method.upper()} {url}")
+    if not SINGLE_FLIGHT:
+        return await _fetch(method, url, kwargs)
+    key = _flight_key(method, url, kwargs)
+    task = _in_flight.get(key)
+    if task is not None and task.get_loop() is asyncio.get_running_loop():
+        # The leader may not have reached get_client yet, so the host can still lack a stats entry.
+        _stats.setdefault(_host(url), _new_stats())["coalesced"] += 1
+    else:
+        task = asyncio.ensure_future(_fetch(method, url, kwargs))
+        _in_flight[key] = task
+        task.add_done_callback(lambda done: _finish_flight(key, done))
+    # Shielded so that one caller giving up does not cancel the request for the others.
+    return await asyncio.shield(task)
+
+
+async def get(url: str, **kwargs) -> httpx.Response:
+    return await request("GET", url, **kwargs)
+
+
+async def post(url: str, **kwargs) -> httpx.Response:
+    return await request("POST", url, **kwargs)
+
+
+def _pool_connections(client: httpx.AsyncClient) -> tuple:
+    # httpx does not expose pool state publicly; read it from httpcore when available.
+    pool = getattr(getattr(client, "_transport", None), "_pool", None)
+    connections = getattr(pool, "connections", None)
+    if connections is None:
+        return None, None
+    idle = sum(1 for conn in connections if conn.is_idle())
+    return len(connections), idle
+
+
+def pool_stats() -> dict:
+    """Returns per-host pool configuration and usage counters."""
+    result = {}
+    for host, (client, _) in list(_clients.items()):
+        limits = POOL_LIMITS.get(host, {})
+        open_connections, idle_connections = _pool_connections(client)
+        latencies = _latencies.get(host)
+        result[host] = {
+            "max_connections": limits.get("max_connections", DEFAULT_MAX_CONNECTIONS),
+            "max_keepalive": limits.get("max_keepalive", DEFAULT_MAX_KEEPALIVE),
+            "open_connections": open_connections,
+            "idle_connections": idle_connections,
+            **_stats[host],
+            "breaker_state": _breakers[host].state if host in _breakers else "closed",
+            "latency_p50": round(_percentile(latencies, 0.5), 4) if latencies else None,
+            "latency_p95": round(_percentile(latencies, 0.95), 4) if latencies else None,
+        }
+    return {"http2_available": HTTP2_AVAILABLE, "hosts": result, "rate_limits": ratelimit.stats(), "cassette": cassette.stats()}
+
+
+async def close() -> None:
+    """Closes every pooled client."""
+    clients = [client for client, _ in _clients.values()]
+    _clients.clear()
+    for client in clients:
+        await client.aclose()